@@ -1,18 +1,9 @@
 """This is Dallinger, a platform for simulating evolution with people."""
 
-from . import (
-    models,
-    information,
-    nodes,
-    networks,
-    processes,
-    transformations,
-    experiments,
-    heroku
-)
-
-from localconfig import config
-config.read("config.txt")
+import importlib
+import pkgutil
+import sys
+import types
 
 __all__ = (
     "config",
@@ -25,3 +16,44 @@ __all__ = (
     "experiments",
     "heroku",
 )
+
+
+def _modules(path):
+    """The names of the modules and subpackages of the package at path."""
+    return [name for (_, name, _) in pkgutil.iter_modules(path)]
+
+
+class _Package(types.ModuleType):
+    """The dallinger package, which imports its modules when first used.
+
+    ``import dallinger`` does not import SQLAlchemy, psiTurk or the Heroku
+    tools, so that the command-line utility, the web and worker processes
+    and the clock start quickly and only pay for what they use. Reading
+    ``dallinger.models``, say, imports it as ``import dallinger.models``
+    would, and ``dallinger.config`` reads ``config.txt`` the first time.
+    """
+
+    def __getattr__(self, name):
+        if name == "config":
+            from localconfig import config
+            config.read("config.txt")
+            self.config = config
+            return config
+        if not name.startswith("_") and name in _modules(self.__path__):
+            return importlib.import_module("." + name, self.__name__)
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(self.__name__, name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(__all__))
+
+
+_package = _Package(__name__, __doc__)
+_package.__dict__.update(
+    (key, value) for (key, value) in globals().items()
+    if key in ("__all__", "__file__", "__loader__", "__package__", "__path__",
+               "__spec__"))
+# Keep the original module alive: Python 2 clears the globals of a module
+# when it is deleted, and the methods above still use them.
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
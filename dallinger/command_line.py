@@ -7,24 +7,22 @@ import errno
 import imp
 import inspect
 import os
-import pexpect
 import pkg_resources
 import re
 import shutil
 import subprocess
+import sys
 import tempfile
 import time
+import traceback
 import uuid
 
-import boto
 import click
 from psiturk.psiturk_config import PsiturkConfig
-import psycopg2
-import redis
 import requests
 
-from dallinger import db
 from dallinger import heroku
+from dallinger import snapshots
 from dallinger.heroku import (
     app_name,
     scale_up_dynos
@@ -96,6 +94,7 @@ def setup_experiment(debug=True, verbose=False, app=None):
             "Fix the errors and then try running 'dallinger verify'.")
 
     # Verify that the Postgres server is running.
+    import psycopg2
     try:
         psycopg2.connect(database="x", user="postgres", password="nada")
     except psycopg2.OperationalError, e:
@@ -148,8 +147,11 @@ def setup_experiment(debug=True, verbose=False, app=None):
     # Zip up the temporary directory and place it in the cwd.
     if not debug:
         log("Freezing the experiment package...")
-        shutil.make_archive(
-            os.path.join("snapshots", id + "-code"), "zip", dst)
+        digest, reused = snapshots.snapshot(
+            dst, os.path.join("snapshots", id + "-code.zip"),
+            os.path.join("snapshots", ".cache"))
+        if reused:
+            log("Reused the snapshot of unchanged code " + digest[:8])
 
     # Change directory to the temporary folder.
     cwd = os.getcwd()
@@ -215,8 +217,6 @@ def setup_experiment(debug=True, verbose=False, app=None):
             filename)
         shutil.copy(src, os.path.join(dst, filename))
 
-    time.sleep(0.25)
-
     os.chdir(cwd)
 
     return (id, dst)
@@ -238,10 +238,193 @@ def summary(app):
         click.echo("\nYield: {:.2%}".format(1.0 * num_101s / num_10xs))
 
 
+def format_summary(summary, jobs=None):
+    """Format a summary from the /summary route, and job metrics, as lines."""
+    lines = [summary.get("time", "")]
+    lines.append("participants: " + ", ".join(
+        "{} {}".format(status, count)
+        for (status, count) in summary["summary"]))
+
+    networks = summary.get("networks", [])
+    if networks:
+        lines.append("networks: {} of {} full, {} of {} places filled".format(
+            sum(1 for net in networks if net["full"]), len(networks),
+            sum(net["size"] for net in networks),
+            sum(net["max_size"] for net in networks)))
+
+    if "completed_per_hour" in summary:
+        lines.append("throughput: {} completed in the last hour ({})".format(
+            summary["completed_per_hour"], ", ".join(
+                "{} {}".format(status, count)
+                for (status, count) in sorted(summary["throughput"].items()))
+            or "none finished"))
+
+    notifications = summary.get("notifications")
+    if notifications:
+        lines.append("queues: {}, pending {}".format(
+            ", ".join("{} {}".format(name, depth) for (name, depth)
+                      in sorted(notifications["queued"].items())),
+            notifications["pending"]))
+
+    for (name, metrics) in sorted((jobs or {}).items()):
+        lines.append(
+            "job {}: {} runs, {} failures, {} skipped, last took {}s".format(
+                name, metrics.get("runs", 0), metrics.get("failures", 0),
+                metrics.get("skipped", 0), metrics.get("last_duration")))
+    return lines
+
+
+@dallinger.command()
+@click.option('--app', default=None, help='ID of the deployed experiment')
+@click.option('--url', default=None,
+              help='URL of the experiment server, instead of --app')
+@click.option('--interval', default=10.0, type=float,
+              help='Seconds between updates')
+@click.option('--count', default=None, type=int,
+              help='Number of updates to print before stopping')
+def monitor(app, url, interval, count):
+    """Print a summary of a running experiment at an interval."""
+    base_url = (url or "https://{}.herokuapp.com".format(app_name(app)))\
+        .rstrip("/")
+    updates = 0
+    try:
+        while count is None or updates < count:
+            try:
+                r = requests.get(base_url + "/summary", timeout=interval)
+                r.raise_for_status()
+                summary = r.json()
+                r = requests.get(base_url + "/jobs", timeout=interval)
+                jobs = r.json().get("jobs") if r.ok else None
+            except (requests.exceptions.RequestException, ValueError) as e:
+                click.echo("Could not fetch the summary: {}".format(e))
+            else:
+                click.echo("\n".join(format_summary(summary, jobs)) + "\n")
+            updates += 1
+            if count is None or updates < count:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def swap_in_hotair_recruiter():
+    """Make the experiment in the current directory use HotAirRecruiter."""
+    os.rename("dallinger_experiment.py", "dallinger_experiment_tmp.py")
+    with open("dallinger_experiment_tmp.py", "r+") as f:
+        with open("dallinger_experiment.py", "w+") as f2:
+            f2.write("from dallinger.recruiters import HotAirRecruiter\n")
+            for idx, line in enumerate(f):
+                if re.search("\s*self.recruiter = (.*)", line):
+                    p = line.partition("self.recruiter =")
+                    f2.write(p[0] + p[1] + ' HotAirRecruiter\n')
+                else:
+                    f2.write(line)
+
+    os.remove("dallinger_experiment_tmp.py")
+
+
+def wait_for_server(url, timeout=30, interval=0.1):
+    """Poll url until a server answers, returning whether one did in time."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=interval * 10)
+            return True
+        except requests.RequestException:
+            time.sleep(interval)
+    return False
+
+
+def source_files(root):
+    """Map the experiment's source files under root to their mtimes.
+
+    The files that setup_experiment leaves out of the experiment, and
+    compiled Python, are not included.
+    """
+    ignored = set([".git", "snapshots", "data"])
+    mtimes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in ignored]
+        for filename in filenames:
+            if filename == "server.log" or \
+                    os.path.splitext(filename)[1] in (".db", ".pyc"):
+                continue
+            path = os.path.join(dirpath, filename)
+            mtimes[os.path.relpath(path, root)] = os.path.getmtime(path)
+    return mtimes
+
+
+def reload_experiment(src, dst, changed):
+    """Copy changed files from src to dst and reload the experiment.
+
+    The experiment module is swapped for a fresh import, so the next request
+    uses the new code. Templates are reloaded by Flask when they change, and
+    static files are served as they are. The database is left alone.
+    """
+    for name in changed:
+        target = "dallinger_experiment.py" if name == "experiment.py" \
+            else name
+        if not os.path.isdir(os.path.dirname(os.path.join(dst, target))):
+            os.makedirs(os.path.dirname(os.path.join(dst, target)))
+        shutil.copy(os.path.join(src, name), os.path.join(dst, target))
+    if "experiment.py" in changed:
+        swap_in_hotair_recruiter()
+    if any(name.endswith(".py") for name in changed):
+        import custom
+        from dallinger import experiments
+        for module in ["dallinger_experiment", "experiment"]:
+            sys.modules.pop(module, None)
+        custom.experiment = experiments.load()
+
+
+def serve_in_process(src, dst, host, port, interval=0.5):
+    """Serve the experiment in dst from this process, reloading changes.
+
+    The server is launched as soon as it answers. Files changed in src are
+    then copied over and reloaded every interval seconds until Ctrl-C.
+    """
+    from dallinger import loadtest as load
+    sys.path.insert(0, dst)
+    from psiturk.experiment import app
+    app.config["TEMPLATES_AUTO_RELOAD"] = True
+    app.jinja_env.auto_reload = True
+    server = load.serve(app, host=host, port=int(port))
+    url = "http://{}:{}".format(host, server.server_port)
+    try:
+        if not wait_for_server(url):
+            raise RuntimeError("The server at {} did not start.".format(url))
+        requests.post(url + "/launch")
+        log("Serving the experiment at {}. Changes to the experiment are "
+            "reloaded; press Ctrl-C to stop.".format(url))
+        mtimes = source_files(src)
+        while True:
+            time.sleep(interval)
+            latest = source_files(src)
+            changed = sorted(name for name in latest
+                             if mtimes.get(name) != latest[name])
+            if changed:
+                start = time.time()
+                try:
+                    reload_experiment(src, dst, changed)
+                    log("Reloaded {} in {:.2f}s.".format(
+                        ", ".join(changed), time.time() - start))
+                except Exception:
+                    log("Couldn't reload the experiment:\n" +
+                        traceback.format_exc())
+            mtimes = latest
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        sys.path.remove(dst)
+
+
 @dallinger.command()
 @click.option('--verbose', is_flag=True, flag_value=True, help='Verbose mode')
-def debug(verbose):
+@click.option('--fast', is_flag=True, flag_value=True,
+              help='Serve the experiment in process and reload changes')
+def debug(verbose, fast):
     """Run the experiment locally."""
+    from dallinger import db
     (id, tmp) = setup_experiment(debug=True, verbose=verbose)
 
     # Drop all the tables from the database.
@@ -263,19 +446,7 @@ def debug(verbose):
         "logfile",
         os.path.join(cwd, config.get("Server Parameters", "logfile")))
 
-    # Swap in the HotAirRecruiter
-    os.rename("dallinger_experiment.py", "dallinger_experiment_tmp.py")
-    with open("dallinger_experiment_tmp.py", "r+") as f:
-        with open("dallinger_experiment.py", "w+") as f2:
-            f2.write("from dallinger.recruiters import HotAirRecruiter\n")
-            for idx, line in enumerate(f):
-                if re.search("\s*self.recruiter = (.*)", line):
-                    p = line.partition("self.recruiter =")
-                    f2.write(p[0] + p[1] + ' HotAirRecruiter\n')
-                else:
-                    f2.write(line)
-
-    os.remove("dallinger_experiment_tmp.py")
+    swap_in_hotair_recruiter()
 
     # Set environment variables.
     vars = [
@@ -294,19 +465,25 @@ def debug(verbose):
 
     # Start up the local server
     log("Starting up the server...")
+    host = config.get("Server Parameters", "host")
+    port = config.get("Server Parameters", "port")
+
+    if fast:
+        serve_in_process(cwd, tmp, host, port)
+        log("Completed debugging of experiment with id " + id)
+        os.chdir(cwd)
+        return
 
     # Try opening the psiTurk shell.
+    import pexpect
     try:
         p = pexpect.spawn("psiturk")
         p.expect_exact("]$")
         p.sendline("server on")
         p.expect_exact("Experiment server launching...")
 
-        # Launche the experiment.
-        time.sleep(4)
-
-        host = config.get("Server Parameters", "host")
-        port = config.get("Server Parameters", "port")
+        # Launch the experiment once the server is up.
+        wait_for_server("http://{}:{}/".format(host, port))
 
         subprocess.check_call(
             'curl --data "" http://{}:{}/launch'.format(host, port),
@@ -322,6 +499,121 @@ def debug(verbose):
     os.chdir(cwd)
 
 
+@dallinger.command()
+@click.option('--bots', default=10, help='Number of simulated participants')
+@click.option('--script', default=None,
+              help='Bot script (defaults to the experiment directory name)')
+@click.option('--ramp-up', default=0.0, help='Seconds over which to start bots')
+@click.option('--pause', default=0.0, help='Mean think time between steps')
+@click.option('--output', default=None, help='File to write the report to')
+@click.option('--fake-mturk', is_flag=True, flag_value=True,
+              help='Recruit the bots through a local fake MTurk')
+@click.option('--duration', default=60.0,
+              help='Seconds to recruit for, with --fake-mturk')
+@click.option('--mturk-latency', default=0.0,
+              help='Seconds each fake MTurk call takes')
+@click.option('--mturk-errors', default=0.0,
+              help='Fraction of fake MTurk calls that are throttled')
+@click.option('--return-rate', default=0.0,
+              help='Fraction of fake MTurk assignments that are returned')
+@click.option('--verbose', is_flag=True, flag_value=True, help='Verbose mode')
+def loadtest(bots, script, ramp_up, pause, output, fake_mturk, duration,
+             mturk_latency, mturk_errors, return_rate, verbose):
+    """Load test the experiment locally with simulated participants."""
+    from dallinger import db
+    from dallinger import fakemturk
+    from dallinger import loadtest as load
+    script = script or os.path.basename(os.getcwd())
+    if script not in load.bots:
+        raise click.BadParameter(
+            "No bot script for {}; choose one of {}.".format(
+                script, ", ".join(sorted(load.bots))),
+            param_hint="--script")
+
+    (id, tmp) = setup_experiment(debug=True, verbose=verbose)
+    db.init_db(drop_all=True)
+
+    cwd = os.getcwd()
+    os.chdir(tmp)
+
+    if fake_mturk:
+        fake = fakemturk.FakeMTurk(
+            latency=mturk_latency,
+            error_rate=mturk_errors,
+            bot_class=load.bots[script],
+            work_time=pause,
+            return_rate=return_rate)
+        try:
+            report = fake_mturk_pipeline(tmp, fake, bots, duration)
+        finally:
+            os.chdir(cwd)
+        report["experiment_id"] = id
+        if output:
+            with open(output, "w") as f:
+                f.write(load.dumps(report))
+            log("Report written to " + output)
+        else:
+            click.echo(load.dumps(report))
+        return
+
+    swap_in_hotair_recruiter()
+
+    # Serve the app from this process so that the pool can be monitored.
+    sys.path.insert(0, tmp)
+    from psiturk.experiment import app
+    server = load.serve(app)
+    log("Sending {} bots to port {}...".format(bots, server.server_port))
+    try:
+        report = load.swarm(
+            "http://127.0.0.1:{}".format(server.server_port),
+            load.bots[script],
+            n=bots,
+            ramp_up=ramp_up,
+            pause=pause,
+            monitor=load.PoolMonitor())
+    finally:
+        server.shutdown()
+        os.chdir(cwd)
+
+    report["experiment_id"] = id
+    if output:
+        with open(output, "w") as f:
+            f.write(load.dumps(report))
+        log("Report written to " + output)
+    else:
+        click.echo(load.dumps(report))
+
+
+def fake_mturk_pipeline(tmp, fake, assignments, duration):
+    """Run the experiment in tmp against fake, returning the report.
+
+    The server runs in this process, as does the fake MTurk service, which
+    the server and a worker process find through FAKE_MTURK_URL.
+    """
+    from dallinger import fakemturk
+    from dallinger import loadtest as load
+    sys.path.insert(0, tmp)
+    from psiturk.experiment import app
+    server = load.serve(app)
+    mturk = load.serve(fakemturk.create_app(fake))
+    fake.base_url = "http://127.0.0.1:{}".format(server.server_port)
+    os.environ["FAKE_MTURK_URL"] = "http://127.0.0.1:{}".format(
+        mturk.server_port)
+    os.environ["auto_recruit"] = "true"
+    worker = subprocess.Popen([sys.executable, "worker.py"])
+    log("Recruiting {} bots through the fake MTurk for {}s...".format(
+        assignments, duration))
+    try:
+        return load.pipeline(fake.base_url, fake, assignments=assignments,
+                             duration=duration)
+    finally:
+        worker.terminate()
+        worker.wait()
+        mturk.shutdown()
+        server.shutdown()
+        del os.environ["FAKE_MTURK_URL"]
+
+
 def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
     """Set up Git, push to Heroku, and launch the app."""
     if verbose:
@@ -346,7 +638,6 @@ def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
             'git commit -m "Experiment ' + id + '"']
     for cmd in cmds:
         subprocess.check_call(cmd, stdout=out, shell=True)
-        time.sleep(0.5)
 
     # Load psiTurk configuration.
     config = PsiturkConfig()
@@ -434,6 +725,7 @@ def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
 
     # Wait for Redis database to be ready.
     log("Waiting for Redis...")
+    import redis
     ready = False
     while not ready:
         redis_URL = subprocess.check_output(
@@ -459,12 +751,10 @@ def deploy_sandbox_shared_setup(verbose=True, app=None, web_procs=1):
         "heroku config:get DATABASE_URL --app " + app_name(id), shell=True)
     config.set("Database Parameters", "database_url", db_url.rstrip())
     subprocess.check_call("git add config.txt", stdout=out, shell=True),
-    time.sleep(0.25)
     subprocess.check_call(
         'git commit -m "Save URLs for database and notifications"',
         stdout=out,
         shell=True)
-    time.sleep(0.25)
 
     # Launch the Heroku app.
     log("Pushing code to Heroku...")
@@ -660,6 +950,7 @@ def dump_database(id):
 
 def backup(app):
     """Dump the database."""
+    import boto
     dump_path = dump_database(app)
 
     config = PsiturkConfig()
@@ -733,6 +1024,7 @@ def destroy(app):
 @click.option('--databaseurl', default=None, help='URL of the database')
 def awaken(app, databaseurl):
     """Restore the database from a given url."""
+    import boto
     id = app
     config = PsiturkConfig()
     config.load_config()
@@ -780,8 +1072,19 @@ def awaken(app, databaseurl):
 @click.option('--app', default=None, help='ID of the deployed experiment')
 @click.option('--local', is_flag=True, flag_value=True,
               help='Export local data')
-def export(app, local):
+@click.option('--format', 'fmt', default='csv',
+              help='Format of the exported tables: csv (the default), '
+                   'csv.gz, csv.zst or parquet')
+@click.option('--jobs', default=4, help='Number of tables to export at once')
+@click.option('--incremental', is_flag=True, flag_value=True,
+              help='Add the rows changed since the last export')
+def export(app, local, fmt, jobs, incremental):
     """Export the data."""
+    from dallinger import data
+    if fmt not in data.FORMATS:
+        raise click.BadParameter(
+            "choose one of {}.".format(", ".join(data.FORMATS)),
+            param_hint="--format")
     print_header()
 
     log("Preparing to export the data...")
@@ -814,7 +1117,7 @@ def export(app, local):
     # open(os.path.join(id, "README.txt"), "a").close()
 
     # Save the experiment id.
-    with open(os.path.join("data", id, "experiment_id.md"), "a+") as file:
+    with open(os.path.join("data", id, "experiment_id.md"), "w") as file:
         file.write(id)
 
     if not local:
@@ -841,27 +1144,21 @@ def export(app, local):
         except Exception:
             pass
 
-    all_tables = [
-        "node",
-        "network",
-        "vector",
-        "info",
-        "transformation",
-        "transmission",
-        "participant",
-        "notification",
-        "question"
-    ]
-
-    for table in all_tables:
-        subprocess.check_call(
-            "psql -d dallinger --command=\"\\copy " + table + " to \'" +
-            os.path.join(subdata_path, table) + ".csv\' csv header\"",
-            shell=True)
+    log("Exporting the tables as {}...".format(fmt))
+    manifest = data.export_data(subdata_path, fmt=fmt, jobs=jobs,
+                                incremental=incremental)
+    run = manifest["runs"][-1]
+    log("Exported {} rows in {:.1f}s.".format(
+        sum(t["rows"] for t in run["tables"]), run["seconds"]))
 
     if not local:
         os.remove(dump_path)
 
+    if incremental:
+        # Keep the export, so that the next one can add to it.
+        log("Done. Data available in " + os.path.join("data", id))
+        return
+
     log("Zipping up the package...")
     shutil.make_archive(
         os.path.join("data", id + "-data"),
@@ -874,6 +1171,26 @@ def export(app, local):
     log("Done. Data available in " + str(id) + ".zip")
 
 
+@dallinger.command('import')
+@click.option('--app', default=None, help='ID of the exported experiment')
+@click.option('--path', default=None,
+              help='Export to import, by default data/<app>-data.zip')
+@click.option('--jobs', default=4, help='Number of tables to import at once')
+def import_data(app, path, jobs):
+    """Load exported data into the local database, replacing its data."""
+    from dallinger import data
+    if path is None:
+        if app is None:
+            raise TypeError("Select an export using the --app or --path flag.")
+        path = os.path.join("data", str(app) + "-data.zip")
+
+    log("Importing {} into the local database...".format(path))
+    start = time.time()
+    rows = data.import_data(path, jobs=jobs)
+    log("Imported {} rows in {:.1f}s.".format(
+        sum(rows.values()), time.time() - start))
+
+
 @dallinger.command()
 @click.option('--app', default=None, help='ID of the deployed experiment')
 def logs(app):
@@ -1,7 +1,9 @@
 """Import custom routes into the experiment server."""
 
+from collections import Counter
 from datetime import datetime
-from json import dumps
+from functools import partial
+from json import dumps, loads
 import logging
 from operator import attrgetter
 import os
@@ -19,14 +21,21 @@ from psiturk.db import db_session as session_psiturk
 from psiturk.db import init_db
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.user_utils import PsiTurkAuthorization
+from redis.exceptions import RedisError
 from rq import get_current_job
 from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 from worker import conn
 
 import dallinger
 from dallinger import db
+from dallinger import jobs
 from dallinger import models
+from dallinger import recruiters
 
 # Load the configuration options.
 config = PsiturkConfig()
@@ -45,6 +54,73 @@ LOG_LEVEL = LOG_LEVELS[config.getint('Server Parameters', 'loglevel')]
 
 db.logger.setLevel(LOG_LEVEL)
 
+# How participants are copied into psiTurk's table: "sync" writes the copy
+# during the request, "deferred" leaves it to a worker and "off" skips it.
+if config.has_option('Server Parameters', 'psiturk_mirror'):
+    PSITURK_MIRROR = config.get('Server Parameters', 'psiturk_mirror')
+else:
+    PSITURK_MIRROR = "deferred"
+if PSITURK_MIRROR not in ["sync", "deferred", "off"]:
+    raise ValueError(
+        "psiturk_mirror must be sync, deferred or off, not {}"
+        .format(PSITURK_MIRROR))
+
+# How MTurk notifications are processed: "single" queues a job for each one,
+# "batch" collects them in Redis and processes them in batches.
+if config.has_option('Server Parameters', 'notification_mode'):
+    NOTIFICATION_MODE = config.get('Server Parameters', 'notification_mode')
+else:
+    NOTIFICATION_MODE = "single"
+if NOTIFICATION_MODE not in ["single", "batch"]:
+    raise ValueError(
+        "notification_mode must be single or batch, not {}"
+        .format(NOTIFICATION_MODE))
+if config.has_option('Server Parameters', 'notification_batch_size'):
+    NOTIFICATION_BATCH_SIZE = config.getint(
+        'Server Parameters', 'notification_batch_size')
+else:
+    NOTIFICATION_BATCH_SIZE = 100
+
+# Whether recruitment requested while processing notifications is coalesced
+# into as few calls to the recruiter as possible, or made at once.
+if config.has_option('Server Parameters', 'coalesce_recruitment'):
+    COALESCE_RECRUITMENT = config.getboolean(
+        'Server Parameters', 'coalesce_recruitment')
+else:
+    COALESCE_RECRUITMENT = True
+
+# How approvals and bonuses are paid: "deferred" records them as payouts
+# that a separate job makes, "sync" pays them while processing the
+# notification.
+if config.has_option('Server Parameters', 'payout_mode'):
+    PAYOUT_MODE = config.get('Server Parameters', 'payout_mode')
+else:
+    PAYOUT_MODE = "deferred"
+if PAYOUT_MODE not in ["sync", "deferred"]:
+    raise ValueError(
+        "payout_mode must be sync or deferred, not {}".format(PAYOUT_MODE))
+
+# Redis key of the flag that is set while a payout job is queued or running.
+PAYOUTS_SCHEDULED = "dallinger:payouts:scheduled"
+PAYOUT_BATCH_SIZE = 100
+
+# Redis keys of the pending notifications and of the flag that is set while
+# a job to process them is queued or running. The flag expires in case that
+# job dies without clearing it.
+PENDING_NOTIFICATIONS = "dallinger:notifications"
+NOTIFICATIONS_SCHEDULED = "dallinger:notifications:scheduled"
+NOTIFICATIONS_SCHEDULED_TTL = 600
+
+# Redis key of the count of notifications received.
+NOTIFICATIONS_RECEIVED = "dallinger:notifications:received"
+
+# Redis key of the cached summary, and how many seconds it is cached for.
+SUMMARY_KEY = "dallinger:summary"
+SUMMARY_TTL = 5
+
+# The statuses of participants who submitted their assignment.
+COMPLETED_STATUSES = ["submitted", "approved", "bad_data", "did_not_attend"]
+
 if len(db.logger.handlers) == 0:
     ch = logging.StreamHandler()
     ch.setLevel(LOG_LEVEL)
@@ -66,8 +142,28 @@ custom_code = Blueprint(
 # Initialize the Dallinger database.
 session = db.session
 
-# Connect to the Redis queue for notifications.
+# Connect to the Redis queues for notifications and deferred work. The
+# worker takes jobs from high before default, and from default before low.
 q = Queue(connection=conn)
+high_q = Queue("high", connection=conn)
+low_q = Queue("low", connection=conn)
+queues = {"high": high_q, "default": q, "low": low_q}
+
+# The queue each kind of notification goes on. Approvals and bonuses that
+# participants are waiting for must not wait behind cleanups.
+NOTIFICATION_PRIORITIES = {
+    "AssignmentSubmitted": "high",
+    "NotificationMissing": "default",
+    "AssignmentAbandoned": "low",
+    "AssignmentAccepted": "low",
+    "AssignmentReturned": "low",
+}
+
+
+def notification_queue(event_type):
+    """Return the queue for notifications of event_type."""
+    return queues[NOTIFICATION_PRIORITIES.get(event_type, "default")]
+
 
 # Load the experiment.
 experiment = dallinger.experiments.load()
@@ -75,12 +171,18 @@ experiment = dallinger.experiments.load()
 """Define some canned response types."""
 
 
-def success_response(field=None, data=None, request_type=""):
-    """Return a generic success response."""
+def success_response(field=None, data=None, request_type="", deferred=None):
+    """Return a generic success response.
+
+    If the request deferred an experiment hook, the id of the queued job is
+    returned as deferred.
+    """
     data_out = {}
     data_out["status"] = "success"
     if field:
         data_out[field] = data
+    if deferred:
+        data_out["deferred"] = deferred
     print("{} request successful.".format(request_type))
     js = dumps(data_out, default=date_handler)
     return Response(js, status=200, mimetype='application/json')
@@ -184,15 +286,48 @@ def compute_bonus():
 
 @custom_code.route('/summary', methods=['GET'])
 def summary():
-    """Summarize the participants' status codes."""
-    return Response(
-        dumps({
-            "status": "success",
-            "summary": experiment(session).log_summary()
-        }),
-        status=200,
-        mimetype='application/json'
-    )
+    """Summarize the participants, networks and queues.
+
+    The summary is cached in Redis for SUMMARY_TTL seconds, so that it can
+    be polled by many clients without querying the database each time.
+    """
+    try:
+        cached = conn.get(SUMMARY_KEY)
+    except RedisError:
+        cached = None
+    if cached is None:
+        cached = dumps(dict(experiment_summary(), status="success"))
+        try:
+            conn.set(SUMMARY_KEY, cached, ex=SUMMARY_TTL)
+        except RedisError:
+            db.logger.warning("Could not cache the summary.")
+    return Response(cached, status=200, mimetype='application/json')
+
+
+def experiment_summary():
+    """Return the summary of the experiment's progress.
+
+    summary is the number of participants with each status, networks how
+    full each network is, throughput the number of participants who
+    finished in the last hour by status, completed_per_hour those of them
+    who submitted their assignment and notifications the depth of the
+    notification queues, which is None if Redis is unreachable.
+    """
+    exp = experiment(session)
+    throughput = exp.throughput(hours=1)
+    try:
+        notifications = notification_metrics()
+    except RedisError:
+        notifications = None
+    return {
+        "summary": exp.log_summary(),
+        "networks": exp.network_summary(),
+        "throughput": throughput,
+        "completed_per_hour": sum(throughput.get(status, 0)
+                                  for status in COMPLETED_STATUSES),
+        "notifications": notifications,
+        "time": datetime.now().isoformat(),
+    }
 
 
 @custom_code.route('/quitter', methods=['POST'])
@@ -297,8 +432,6 @@ def request_parameter(parameter, parameter_type=None, default=None,
     or if the parameter is found but is of the wrong type
     then a Response object is returned
     """
-    exp = experiment(session)
-
     # get the parameter
     try:
         value = request.values[parameter]
@@ -329,7 +462,7 @@ def request_parameter(parameter, parameter_type=None, default=None,
     elif parameter_type == "known_class":
         # if its a known class check against the known classes
         try:
-            value = exp.known_classes[value]
+            value = experiment(session).known_classes[value]
             return value
         except KeyError:
             msg = "{} {} request, unknown_class: {} for parameter {}".format(
@@ -354,7 +487,8 @@ def assign_properties(thing):
 
     When creating something via a post request (e.g. a node), you can pass the
     properties of the object in the request. This function gets those values
-    from the request and fills in the relevant columns of the table.
+    from the request and fills in the relevant columns of the table. It does
+    not commit, so the caller's transaction decides whether they are saved.
     """
     for p in range(5):
         property_name = "property" + str(p + 1)
@@ -362,9 +496,104 @@ def assign_properties(thing):
         if property:
             setattr(thing, property_name, property)
 
+
+# The tables whose rows can be passed to a deferred hook.
+HOOK_MODELS = {
+    "info": models.Info,
+    "network": models.Network,
+    "node": models.Node,
+    "participant": models.Participant,
+    "transformation": models.Transformation,
+    "transmission": models.Transmission,
+    "vector": models.Vector,
+}
+
+
+def call_hook(exp, hook, **kwargs):
+    """Run an experiment hook, unless the experiment defers it.
+
+    Deferred hooks are not run; instead the hook and references to its
+    arguments are returned, to be queued with defer_hook once the request
+    has committed.
+    """
+    if hook not in exp.deferred_hooks:
+        getattr(exp, hook)(**kwargs)
+        return None
+    # New rows need their ids before they can be referred to.
+    session.flush()
+    return hook, dict((name, hook_reference(value))
+                      for name, value in kwargs.items())
+
+
+def hook_reference(value):
+    """Replace database rows in a hook argument by (table, id) pairs."""
+    if isinstance(value, list):
+        return [hook_reference(v) for v in value]
+    if isinstance(value, db.Base):
+        return (value.__tablename__, value.id)
+    return value
+
+
+def load_hook_reference(value):
+    """Load the database rows a hook argument refers to."""
+    if isinstance(value, list):
+        return [load_hook_reference(v) for v in value]
+    if isinstance(value, tuple):
+        table, id = value
+        return HOOK_MODELS[table].query.get(id)
+    return value
+
+
+def defer_hook(deferred):
+    """Queue a hook returned by call_hook and return the job id.
+
+    Must be called after the request's commit, so that the worker sees the
+    rows the hook refers to. If Redis is unreachable the hook is run now, in
+    a transaction of its own.
+    """
+    if deferred is None:
+        return None
+    hook, kwargs = deferred
+    try:
+        return q.enqueue(run_deferred_hook, hook, kwargs).id
+    except RedisError:
+        db.logger.warning("Could not queue %s, running it now.", hook)
+        execute_hook(hook, kwargs)
+        session.commit()
+        return None
+
+
+def execute_hook(hook, kwargs):
+    """Run a deferred hook with its arguments loaded from the database."""
+    exp = experiment(session)
+    getattr(exp, hook)(**dict((name, load_hook_reference(value))
+                              for name, value in kwargs.items()))
+
+
+@db.scoped_session_decorator
+def run_deferred_hook(hook, kwargs):
+    """Run a deferred hook in the worker and commit its changes."""
+    execute_hook(hook, kwargs)
     session.commit()
 
 
+@custom_code.route("/deferred/<job_id>", methods=["GET"])
+def deferred_status(job_id):
+    """Get the status of a deferred hook.
+
+    The status is queued, started, finished or failed. Finished jobs are
+    forgotten by Redis after a few minutes.
+    """
+    try:
+        job = Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return error_response(error_type="/deferred GET, no job found",
+                              status=404)
+    return success_response(field="job_status",
+                            data=job.get_status(),
+                            request_type="deferred get")
+
+
 @custom_code.route("/participant/<worker_id>/<hit_id>/<assignment_id>/<mode>",
                    methods=["POST"])
 def create_participant(worker_id, hit_id, assignment_id, mode):
@@ -388,13 +617,21 @@ def create_participant(worker_id, hit_id, assignment_id, mode):
     session.add(participant)
     session.commit()
 
-    # make a psiturk participant too, for now
-    from psiturk.models import Participant as PsiturkParticipant
-    psiturk_participant = PsiturkParticipant(workerid=worker_id,
-                                             assignmentid=assignment_id,
-                                             hitid=hit_id)
-    session_psiturk.add(psiturk_participant)
-    session_psiturk.commit()
+    # replace any duplicate assignments
+    check_for_duplicate_assignments(participant)
+
+    # copy the participant into psiturk's table
+    if PSITURK_MIRROR == "deferred":
+        try:
+            low_q.enqueue(mirror_psiturk_participant,
+                          worker_id, hit_id, assignment_id)
+        except RedisError:
+            db.logger.warning("Could not queue the psiTurk copy of "
+                              "participant %s, writing it now.",
+                              participant.id)
+            write_psiturk_participant(worker_id, hit_id, assignment_id)
+    elif PSITURK_MIRROR == "sync":
+        write_psiturk_participant(worker_id, hit_id, assignment_id)
 
     # return the data
     return success_response(field="participant",
@@ -402,6 +639,41 @@ def create_participant(worker_id, hit_id, assignment_id, mode):
                             request_type="participant post")
 
 
+def write_psiturk_participant(worker_id, hit_id, assignment_id):
+    """Copy a participant into psiTurk's table, unless it is already there."""
+    from psiturk.models import Participant as PsiturkParticipant
+    with db.sessions_scope(session_psiturk, commit=True):
+        exists = PsiturkParticipant.query\
+            .filter_by(workerid=worker_id, assignmentid=assignment_id)\
+            .first()
+        if exists is None:
+            session_psiturk.add(PsiturkParticipant(workerid=worker_id,
+                                                   assignmentid=assignment_id,
+                                                   hitid=hit_id))
+
+
+def mirror_psiturk_participant(worker_id, hit_id, assignment_id,
+                               attempt=1, attempts=3, backoff=1):
+    """Write the psiTurk copy of a participant, retrying on db errors.
+
+    A failed attempt is retried by a job delayed by backoff seconds, then
+    twice as long, and so on. If the last attempt fails the error is raised
+    so that the job is kept in the failed queue.
+    """
+    try:
+        return write_psiturk_participant(worker_id, hit_id, assignment_id)
+    except SQLAlchemyError:
+        if attempt == attempts:
+            raise
+        db.logger.warning("Retrying the psiTurk copy of worker %s",
+                          worker_id)
+        jobs.enqueue_in(low_q, backoff * 2 ** (attempt - 1),
+                        mirror_psiturk_participant,
+                        worker_id, hit_id, assignment_id,
+                        attempt=attempt + 1, attempts=attempts,
+                        backoff=backoff)
+
+
 @custom_code.route("/participant/<participant_id>", methods=["GET"])
 def get_participant(participant_id):
     """Get the participant with the given id."""
@@ -469,6 +741,7 @@ def create_question(participant_id):
                         response=response, number=number)
         session.commit()
     except Exception:
+        session.rollback()
         return error_response(error_type="/question POST server error",
                               status=403)
 
@@ -512,23 +785,21 @@ def node_neighbors(node_id):
             .format(node_id))
 
     # get its neighbors
-    nodes = node.neighbours(
+    nodes = node.neighbors(
         type=node_type,
-        failed=failed,
-        connection=connection)
+        direction=connection)
 
     try:
         # ping the experiment
-        exp.node_get_request(
-            node=node,
-            nodes=nodes)
+        hook = call_hook(exp, "node_get_request", node=node, nodes=nodes)
         session.commit()
     except Exception:
         return error_response(error_type="exp.node_get_request")
 
     return success_response(field="nodes",
                             data=[n.__json__() for n in nodes],
-                            request_type="neighbors")
+                            request_type="neighbors",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<participant_id>", methods=["POST"])
@@ -537,9 +808,10 @@ def create_node(participant_id):
 
     This makes a new node for the participant, it calls:
         1. exp.get_network_for_participant
-        2. exp.create_node
-        3. exp.add_node_to_network
-        4. exp.node_post_request
+        2. exp.lock_network
+        3. exp.create_node
+        4. exp.add_node_to_network
+        5. exp.node_post_request
     """
     exp = experiment(session)
 
@@ -551,9 +823,6 @@ def create_node(participant_id):
         return error_response(error_type="/node POST no participant found",
                               status=403)
 
-    # replace any duplicate assignments
-    check_for_duplicate_assignments(participant)
-
     # Make sure the participant status is working
     if participant.status != "working":
         error_type = "/node POST, status = {}".format(participant.status)
@@ -567,6 +836,9 @@ def create_node(participant_id):
         if network is None:
             return Response(dumps({"status": "error"}), status=403)
 
+        # Hold the network's lock while its structure changes.
+        exp.lock_network(network)
+
         node = exp.create_node(
             participant=participant,
             network=network)
@@ -577,12 +849,12 @@ def create_node(participant_id):
             node=node,
             network=network)
 
-        session.commit()
-
         # ping the experiment
-        exp.node_post_request(participant=participant, node=node)
+        hook = call_hook(exp, "node_post_request",
+                         participant=participant, node=node)
         session.commit()
     except Exception:
+        session.rollback()
         return error_response(error_type="/node POST server error",
                               status=403,
                               participant=participant)
@@ -590,7 +862,8 @@ def create_node(participant_id):
     # return the data
     return success_response(field="node",
                             data=node.__json__(),
-                            request_type="/node POST")
+                            request_type="/node POST",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/vectors", methods=["GET"])
@@ -617,7 +890,8 @@ def node_vectors(node_id):
 
     try:
         vectors = node.vectors(direction=direction, failed=failed)
-        exp.vector_get_request(node=node, vectors=vectors)
+        hook = call_hook(exp, "vector_get_request",
+                         node=node, vectors=vectors)
         session.commit()
     except Exception:
         return error_response(error_type="/node/vectors GET server error",
@@ -627,7 +901,8 @@ def node_vectors(node_id):
     # return the data
     return success_response(field="vectors",
                             data=[v.__json__() for v in vectors],
-                            request_type="vector get")
+                            request_type="vector get",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/connect/<int:other_node_id>",
@@ -642,7 +917,7 @@ def connect(node_id, other_node_id):
 
     # get the parameters
     direction = request_parameter(parameter="direction", default="to")
-    if type(direction == Response):
+    if type(direction) == Response:
         return direction
 
     # check the nodes exist
@@ -663,9 +938,8 @@ def connect(node_id, other_node_id):
             assign_properties(v)
 
         # ping the experiment
-        exp.vector_post_request(
-            node=node,
-            vectors=vectors)
+        hook = call_hook(exp, "vector_post_request",
+                         node=node, vectors=vectors)
 
         session.commit()
     except Exception:
@@ -675,7 +949,8 @@ def connect(node_id, other_node_id):
 
     return success_response(field="vectors",
                             data=[v.__json__() for v in vectors],
-                            request_type="vector post")
+                            request_type="vector post",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/info/<int:node_id>/<int:info_id>", methods=["GET"])
@@ -706,7 +981,7 @@ def get_info(node_id, info_id):
 
     try:
         # ping the experiment
-        exp.info_get_request(node=node, infos=info)
+        hook = call_hook(exp, "info_get_request", node=node, infos=info)
         session.commit()
     except Exception:
         return error_response(error_type="/info GET server error",
@@ -716,7 +991,8 @@ def get_info(node_id, info_id):
     # return the data
     return success_response(field="info",
                             data=info.__json__(),
-                            request_type="info get")
+                            request_type="info get",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/infos", methods=["GET"])
@@ -745,9 +1021,7 @@ def node_infos(node_id):
         infos = node.infos(type=info_type)
 
         # ping the experiment
-        exp.info_get_request(
-            node=node,
-            infos=infos)
+        hook = call_hook(exp, "info_get_request", node=node, infos=infos)
 
         session.commit()
     except Exception:
@@ -757,7 +1031,8 @@ def node_infos(node_id):
 
     return success_response(field="infos",
                             data=[i.__json__() for i in infos],
-                            request_type="infos")
+                            request_type="infos",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/received_infos", methods=["GET"])
@@ -786,9 +1061,7 @@ def node_received_infos(node_id):
 
     try:
         # ping the experiment
-        exp.info_get_request(
-            node=node,
-            infos=infos)
+        hook = call_hook(exp, "info_get_request", node=node, infos=infos)
 
         session.commit()
     except Exception:
@@ -798,7 +1071,8 @@ def node_received_infos(node_id):
 
     return success_response(field="infos",
                             data=[i.__json__() for i in infos],
-                            request_type="received infos")
+                            request_type="received infos",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/info/<int:node_id>", methods=["POST"])
@@ -834,12 +1108,11 @@ def info_post(node_id):
         assign_properties(info)
 
         # ping the experiment
-        exp.info_post_request(
-            node=node,
-            info=info)
+        hook = call_hook(exp, "info_post_request", node=node, info=info)
 
         session.commit()
     except Exception:
+        session.rollback()
         return error_response(error_type="/info POST server error",
                               status=403,
                               participant=node.participant)
@@ -847,7 +1120,8 @@ def info_post(node_id):
     # return the data
     return success_response(field="info",
                             data=info.__json__(),
-                            request_type="info post")
+                            request_type="info post",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/transmissions", methods=["GET"])
@@ -881,7 +1155,8 @@ def node_transmissions(node_id):
             node.receive()
             session.commit()
         # ping the experiment
-        exp.transmission_get_request(node=node, transmissions=transmissions)
+        hook = call_hook(exp, "transmission_get_request",
+                         node=node, transmissions=transmissions)
         session.commit()
     except Exception:
         return error_response(
@@ -892,7 +1167,8 @@ def node_transmissions(node_id):
     # return the data
     return success_response(field="transmissions",
                             data=[t.__json__() for t in transmissions],
-                            request_type="transmissions")
+                            request_type="transmissions",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/transmit", methods=["POST"])
@@ -976,20 +1252,21 @@ def node_transmit(node_id):
         transmissions = node.transmit(what=what, to_whom=to_whom)
         for t in transmissions:
             assign_properties(t)
-        session.commit()
+
         # ping the experiment
-        exp.transmission_post_request(
-            node=node,
-            transmissions=transmissions)
+        hook = call_hook(exp, "transmission_post_request",
+                         node=node, transmissions=transmissions)
         session.commit()
     except Exception:
+        session.rollback()
         return error_response(error_type="/node/transmit POST, server error",
                               participant=node.participant)
 
     # return the data
     return success_response(field="transmissions",
                             data=[t.__json__() for t in transmissions],
-                            request_type="transmit")
+                            request_type="transmit",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/node/<int:node_id>/transformations", methods=["GET"])
@@ -1016,12 +1293,11 @@ def transformation_get(node_id):
             error_type="/node/transformations, node does not exist")
 
     # execute the request
-    transformations = node.transformations(
-        transformation_type=transformation_type)
+    transformations = node.transformations(type=transformation_type)
     try:
         # ping the experiment
-        exp.transformation_get_request(node=node,
-                                       transformations=transformations)
+        hook = call_hook(exp, "transformation_get_request",
+                         node=node, transformations=transformations)
         session.commit()
     except Exception:
         return error_response(error_type="/node/tranaformations GET failed",
@@ -1030,7 +1306,8 @@ def transformation_get(node_id):
     # return the data
     return success_response(field="transformations",
                             data=[t.__json__() for t in transformations],
-                            request_type="transformations")
+                            request_type="transformations",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route(
@@ -1074,20 +1351,21 @@ def transformation_post(node_id, info_in_id, info_out_id):
         transformation = transformation_type(info_in=info_in,
                                              info_out=info_out)
         assign_properties(transformation)
-        session.commit()
 
         # ping the experiment
-        exp.transformation_post_request(node=node,
-                                        transformation=transformation)
+        hook = call_hook(exp, "transformation_post_request",
+                         node=node, transformation=transformation)
         session.commit()
     except Exception:
+        session.rollback()
         return error_response(error_type="/tranaformation POST failed",
                               participant=node.participant)
 
     # return the data
     return success_response(field="transformation",
                             data=transformation.__json__(),
-                            request_type="transformation post")
+                            request_type="transformation post",
+                            deferred=defer_hook(hook))
 
 
 @custom_code.route("/notifications", methods=["POST", "GET"])
@@ -1097,26 +1375,81 @@ def api_notifications():
     assignment_id = request.values['Event.1.AssignmentId']
 
     # Add the notification to the queue.
-    db.logger.debug('rq: Queueing %s with id: %s for worker_function',
-                    event_type, assignment_id)
-    q.enqueue(worker_function, event_type, assignment_id, None)
-    db.logger.debug('rq: Submitted Queue Length: %d (%s)', len(q),
-                    ', '.join(q.job_ids))
+    if NOTIFICATION_MODE == "batch":
+        pending = queue_notification(event_type, assignment_id)
+        db.logger.debug('rq: Added %s with id: %s to the pending batch (%d '
+                        'pending)', event_type, assignment_id, pending)
+    else:
+        db.logger.debug('rq: Queueing %s with id: %s for worker_function',
+                        event_type, assignment_id)
+        enqueue_notification(event_type, assignment_id)
 
     return success_response(request_type="notification")
 
 
+@custom_code.route("/notifications/metrics", methods=["GET"])
+def api_notification_metrics():
+    """Count the notifications received and waiting to be processed."""
+    return success_response(field="notifications",
+                            data=notification_metrics(),
+                            request_type="notification metrics")
+
+
+@custom_code.route("/jobs", methods=["GET"])
+def api_jobs():
+    """Return the metrics of the experiment's periodic jobs."""
+    exp = experiment(session)
+    return success_response(field="jobs",
+                            data=jobs.job_metrics(sorted(exp.periodic_jobs),
+                                                  conn=conn),
+                            request_type="jobs")
+
+
+def notification_metrics():
+    """Return the notification counters, read in one Redis round trip.
+
+    received is the number of notifications received since the counter was
+    created, pending the number waiting in the batch, queued the number
+    of jobs waiting in each rq queue and network_locks the counts kept by
+    :meth:`~dallinger.experiments.Experiment.lock_network`. Each is a
+    constant time read, so this stays cheap when the queues are backed up.
+    """
+    names = sorted(queues)
+    pipe = conn.pipeline(transaction=False)
+    pipe.get(NOTIFICATIONS_RECEIVED)
+    pipe.llen(PENDING_NOTIFICATIONS)
+    pipe.hgetall(dallinger.experiments.NETWORK_LOCK_METRICS)
+    for name in names:
+        pipe.llen(queues[name].key)
+    results = pipe.execute()
+    locks = results[2]
+    return {
+        "received": int(results[0] or 0),
+        "pending": results[1],
+        "queued": dict(zip(names, results[3:])),
+        "network_locks": {
+            "locks": int(locks.get("locks", 0)),
+            "waits": int(locks.get("waits", 0)),
+            "wait_seconds": float(locks.get("wait_seconds", 0)),
+            "timeouts": int(locks.get("timeouts", 0)),
+        },
+    }
+
+
 def check_for_duplicate_assignments(participant):
     """Check that the assignment_id of the participant is unique.
 
     If it isnt the older participants will be failed.
     """
-    participants = models.Participant.query.filter_by(
-        assignment_id=participant.assignment_id).all()
-    duplicates = [p for p in participants if (p.id != participant.id and
-                                              p.status == "working")]
-    for d in duplicates:
-        q.enqueue(worker_function, "AssignmentAbandoned", None, d.id)
+    duplicates = models.Participant.query\
+        .with_entities(models.Participant.id)\
+        .filter(models.Participant.assignment_id == participant.assignment_id,
+                models.Participant.id != participant.id,
+                models.Participant.status == "working")\
+        .all()
+    for (duplicate_id, ) in duplicates:
+        low_q.enqueue(worker_function, "AssignmentAbandoned", None,
+                      duplicate_id)
 
 
 @db.scoped_session_decorator
@@ -1124,10 +1457,8 @@ def worker_function(event_type, assignment_id, participant_id):
     """Process the notification."""
     db.logger.debug("rq: worker_function working on job id: %s",
                     get_current_job().id)
-    db.logger.debug('rq: Received Queue Length: %d (%s)', len(q),
-                    ', '.join(q.job_ids))
 
-    exp = experiment(session)
+    exp = notification_experiment()
     key = "-----"
 
     exp.log("Received an {} notification for assignment {}, participant {}"
@@ -1146,29 +1477,15 @@ def worker_function(event_type, assignment_id, participant_id):
             .filter_by(assignment_id=assignment_id)\
             .all()
 
-        # if there are multiple participants select the most recent
-        if len(participants) > 1:
-            if event_type in ['AssignmentAbandoned', 'AssignmentReturned']:
-                participants = [p for p in participants if
-                                p.status == "working"]
-                if participants:
-                    participant = min(participants,
-                                      key=attrgetter('creation_time'))
-                else:
-                    return None
-            else:
-                participant = max(participants,
-                                  key=attrgetter('creation_time'))
-
         # if there are none (this is also bad news) print an error
-        elif len(participants) == 0:
+        if len(participants) == 0:
             exp.log("Warning: No participants associated with this "
                     "assignment_id. Notification will not be processed.", key)
             return None
 
-        # if theres only one participant (this is good) select them
-        else:
-            participant = participants[0]
+        participant = select_participant(participants, event_type)
+        if participant is None:
+            return None
 
     elif participant_id is not None:
         participant = models.Participant.query\
@@ -1178,7 +1495,58 @@ def worker_function(event_type, assignment_id, participant_id):
             "Error: worker_function needs either an assignment_id or a "
             "participant_id, they cannot both be None")
 
-    participant_id = participant.id
+    recruiter = exp.recruiter()
+    outcome = process_notification(exp, recruiter, event_type, participant,
+                                   assignment_id)
+    recruit_after_notifications(exp, recruiter,
+                                replacements=int(outcome == "replace"),
+                                successes=int(outcome == "approved"))
+
+    session.commit()
+
+    if event_type == 'AssignmentSubmitted':
+        schedule_payouts()
+
+
+def notification_experiment():
+    """Create the experiment used to process notifications.
+
+    Unless coalesce_recruitment is false, its recruiter coalesces the
+    recruitment requests of notifications processed at about the same time.
+    """
+    exp = experiment(session)
+    if COALESCE_RECRUITMENT:
+        exp.recruiter = partial(recruiters.CoalescingRecruiter,
+                                exp.recruiter, q)
+    return exp
+
+
+def select_participant(participants, event_type):
+    """Choose which of an assignment's participants a notification is for.
+
+    If there are several, abandoned and returned notifications are for the
+    oldest one still working (None if there is none), and all other
+    notifications for the most recent one.
+    """
+    if len(participants) == 1:
+        return participants[0]
+    if event_type in ['AssignmentAbandoned', 'AssignmentReturned']:
+        participants = [p for p in participants if p.status == "working"]
+        if participants:
+            return min(participants, key=attrgetter('creation_time'))
+        return None
+    return max(participants, key=attrgetter('creation_time'))
+
+
+def process_notification(exp, recruiter, event_type, participant,
+                         assignment_id):
+    """Apply a notification to a participant, without committing.
+
+    Returns "replace" if the participant should be replaced, "approved" if
+    they passed all the checks, and None otherwise. Recruitment is left to
+    the caller so that it can be done once for many notifications.
+    """
+    key = "-----"
 
     if event_type == 'AssignmentAccepted':
         pass
@@ -1201,7 +1569,7 @@ def worker_function(event_type, assignment_id, participant_id):
             participant.status = "submitted"
 
             # Approve the assignment.
-            exp.recruiter().approve_hit(assignment_id)
+            request_payout(recruiter, participant, "approval")
             participant.base_pay = config.get(
                 'HIT Configuration', 'base_payment')
 
@@ -1212,36 +1580,34 @@ def worker_function(event_type, assignment_id, participant_id):
             if not worked:
                 participant.status = "bad_data"
                 exp.data_check_failed(participant=participant)
-                exp.recruiter().recruit_participants(n=1)
+                return "replace"
+
+            # If their data is ok, pay them a bonus.
+            # Note that the bonus is paid before the attention check.
+            bonus = exp.bonus(participant=participant)
+            participant.bonus = bonus
+            if bonus >= 0.01:
+                exp.log("Bonus = {}: paying bonus".format(bonus), key)
+                request_payout(recruiter, participant, "bonus",
+                               amount=bonus, reason=exp.bonus_reason())
             else:
-                # If their data is ok, pay them a bonus.
-                # Note that the bonus is paid before the attention check.
-                bonus = exp.bonus(participant=participant)
-                participant.bonus = bonus
-                if bonus >= 0.01:
-                    exp.log("Bonus = {}: paying bonus".format(bonus), key)
-                    exp.recruiter().reward_bonus(
-                        assignment_id,
-                        bonus,
-                        exp.bonus_reason())
-                else:
-                    exp.log("Bonus = {}: NOT paying bonus".format(bonus), key)
-
-                # Perform an attention check.
-                attended = exp.attention_check(participant=participant)
-
-                # If they fail the attention check, fail nodes and replace.
-                if not attended:
-                    exp.log("Attention check failed.", key)
-                    participant.status = "did_not_attend"
-                    exp.attention_check_failed(participant=participant)
-                    exp.recruiter().recruit_participants(n=1)
-                else:
-                    # All good. Possibly recruit more participants.
-                    exp.log("All checks passed.", key)
-                    participant.status = "approved"
-                    exp.submission_successful(participant=participant)
-                    exp.recruit()
+                exp.log("Bonus = {}: NOT paying bonus".format(bonus), key)
+
+            # Perform an attention check.
+            attended = exp.attention_check(participant=participant)
+
+            # If they fail the attention check, fail nodes and replace.
+            if not attended:
+                exp.log("Attention check failed.", key)
+                participant.status = "did_not_attend"
+                exp.attention_check_failed(participant=participant)
+                return "replace"
+
+            # All good. Possibly recruit more participants.
+            exp.log("All checks passed.", key)
+            participant.status = "approved"
+            exp.submission_successful(participant=participant)
+            return "approved"
 
     elif event_type == "NotificationMissing":
         if participant.status == "working":
@@ -1251,8 +1617,244 @@ def worker_function(event_type, assignment_id, participant_id):
     else:
         exp.log("Error: unknown event_type {}".format(event_type), key)
 
+    return None
+
+
+def request_payout(recruiter, participant, kind, amount=None, reason=None):
+    """Pay a participant, or record the payout for process_payouts.
+
+    kind is "approval" or "bonus". Recorded payouts are saved by the
+    caller's transaction.
+    """
+    if PAYOUT_MODE == "sync":
+        if kind == "approval":
+            recruiter.approve_hit(participant.assignment_id)
+        else:
+            recruiter.reward_bonus(participant.assignment_id, amount, reason)
+    else:
+        session.add(models.Payout(assignment_id=participant.assignment_id,
+                                  participant_id=participant.id,
+                                  kind=kind,
+                                  amount=amount,
+                                  reason=reason))
+
+
+def schedule_payouts():
+    """Queue a process_payouts job, unless one is already waiting."""
+    if PAYOUT_MODE != "deferred":
+        return
+    if conn.set(PAYOUTS_SCHEDULED, 1, nx=True,
+                ex=NOTIFICATIONS_SCHEDULED_TTL):
+        high_q.enqueue(process_payouts)
+
+
+def process_payouts():
+    """Make the pending payouts in batches until none are left.
+
+    Runs on the high queue, separately from the notifications, so a slow or
+    throttled MTurk does not hold up notifications or their transactions.
+    Payouts that cannot be made yet, because another worker holds them or
+    their approval is not made, are left to that worker rather than queueing
+    job after job. Failed payouts are retried by a job delayed until the
+    first of them is due.
+    """
+    last_id = latest_payout_id()
+    try:
+        while payout_batch():
+            conn.expire(PAYOUTS_SCHEDULED, NOTIFICATIONS_SCHEDULED_TTL)
+    finally:
+        conn.delete(PAYOUTS_SCHEDULED)
+    # A payout may have been recorded after the last batch was read but
+    # before the flag was cleared, in which case nobody scheduled a job.
+    if pending_payouts(after=last_id):
+        schedule_payouts()
+        return
+    retry_time = next_payout_attempt()
+    if retry_time is not None:
+        delay = (retry_time - datetime.now()).total_seconds()
+        jobs.enqueue_in(high_q, max(delay, 0), process_payouts)
+
+
+@db.scoped_session_decorator
+def payout_batch():
+    """Make a batch of pending payouts and return how many were made."""
+    recruiter = experiment(session).recruiter()
+    return recruiters.make_payouts(recruiter, limit=PAYOUT_BATCH_SIZE)
+
+
+@db.scoped_session_decorator
+def latest_payout_id():
+    """Return the id of the latest payout, or 0 if there are none."""
+    return session.query(func.max(models.Payout.id)).scalar() or 0
+
+
+@db.scoped_session_decorator
+def next_payout_attempt():
+    """Return when the next failed payout is due to be retried, or None."""
+    return recruiters.next_payout_attempt()
+
+
+@db.scoped_session_decorator
+def pending_payouts(after=0):
+    """Return whether payouts with ids above after are waiting to be made."""
+    return models.Payout.query\
+        .filter(models.Payout.status == "pending",
+                models.Payout.id > after)\
+        .first() is not None
+
+
+def recruit_after_notifications(exp, recruiter, replacements, successes):
+    """Recruit after a number of notifications have been processed.
+
+    Participants who failed a check are replaced, and exp.recruit runs for
+    every successful one. Unless the experiment overrides recruit, this is
+    done with at most one call to the recruiter.
+    """
+    if exp.recruit.__func__ is not dallinger.experiments.Experiment.recruit\
+            .__func__:
+        if replacements:
+            recruiter.recruit_participants(n=replacements)
+        for _ in range(successes):
+            exp.recruit()
+        return
+
+    if successes and not exp.networks(full=False):
+        exp.log("All networks full: closing recruitment", "-----")
+        if replacements:
+            recruiter.recruit_participants(n=replacements)
+        recruiter.close_recruitment()
+        return
+
+    if replacements + successes:
+        exp.log("Recruiting {} more participants"
+                .format(replacements + successes), "-----")
+        recruiter.recruit_participants(n=replacements + successes)
+
+
+def queue_notification(event_type, assignment_id):
+    """Add a notification to the pending batch and return the batch size.
+
+    The notification is stored, counted and the scheduling flag claimed in a
+    single pipelined round trip. A process_notifications job is only queued
+    if no other one is waiting.
+    """
+    pipe = conn.pipeline(transaction=False)
+    pipe.rpush(PENDING_NOTIFICATIONS, dumps([event_type, assignment_id]))
+    pipe.set(NOTIFICATIONS_SCHEDULED, 1, nx=True,
+             ex=NOTIFICATIONS_SCHEDULED_TTL)
+    pipe.incr(NOTIFICATIONS_RECEIVED)
+    pending, scheduled, _ = pipe.execute()
+    if scheduled:
+        high_q.enqueue(process_notifications)
+    return pending
+
+
+def enqueue_notification(event_type, assignment_id):
+    """Queue a worker_function job for a notification and count it.
+
+    The job is saved and queued and the notification counted in a single
+    pipelined round trip.
+    """
+    queue = notification_queue(event_type)
+    job = queue.job_class.create(worker_function,
+                                 args=(event_type, assignment_id, None),
+                                 connection=conn)
+    pipe = conn.pipeline()
+    queue.enqueue_job(job, pipeline=pipe)
+    pipe.incr(NOTIFICATIONS_RECEIVED)
+    pipe.execute()
+    return job
+
+
+def process_notifications():
+    """Process the pending notifications in batches until none are left.
+
+    Each batch is processed in one transaction and only removed from Redis
+    once committed. If a batch fails, its notifications are queued one by
+    one for worker_function, so that a bad notification ends up on the
+    failed queue on its own.
+    """
+    try:
+        while True:
+            conn.expire(NOTIFICATIONS_SCHEDULED, NOTIFICATIONS_SCHEDULED_TTL)
+            events = conn.lrange(PENDING_NOTIFICATIONS,
+                                 0, NOTIFICATION_BATCH_SIZE - 1)
+            if not events:
+                break
+            events = [tuple(loads(e)) for e in events]
+            try:
+                process_notification_batch(events)
+            except Exception:
+                db.logger.exception("Notification batch failed, queueing "
+                                    "its %d notifications one by one.",
+                                    len(events))
+                for event_type, assignment_id in events:
+                    notification_queue(event_type).enqueue(
+                        worker_function, event_type, assignment_id, None)
+            conn.ltrim(PENDING_NOTIFICATIONS, len(events), -1)
+    finally:
+        conn.delete(NOTIFICATIONS_SCHEDULED)
+    # A notification may have arrived after the last read but before the
+    # flag was cleared, in which case nobody scheduled a job for it.
+    if conn.llen(PENDING_NOTIFICATIONS):
+        if conn.set(NOTIFICATIONS_SCHEDULED, 1, nx=True,
+                    ex=NOTIFICATIONS_SCHEDULED_TTL):
+            high_q.enqueue(process_notifications)
+
+
+@db.scoped_session_decorator
+def process_notification_batch(events):
+    """Process (event_type, assignment_id) notifications in one transaction.
+
+    Repeated notifications are processed once, and the participants of all
+    the assignments are loaded with one query.
+    """
+    exp = notification_experiment()
+    key = "-----"
+    exp.log("Processing a batch of {} notifications".format(len(events)), key)
+
+    session.add_all([models.Notification(assignment_id=assignment_id,
+                                         event_type=event_type)
+                     for event_type, assignment_id in events])
+
+    unique = []
+    for event in events:
+        if event not in unique:
+            unique.append(event)
+
+    assignment_ids = set(assignment_id for _, assignment_id in unique)
+    by_assignment = dict((assignment_id, []) for assignment_id in
+                         assignment_ids)
+    participants = models.Participant.query\
+        .filter(models.Participant.assignment_id.in_(assignment_ids))\
+        .all()
+    for participant in participants:
+        by_assignment[participant.assignment_id].append(participant)
+
+    recruiter = exp.recruiter()
+    outcomes = Counter()
+    for event_type, assignment_id in unique:
+        if not by_assignment[assignment_id]:
+            exp.log("Warning: No participants associated with assignment_id "
+                    "{}. Notification will not be processed."
+                    .format(assignment_id), key)
+            continue
+        participant = select_participant(by_assignment[assignment_id],
+                                         event_type)
+        if participant is None:
+            continue
+        outcome = process_notification(exp, recruiter, event_type,
+                                       participant, assignment_id)
+        outcomes[outcome] += 1
+
+    recruit_after_notifications(exp, recruiter,
+                                replacements=outcomes["replace"],
+                                successes=outcomes["approved"])
     session.commit()
 
+    if any(event_type == 'AssignmentSubmitted' for event_type, _ in unique):
+        schedule_payouts()
+
 
 def date_handler(obj):
     """Serialize dates."""
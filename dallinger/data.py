@@ -0,0 +1,794 @@
+"""Export the data of an experiment, read it back and import it again."""
+
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+import gzip
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import posixpath
+import tempfile
+import time
+import zipfile
+
+from sqlalchemy import Boolean, DateTime, Enum, Float, Integer
+from sqlalchemy.schema import AddConstraint, CreateTable
+
+from dallinger import db
+from dallinger import models
+
+#: The tables that are exported, in the order of the manifest.
+TABLES = [
+    "node",
+    "network",
+    "vector",
+    "info",
+    "transformation",
+    "transmission",
+    "participant",
+    "notification",
+    "payout",
+    "question",
+]
+
+#: The export formats, named by the extension of the files they make.
+FORMATS = ["csv", "csv.gz", "csv.zst", "parquet"]
+
+#: The file, in the export directory, that describes the export.
+MANIFEST = "manifest.json"
+
+#: For incremental exports, the columns that record when the rows of each
+#: table change after they are made. A row is exported again if one of these
+#: is later than its latest value at the previous export. The other tables
+#: change in other ways, such as a participant's status, and are exported in
+#: full every time.
+CHANGE_COLUMNS = {
+    "info": ["time_of_death"],
+    "node": ["time_of_death"],
+    "notification": ["time_of_death"],
+    "question": ["time_of_death"],
+    "transformation": ["time_of_death"],
+    "transmission": ["time_of_death", "receive_time"],
+    "vector": ["time_of_death"],
+}
+
+#: The seconds by which each incremental export reaches back before the
+#: previous one. Transactions still open when an export is taken commit
+#: rows with lower ids or earlier times than it saw, which are exported
+#: by the next run if the transaction took less than this. Rows exported
+#: twice are read and imported once.
+EXPORT_OVERLAP = 600
+
+
+def column_type(column):
+    """The type of a column as named in the manifest.
+
+    One of integer, float, boolean, timestamp or string. Enums, including
+    the statuses, are strings.
+    """
+    if isinstance(column.type, Boolean):
+        return "boolean"
+    if isinstance(column.type, Integer):
+        return "integer"
+    if isinstance(column.type, Float):
+        return "float"
+    if isinstance(column.type, DateTime):
+        return "timestamp"
+    return "string"
+
+
+def quote(name):
+    """Quote the name of a table or column for SQL.
+
+    Some names, such as the network's full column, are reserved words.
+    """
+    return '"{}"'.format(name)
+
+
+def table_columns(table):
+    """The name and type of each column of table."""
+    return [{"name": column.name, "type": column_type(column)}
+            for column in models.Base.metadata.tables[table].columns]
+
+
+@contextmanager
+def open_output(path, fmt):
+    """Open a file to write an export in the given CSV format to."""
+    if fmt == "csv":
+        f = open(path, "wb")
+        stream = f
+    elif fmt == "csv.gz":
+        f = open(path, "wb")
+        stream = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+    elif fmt == "csv.zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Exporting csv.zst needs zstandard: pip install zstandard")
+        f = open(path, "wb")
+        stream = zstandard.ZstdCompressor(level=3).stream_writer(f)
+    else:
+        raise ValueError("{} is not a CSV format".format(fmt))
+    try:
+        yield stream
+    finally:
+        if stream is not f:
+            stream.close()
+        if not f.closed:
+            f.close()
+
+
+def select_rows(cursor, table, condition=None):
+    """A SELECT of the rows of table that meet condition, if given.
+
+    condition is a pair of an SQL expression and its parameters.
+    """
+    names = ", ".join(quote(c["name"]) for c in table_columns(table))
+    query = "SELECT {} FROM {}".format(names, quote(table))
+    if condition is not None:
+        query += cursor.mogrify(" WHERE " + condition[0], condition[1])
+    return query
+
+
+def write_csv(cursor, table, path, fmt, condition=None):
+    """Stream the rows of table to path as CSV with a header row.
+
+    The rows are copied by the server, so they are never parsed here.
+    Returns the number of rows.
+    """
+    query = select_rows(cursor, table, condition)
+    with open_output(path, fmt) as f:
+        cursor.copy_expert(
+            "COPY ({}) TO STDOUT WITH CSV HEADER".format(query), f)
+    cursor.execute("SELECT count(*) FROM ({}) AS rows".format(query))
+    return cursor.fetchone()[0]
+
+
+def arrow_schema(table):
+    """The Arrow schema of table."""
+    import pyarrow as pa
+    types = {
+        "boolean": pa.bool_(),
+        "float": pa.float64(),
+        "integer": pa.int64(),
+        "string": pa.string(),
+        "timestamp": pa.timestamp("us"),
+    }
+    return pa.schema([pa.field(c["name"], types[c["type"]])
+                      for c in table_columns(table)])
+
+
+def write_parquet(connection, table, path, condition=None,
+                  batch_size=10000):
+    """Write table to path as Parquet, batch_size rows at a time.
+
+    The rows are read through a server-side cursor, and each batch becomes
+    a row group, so memory use does not grow with the size of the table.
+    Returns the number of rows.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "Exporting parquet needs pyarrow: pip install pyarrow")
+
+    schema = arrow_schema(table)
+    names = [field.name for field in schema]
+    query = select_rows(connection.cursor(), table, condition)
+    cursor = connection.cursor(name="export_{}".format(table))
+    cursor.itersize = batch_size
+    cursor.execute(query)
+    rows = 0
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            arrays = [pa.array(list(values), type=field.type)
+                      for values, field in zip(zip(*batch), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, names=names))
+            rows += len(batch)
+    finally:
+        writer.close()
+        cursor.close()
+    return rows
+
+
+def export_table(table, directory, fmt="csv", snapshot=None,
+                 engine=None, condition=None, filename=None,
+                 batch_size=10000):
+    """Export table to directory, returning its entry in the manifest.
+
+    If snapshot is given the table is read as of that exported Postgres
+    snapshot, so that tables exported in parallel are consistent. If
+    condition is given only the rows that meet it are exported. The file is
+    named filename, or after the table, and only appears once it is
+    complete.
+    """
+    engine = engine if engine is not None else db.engine
+    start = time.time()
+    filename = filename or "{}.{}".format(table, fmt)
+    path = os.path.join(directory, filename)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        if snapshot is not None:
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot, ))
+        if fmt == "parquet":
+            rows = write_parquet(connection, table, path + ".part",
+                                 condition, batch_size)
+        else:
+            rows = write_csv(cursor, table, path + ".part", fmt, condition)
+        connection.rollback()
+    finally:
+        connection.close()
+    os.rename(path + ".part", path)
+    return {
+        "table": table,
+        "file": filename,
+        "mode": "full" if condition is None else "delta",
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        "seconds": time.time() - start,
+        "columns": table_columns(table),
+    }
+
+
+def watermarks(cursor, table):
+    """The highest id of table, the latest value of its CHANGE_COLUMNS and
+    the time of the snapshot, as "snapshot_time"."""
+    columns = ["id"] + CHANGE_COLUMNS[table]
+    cursor.execute("SELECT {}, localtimestamp FROM {}".format(
+        ", ".join("max({})".format(quote(c)) for c in columns), quote(table)))
+    return dict(
+        (c, v.isoformat() if isinstance(v, datetime) else v)
+        for c, v in zip(columns + ["snapshot_time"], cursor.fetchone()))
+
+
+def delta_condition(table, low, high):
+    """The rows of table that are new or changed between two watermarks.
+
+    Rows are new if their id is above low's or they were created less than
+    EXPORT_OVERLAP seconds before low's snapshot, and changed if one of the
+    table's CHANGE_COLUMNS is later than it was at low, or than that many
+    seconds before low's snapshot. The overlap finds the rows of
+    transactions that were open at low's snapshot. Nothing above high is
+    included, so the rows are the same however often this is exported.
+    low is None for the first export, which includes every row.
+    """
+    if high["id"] is None:
+        return "false", ()
+    if low is None or low["id"] is None:
+        return '"id" <= %s', (high["id"], )
+    # Manifests written before the overlap have no snapshot_time.
+    since = low.get("snapshot_time")
+    overlap = "%s::timestamp - %s * interval '1 second'"
+    clauses = ['"id" > %s']
+    params = [low["id"]]
+    if since is not None:
+        clauses.append('"creation_time" > ' + overlap)
+        params.extend([since, EXPORT_OVERLAP])
+    for column in CHANGE_COLUMNS[table]:
+        if high[column] is None:
+            continue
+        if low[column] is None:
+            clauses.append("{0} <= %s".format(quote(column)))
+            params.append(high[column])
+        elif since is None:
+            clauses.append("({0} > %s AND {0} <= %s)".format(quote(column)))
+            params.extend([low[column], high[column]])
+        else:
+            clauses.append(
+                "({0} > least(%s, {1}) AND {0} <= %s)".format(
+                    quote(column), overlap))
+            params.extend([low[column], since, EXPORT_OVERLAP, high[column]])
+    return ('"id" <= %s AND ({})'.format(" OR ".join(clauses)),
+            tuple([high["id"]] + params))
+
+
+def load_manifest(directory):
+    """The manifest of the export in directory, or None if there is none."""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    """Replace the manifest of the export in directory."""
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + ".part", path)
+
+
+def export_data(directory, fmt="csv", tables=None, jobs=4, engine=None,
+                incremental=False):
+    """Export the tables of the database to directory, several at a time.
+
+    Each table is written to a file in the given format, one of FORMATS,
+    with jobs tables exported at once. All the tables are read from the
+    same snapshot of the database, even while the experiment is running.
+    A manifest describing the files, their row counts and the type of each
+    column is written to MANIFEST in directory and returned.
+
+    The manifest lists the runs of the export. Without incremental there is
+    one run, which exports every row. With incremental a run is added to
+    the export already in directory: the tables in CHANGE_COLUMNS are
+    exported as delta files of the rows that are new or changed since the
+    previous run, whose rows replace their earlier copies, and the other
+    tables are replaced. The manifest is updated as each table completes,
+    so a run that is interrupted is resumed by the next, which exports only
+    the tables that are missing.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("{} is not one of {}".format(fmt, ", ".join(FORMATS)))
+    tables = tables if tables is not None else TABLES
+    engine = engine if engine is not None else db.engine
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest = load_manifest(directory) if incremental else None
+    if manifest is None:
+        manifest = {"format": fmt, "incremental": incremental, "runs": []}
+    elif manifest["format"] != fmt or not manifest["incremental"]:
+        raise ValueError(
+            "{} holds an export that cannot be continued as an incremental "
+            "{} export".format(directory, fmt))
+    runs = manifest["runs"]
+    if runs and not runs[-1]["complete"]:
+        run = runs[-1]
+    else:
+        run = {
+            "run": len(runs),
+            "created": datetime.now().isoformat(),
+            "complete": False,
+            "seconds": 0.0,
+            "tables": [],
+        }
+        runs.append(run)
+    done = set(entry["table"] for entry in run["tables"])
+
+    start = time.time()
+    # The snapshot stays valid while the transaction that exported it is
+    # open, so hold it open until every table has been read.
+    coordinator = engine.raw_connection()
+    try:
+        cursor = coordinator.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        if incremental:
+            marks = run.setdefault("watermarks", {})
+            for table in tables:
+                if table in CHANGE_COLUMNS and table not in marks:
+                    marks[table] = watermarks(cursor, table)
+            write_manifest(directory, manifest)
+
+        tasks = []
+        for table in tables:
+            if table in done:
+                continue
+            kwargs = {"directory": directory, "fmt": fmt,
+                      "snapshot": snapshot, "engine": engine}
+            if incremental and table in CHANGE_COLUMNS:
+                previous = [r for r in runs[:-1]
+                            if table in r.get("watermarks", {})]
+                low = previous[-1]["watermarks"][table] if previous else None
+                kwargs["condition"] = delta_condition(
+                    table, low, run["watermarks"][table])
+                if run["run"]:
+                    kwargs["filename"] = "{}.{:04d}.{}".format(
+                        table, run["run"], fmt)
+            tasks.append(partial(export_table, table, **kwargs))
+
+        pool = ThreadPool(max(min(jobs, len(tasks)), 1))
+        try:
+            for entry in pool.imap_unordered(lambda task: task(), tasks):
+                run["tables"].append(entry)
+                write_manifest(directory, manifest)
+        finally:
+            pool.close()
+            pool.join()
+        coordinator.rollback()
+    finally:
+        coordinator.close()
+
+    run["complete"] = True
+    run["seconds"] += time.time() - start
+    write_manifest(directory, manifest)
+    return manifest
+
+
+#: The comparisons that filters can make, as in pyarrow's filters.
+OPERATORS = {
+    "=": lambda column, value: column == value,
+    "==": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "in": lambda column, value: column.isin(value),
+    "not in": lambda column, value: ~column.isin(value),
+}
+
+
+def load(path, cache_dir=None):
+    """Open the export at path, a directory or the zip made by export.
+
+    Nothing is read until a table is. See :class:`Export`.
+    """
+    return Export(path, cache_dir=cache_dir)
+
+
+class Export(object):
+    """An export of an experiment's data, opened for reading.
+
+    Tables are read lazily, one at a time, with ``export["info"]`` or
+    ``export.info``. Exports from before the manifest was added are read as
+    CSV, typed by the current models. The files of a zipped export are
+    extracted to cache_dir, a temporary directory by default, when their
+    table is first read.
+    """
+
+    def __init__(self, path, cache_dir=None):
+        """Read the manifest of the export at path."""
+        self.path = path
+        self.cache_dir = cache_dir
+        self.zip = None
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            names = self.zip.namelist()
+            manifests = [n for n in names
+                         if posixpath.basename(n) == MANIFEST]
+            if manifests:
+                self.prefix = posixpath.dirname(manifests[0])
+                manifest = json.loads(self.zip.read(manifests[0]))
+            else:
+                self.prefix = "data"
+                files = [posixpath.basename(n) for n in names
+                         if posixpath.dirname(n) == self.prefix]
+                manifest = legacy_manifest(files)
+        else:
+            # The tables are in the data directory of an unzipped export.
+            self.prefix = path
+            if not os.path.exists(os.path.join(path, MANIFEST)) and \
+                    os.path.isdir(os.path.join(path, "data")):
+                self.prefix = os.path.join(path, "data")
+            manifest = load_manifest(self.prefix)
+            if manifest is None:
+                manifest = legacy_manifest(os.listdir(self.prefix))
+        self.manifest = manifest
+        self.format = manifest["format"]
+        self._tables = {}
+
+    @property
+    def tables(self):
+        """The names of the tables in the export."""
+        names = set(entry["table"] for run in self.manifest["runs"]
+                    for entry in run["tables"])
+        return [t for t in TABLES if t in names] + \
+            sorted(names.difference(TABLES))
+
+    def __getitem__(self, table):
+        """The table named table."""
+        if table not in self._tables:
+            entries = [entry for run in self.manifest["runs"]
+                       for entry in run["tables"] if entry["table"] == table]
+            if not entries:
+                raise KeyError(table)
+            if entries[-1]["mode"] == "full":
+                entries = entries[-1:]
+            self._tables[table] = Table(self, table, entries)
+        return self._tables[table]
+
+    def __getattr__(self, table):
+        """The table named table."""
+        if table.startswith("_"):
+            raise AttributeError(table)
+        try:
+            return self[table]
+        except KeyError:
+            raise AttributeError(table)
+
+    def file(self, filename):
+        """The path of one of the export's files, extracting it if zipped."""
+        if self.zip is None:
+            return os.path.join(self.prefix, filename)
+        if self.cache_dir is None:
+            self.cache_dir = tempfile.mkdtemp(prefix="dallinger-data-")
+        member = posixpath.join(self.prefix, filename)
+        path = os.path.join(self.cache_dir, member)
+        if not os.path.exists(path):
+            self.zip.extract(member, self.cache_dir)
+        return path
+
+
+def legacy_manifest(files):
+    """A manifest for an export of CSV files made without one."""
+    tables = [f[:-len(".csv")] for f in files
+              if f.endswith(".csv") and f[:-len(".csv")] in TABLES]
+    return {
+        "format": "csv",
+        "incremental": False,
+        "runs": [{
+            "run": 0,
+            "complete": True,
+            "tables": [{
+                "table": table,
+                "file": table + ".csv",
+                "mode": "full",
+                "columns": table_columns(table),
+            } for table in tables],
+        }],
+    }
+
+
+class Table(object):
+    """A table of an export, read only when asked for.
+
+    :meth:`read` returns a pandas DataFrame of chosen columns and rows, and
+    :meth:`to_numpy` the same as a NumPy structured array. Columns are
+    typed as in the manifest: timestamps are datetimes, booleans are bools
+    and the property columns are strings. Parquet files are memory-mapped
+    and read a row group at a time, and CSV files in chunks, so only the
+    rows asked for are kept in memory. Rows exported again by incremental
+    exports replace their earlier copies, and the rows are then in id order.
+    """
+
+    #: The number of CSV rows parsed at a time.
+    chunk_size = 100000
+
+    def __init__(self, export, name, entries):
+        """Describe the table from its entries in the manifest."""
+        self.export = export
+        self.name = name
+        self.entries = entries
+        self.column_types = dict((c["name"], c["type"])
+                                 for c in entries[-1]["columns"])
+        self.columns = [c["name"] for c in entries[-1]["columns"]]
+
+    def __len__(self):
+        """The number of rows exported, counting rows exported again."""
+        return sum(entry["rows"] for entry in self.entries
+                   if "rows" in entry)
+
+    def __repr__(self):
+        """Name the table."""
+        return "<Table {} of {}>".format(self.name, self.export.path)
+
+    def read(self, columns=None, filters=None):
+        """Read the table as a pandas DataFrame.
+
+        columns is a list of the columns to read, all of them by default.
+        filters is a list of (column, operator, value) triples, all of which
+        a row must meet to be read, such as ``[("network_id", "=", 3)]``.
+        The operators are those of OPERATORS.
+        """
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("Reading exports needs pandas: "
+                              "pip install pandas")
+        columns = list(columns) if columns is not None else self.columns
+        filters = list(filters or [])
+        for name in columns + [f[0] for f in filters]:
+            if name not in self.column_types:
+                raise ValueError("{} has no column {}".format(self.name, name))
+        for f in filters:
+            if f[1] not in OPERATORS:
+                raise ValueError("Unknown operator {}".format(f[1]))
+
+        needed = list(columns)
+        for name in [f[0] for f in filters] + ["id"]:
+            if name not in needed:
+                needed.append(name)
+
+        # Read the newest file first, so that rows exported again are taken
+        # from it and their earlier copies skipped.
+        seen = set()
+        files = []
+        dedupe = len(self.entries) > 1
+        for entry in reversed(self.entries):
+            chunk_frames = []
+            for chunk in self.chunks(entry["file"], needed):
+                if dedupe:
+                    ids = chunk["id"]
+                    chunk = chunk[~ids.isin(seen)]
+                    seen.update(ids)
+                for name, op, value in filters:
+                    chunk = chunk[OPERATORS[op](chunk[name], value)]
+                chunk_frames.append(chunk[needed])
+            files.insert(0, chunk_frames)
+        frames = [frame for group in files for frame in group]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        frame = pd.concat(frames, ignore_index=True)
+        if dedupe:
+            frame = frame.sort_values("id")
+        return frame[columns].reset_index(drop=True)
+
+    def to_numpy(self, columns=None, filters=None):
+        """Read the table as a NumPy structured array; see :meth:`read`."""
+        return self.read(columns, filters).to_records(index=False)
+
+    def chunks(self, filename, columns):
+        """Read columns of one of the table's files as DataFrames."""
+        path = self.export.file(filename)
+        if self.export.format == "parquet":
+            return self.parquet_chunks(path, columns)
+        return self.csv_chunks(path, columns)
+
+    def parquet_chunks(self, path, columns):
+        """Read a Parquet file a row group at a time, memory-mapped."""
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                "Reading parquet needs pyarrow: pip install pyarrow")
+        parquet = pq.ParquetFile(path, memory_map=True)
+        for i in range(parquet.num_row_groups):
+            yield parquet.read_row_group(i, columns=columns).to_pandas()
+
+    def csv_chunks(self, path, columns):
+        """Read a CSV file in chunks, with the columns typed."""
+        import pandas as pd
+        compression = {"csv": None, "csv.gz": "gzip"}.get(self.export.format)
+        if self.export.format == "csv.zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError(
+                    "Reading csv.zst needs zstandard: pip install zstandard")
+            source = zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"))
+        else:
+            source = path
+        types = dict((c, self.column_types[c]) for c in columns)
+        dtype = dict((c, {"float": "float64", "string": object}[t])
+                     for c, t in types.items() if t in ("float", "string"))
+        try:
+            reader = pd.read_csv(
+                source, usecols=columns, dtype=dtype,
+                parse_dates=[c for c, t in types.items() if t == "timestamp"],
+                compression=compression, chunksize=self.chunk_size,
+                memory_map=self.export.format == "csv")
+            for chunk in reader:
+                for c, t in types.items():
+                    if t == "boolean":
+                        chunk[c] = chunk[c].map({"t": True, "f": False})
+                yield chunk
+        finally:
+            if source is not path:
+                source.close()
+
+
+def import_data(path, jobs=4, engine=None):
+    """Load the export at path into the database, replacing its tables.
+
+    The tables are created without their indexes and foreign keys, and
+    loaded with COPY, jobs tables at once. The indexes and foreign keys are
+    then added, the id sequences set past the highest ids and the tables
+    analyzed. Delta files of incremental exports are applied in order,
+    replacing the rows they export again. Returns the number of rows loaded
+    into each table.
+    """
+    engine = engine if engine is not None else db.engine
+    export = load(path)
+    tables = [models.Base.metadata.tables[name] for name in export.tables
+              if name in models.Base.metadata.tables]
+
+    db.session.remove()
+    models.Base.metadata.drop_all(bind=engine)
+    with engine.begin() as connection:
+        for table in models.Base.metadata.sorted_tables:
+            for column in table.columns:
+                if isinstance(column.type, Enum):
+                    column.type.create(bind=connection, checkfirst=True)
+            connection.execute(
+                CreateTable(table, include_foreign_key_constraints=[]))
+
+    pool = ThreadPool(max(min(jobs, len(tables)), 1))
+    try:
+        rows = pool.map(
+            lambda table: import_table(export, table.name, engine), tables)
+        # Every table was created without its indexes, exported or not.
+        pool.map(lambda table: create_indexes(table, engine),
+                 models.Base.metadata.sorted_tables)
+    finally:
+        pool.close()
+        pool.join()
+
+    with engine.begin() as connection:
+        for table in models.Base.metadata.sorted_tables:
+            for constraint in table.foreign_key_constraints:
+                connection.execute(AddConstraint(constraint))
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "coalesce(max(id), 1), max(id) IS NOT NULL) FROM {0}"
+                .format(quote(table.name)))
+            connection.execute("ANALYZE {}".format(quote(table.name)))
+    return dict((table.name, n) for table, n in zip(tables, rows))
+
+
+def create_indexes(table, engine):
+    """Create the indexes of table."""
+    for index in table.indexes:
+        index.create(bind=engine)
+
+
+def import_table(export, table, engine):
+    """COPY a table's files from export, returning the number of rows.
+
+    The first file is copied straight into the table. Each later file, a
+    delta of an incremental export, is copied into a temporary table whose
+    rows then replace those of the table with the same ids.
+    """
+    entries = export[table].entries
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for i, entry in enumerate(entries):
+            names = ", ".join(quote(c["name"]) for c in entry["columns"])
+            target = quote(table if i == 0 else "import_{}".format(table))
+            if i:
+                cursor.execute(
+                    "CREATE TEMPORARY TABLE {} (LIKE {}) ON COMMIT DROP"
+                    .format(target, quote(table)))
+            copy = "COPY {} ({}) FROM STDIN WITH CSV HEADER".format(
+                target, names)
+            for f in csv_files(export, entry):
+                cursor.copy_expert(copy, f)
+            if i:
+                cursor.execute(
+                    "DELETE FROM {0} USING {1} WHERE {0}.id = {1}.id"
+                    .format(quote(table), target))
+                cursor.execute("INSERT INTO {0} ({2}) SELECT {2} FROM {1}"
+                               .format(quote(table), target, names))
+            connection.commit()
+        cursor.execute("SELECT count(*) FROM {}".format(quote(table)))
+        return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def csv_files(export, entry):
+    """Open a file of an export as CSV files that COPY can read.
+
+    CSV files are read as they are, decompressing them if needed. Parquet
+    files are converted a row group at a time.
+    """
+    path = export.file(entry["file"])
+    if export.format == "csv":
+        with open(path, "rb") as f:
+            yield f
+    elif export.format == "csv.gz":
+        with gzip.open(path, "rb") as f:
+            yield f
+    elif export.format == "csv.zst":
+        import zstandard
+        with open(path, "rb") as f:
+            yield zstandard.ZstdDecompressor().stream_reader(f)
+    else:
+        from io import BytesIO
+        table = export[entry["table"]]
+        columns = [c["name"] for c in entry["columns"]]
+        integers = [c["name"] for c in entry["columns"]
+                    if c["type"] == "integer"]
+        for chunk in table.parquet_chunks(path, columns):
+            # pandas reads integers with nulls as floats, which COPY rejects.
+            for c in integers:
+                if chunk[c].dtype.kind == "f":
+                    chunk[c] = chunk[c].map(
+                        lambda v: "" if v != v else int(v))
+            f = BytesIO()
+            chunk.to_csv(f, index=False, encoding="utf-8")
+            f.seek(0)
+            yield f
@@ -1,11 +1,15 @@
 """Create a connection to the database."""
 
+from collections import Counter
 from contextlib import contextmanager
 from functools import wraps
 import logging
 import os
+import threading
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -22,6 +26,9 @@ session = scoped_session(sessionmaker(autocommit=False,
 Base = declarative_base()
 Base.query = session.query_property()
 
+# The SQLSTATE of a lock that was not granted within lock_timeout.
+LOCK_NOT_AVAILABLE = "55P03"
+
 
 @contextmanager
 def sessions_scope(local_session, commit=False):
@@ -47,23 +54,89 @@ def sessions_scope(local_session, commit=False):
 
 
 def scoped_session_decorator(func):
-    """Manage contexts and add debugging to psiTurk sessions."""
+    """Manage contexts and add debugging to db sessions.
+
+    Only the Dallinger session is opened; jobs that also write to the psiTurk
+    tables manage that session themselves.
+    """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        from dallinger.db import session as dallinger_session
-        with sessions_scope(dallinger_session):
-            from psiturk.db import db_session as psi_session
-            with sessions_scope(psi_session):
-                # The sessions used in func come from the funcs globals, but
-                # they will be proxied thread locals vars from the session
-                # registry, and will therefore be identical to those returned
-                # by the context managers above.
-                logger.debug('Running worker %s in scoped DB sessions',
-                             func.__name__)
-                return func(*args, **kwargs)
+        with sessions_scope(session):
+            # The session used in func comes from the funcs globals, but it
+            # will be a proxied thread local var from the session registry,
+            # and will therefore be identical to the one returned by the
+            # context manager above.
+            logger.debug('Running worker %s in scoped DB session',
+                         func.__name__)
+            return func(*args, **kwargs)
     return wrapper
 
 
+@contextmanager
+def lock_timeout(session, timeout):
+    """Wait at most timeout seconds for each lock taken inside the block.
+
+    A lock that is not granted in time raises an OperationalError. The
+    transaction's previous lock_timeout is restored when the block ends. If
+    timeout is None the setting is left alone.
+    """
+    if timeout is None:
+        yield
+        return
+    previous = session.execute(
+        "SELECT current_setting('lock_timeout'), "
+        "set_config('lock_timeout', :timeout, true)",
+        {"timeout": "{:d}ms".format(int(timeout * 1000))}).first()[0]
+    yield
+    # After an error the transaction is rolled back, which resets it anyway.
+    session.execute("SELECT set_config('lock_timeout', :previous, true)",
+                    {"previous": previous})
+
+
+def advisory_xact_lock(session, namespace, key, timeout=None):
+    """Take a Postgres advisory lock until the session's transaction ends.
+
+    Locks are identified by two integers: a namespace, so that different
+    kinds of lock cannot collide, and a key within it. If the lock is not
+    granted within timeout seconds an OperationalError is raised. Returns the
+    number of seconds spent waiting for the lock, or None if the transaction
+    already held it, in which case no statement is issued.
+    """
+    held = session.info.setdefault("advisory_locks", set())
+    if (namespace, key) in held:
+        return None
+    start = time.time()
+    try:
+        with lock_timeout(session, timeout):
+            session.execute(
+                "SELECT pg_advisory_xact_lock(:namespace, :key)",
+                {"namespace": namespace, "key": key})
+    except OperationalError as e:
+        if is_lock_timeout(e):
+            logger.warning("Timed out after %.3fs waiting for lock %s:%s",
+                           time.time() - start, namespace, key)
+        raise
+    held.add((namespace, key))
+    waited = time.time() - start
+    logger.debug("Waited %.3fs for lock %s:%s", waited, namespace, key)
+    return waited
+
+
+def is_lock_timeout(error):
+    """Whether error is Postgres giving up waiting for a lock."""
+    return getattr(getattr(error, "orig", None), "pgcode", None) == \
+        LOCK_NOT_AVAILABLE
+
+
+def _forget_advisory_locks(session, transaction):
+    """Forget the advisory locks held by a transaction that has ended."""
+    if transaction.parent is None:
+        session.info.pop("advisory_locks", None)
+
+
+event.listen(session, "after_transaction_end", _forget_advisory_locks)
+
+
 def init_db(drop_all=False):
     """Initialize the database, optionally dropping existing tables."""
     if drop_all:
@@ -71,3 +144,263 @@ def init_db(drop_all=False):
     Base.metadata.create_all(bind=engine)
 
     return session
+
+
+#: The number of objects bulk_mode creates before writing them to the database.
+BULK_BATCH_SIZE = 1000
+
+# The state of bulk_mode in each thread: the session, the number of objects
+# created since the last flush, the unused ids of each table and the size of
+# the last block of them, and the networks that have gained nodes.
+_bulk = threading.local()
+
+
+@contextmanager
+def bulk_mode(session=session, batch_size=BULK_BATCH_SIZE):
+    """Create many objects quickly.
+
+    Use as a context manager around a loop that creates nodes, vectors,
+    infos or transmissions, such as the setup of an experiment or a
+    simulation. Inside the block the session does not flush before every
+    query. Each new object is given an id from its table's sequence as it is
+    created, so it can be referred to before it is written. New objects are
+    written batch_size at a time, with one INSERT for each table, and the
+    rest when the block ends.
+
+    Queries in the block do not see objects created in it until they are
+    written, so it suits loops that do not read back what they create.
+    :attr:`~dallinger.models.Network.full` counts the nodes not yet written
+    as they are created, and is recalculated at the end of the block for
+    the networks that gained nodes. If the block raises,
+    nothing more is written and the caller should roll back.
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    if getattr(_bulk, "session", None) is not None:
+        # Already in bulk mode: the outer block writes the objects.
+        yield session
+        return
+
+    _bulk.session = session
+    _bulk.batch_size = batch_size
+    _bulk.created = 0
+    _bulk.ids = {}
+    _bulk.block_sizes = {}
+    _bulk.networks = set()
+    autoflush = session.autoflush
+    session.autoflush = False
+    try:
+        yield session
+        session.flush()
+        _calculate_full(session, _bulk.networks)
+    finally:
+        session.autoflush = autoflush
+        _bulk.session = None
+
+
+def _bulk_session():
+    """The session in bulk mode in this thread, or None."""
+    return getattr(_bulk, "session", None)
+
+
+def _allocate_id(table):
+    """Return an unused id from the sequence of table.
+
+    Ids are fetched from the sequence in blocks that double in size up to
+    the batch size, so that few are wasted when only a few are needed.
+    """
+    ids = _bulk.ids.setdefault(table.name, [])
+    if not ids:
+        size = min(2 * _bulk.block_sizes.get(table.name, 5), _bulk.batch_size)
+        _bulk.block_sizes[table.name] = size
+        rows = _bulk.session.execute(
+            "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+            "FROM generate_series(1, :size)",
+            {"table": table.name, "size": size})
+        ids.extend(sorted((row[0] for row in rows), reverse=True))
+    return ids.pop()
+
+
+def _assign_id(target, args, kwargs):
+    """Give an object created in bulk mode its id, writing a full batch."""
+    if _bulk_session() is None or target.id is not None:
+        return
+    table = type(target).__mapper__.base_mapper.local_table
+    if "id" not in table.c or not table.c.id.primary_key:
+        return
+    if _bulk.created >= _bulk.batch_size:
+        _bulk.session.flush()
+        _bulk.created = 0
+    _bulk.created += 1
+    target.id = _allocate_id(table)
+
+
+def _collect_networks(flushing_session, flush_context, instances):
+    """Remember the networks that gained nodes in bulk mode."""
+    if flushing_session is not _bulk_session():
+        return
+    from dallinger.models import Node
+    _bulk.networks.update(obj.network for obj in flushing_session.new
+                          if isinstance(obj, Node) and obj.network is not None)
+
+
+def pending_nodes(network):
+    """The number of nodes of network created in bulk mode and not written.
+
+    Queries do not see these nodes until they are written, so they are
+    counted when working out whether the network is full.
+    """
+    session = _bulk_session()
+    if session is None:
+        return 0
+    from dallinger.models import Node
+    return sum(1 for obj in session.new
+               if isinstance(obj, Node) and obj.network is network and
+               not obj.failed)
+
+
+def _calculate_full(session, networks):
+    """Recalculate whether each of networks is full, in one query."""
+    if not networks:
+        return
+    from dallinger.models import Node
+    sizes = dict(session.query(Node.network_id, func.count(Node.id))
+                 .filter(Node.network_id.in_([net.id for net in networks]),
+                         Node.failed.is_(False))
+                 .group_by(Node.network_id)
+                 .all())
+    for network in networks:
+        network.full = sizes.get(network.id, 0) >= int(network.max_size)
+    session.flush()
+
+
+def _insert_many(cursor, statement, parameters, context):
+    """Send an executemany INSERT in bulk mode as multi-row INSERTs.
+
+    psycopg2 sends each row of an executemany in its own round trip, so the
+    rows are instead inlined batch_size at a time into INSERT statements
+    with many VALUES.
+    """
+    if _bulk_session() is None or not statement.startswith("INSERT"):
+        return False
+    prefix, values = statement.split(" VALUES ", 1)
+    prefix = prefix.encode("utf-8") + b" VALUES "
+    size = _bulk.batch_size
+    for start in range(0, len(parameters), size):
+        cursor.execute(prefix + b",".join(
+            cursor.mogrify(values, row)
+            for row in parameters[start:start + size]))
+    return True
+
+
+event.listen(Base, "init", _assign_id, propagate=True)
+event.listen(session, "before_flush", _collect_networks)
+event.listen(engine, "do_executemany", _insert_many)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block issues more SQL than its budget allows."""
+
+
+class QueryBudget(object):
+    """Record the SQL statements issued inside a block.
+
+    Use as a context manager. On exit the block fails with
+    :class:`QueryBudgetExceeded` if it issued more than ``max_queries``
+    statements, or if any single statement was repeated more than
+    ``max_repeats`` times, which usually indicates an N+1 query, or if it
+    committed more than ``max_commits`` times. Any limit can be ``None`` to
+    disable the check.
+
+    If ``explain`` is True, the plan of every ``SELECT`` is captured with
+    ``EXPLAIN`` on the same connection so that index usage can be asserted
+    with :meth:`assert_no_seq_scan`. Plans are captured with sequential scans
+    disabled, so a scan that remains means no index can serve the query.
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None, explain=False,
+                 bind=None, max_commits=None):
+        """Set the budget."""
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.max_commits = max_commits
+        self.explain = explain
+        self.bind = bind if bind is not None else engine
+        self.statements = []
+        self.plans = []
+        self.commits = 0
+
+    def __enter__(self):
+        """Start recording."""
+        event.listen(self.bind, "after_cursor_execute", self._record)
+        event.listen(self.bind, "commit", self._record_commit)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        """Stop recording and check the budget."""
+        event.remove(self.bind, "after_cursor_execute", self._record)
+        event.remove(self.bind, "commit", self._record_commit)
+        if exc_type is None:
+            self.check()
+
+    def _record_commit(self, conn):
+        self.commits += 1
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+        if self.explain and statement.lstrip().upper().startswith("SELECT"):
+            # Small test tables are always cheaper to scan, so discourage
+            # sequential scans: a plan that still uses one has no index.
+            explain_cursor = cursor.connection.cursor()
+            try:
+                explain_cursor.execute("SET enable_seqscan = off")
+                explain_cursor.execute("EXPLAIN " + statement, parameters)
+                plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+                explain_cursor.execute("RESET enable_seqscan")
+            finally:
+                explain_cursor.close()
+            self.plans.append((statement, plan))
+
+    @property
+    def count(self):
+        """The number of statements issued so far."""
+        return len(self.statements)
+
+    def repeated(self):
+        """Statements issued more than ``max_repeats`` times, with counts."""
+        if self.max_repeats is None:
+            return {}
+        return dict((s, n) for s, n in Counter(self.statements).items()
+                    if n > self.max_repeats)
+
+    def check(self):
+        """Raise if the recorded statements exceed the budget."""
+        if self.max_queries is not None and self.count > self.max_queries:
+            raise QueryBudgetExceeded(
+                "{} queries issued, budget is {}:\n{}".format(
+                    self.count, self.max_queries,
+                    "\n".join(self.statements)))
+        if self.max_commits is not None and self.commits > self.max_commits:
+            raise QueryBudgetExceeded(
+                "{} commits, budget is {}".format(
+                    self.commits, self.max_commits))
+        repeats = self.repeated()
+        if repeats:
+            worst = max(repeats, key=repeats.get)
+            raise QueryBudgetExceeded(
+                "Possible N+1: statement issued {} times, budget is {}:\n{}"
+                .format(repeats[worst], self.max_repeats, worst))
+
+    def seq_scans(self, table):
+        """Captured plans that sequentially scan ``table``."""
+        target = "Seq Scan on {} ".format(table)
+        return [(s, p) for s, p in self.plans if target in p]
+
+    def assert_no_seq_scan(self, table):
+        """Raise if any captured plan sequentially scans ``table``."""
+        scans = self.seq_scans(table)
+        if scans:
+            raise QueryBudgetExceeded(
+                "Sequential scan on {}:\n{}\n{}".format(
+                    table, scans[0][0], scans[0][1]))
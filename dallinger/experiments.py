@@ -1,14 +1,14 @@
 """The base experiment class."""
 
-from collections import Counter
+from datetime import datetime, timedelta
 import imp
 import inspect
-from operator import itemgetter
-import random
 import sys
 
-from sqlalchemy import and_
+from sqlalchemy import Integer, and_, cast, func, select
+from sqlalchemy.exc import OperationalError
 
+from dallinger import db
 from dallinger.models import Network, Node, Info, Transformation, Participant
 from dallinger.information import Gene, Meme, State
 from dallinger.nodes import Agent, Source, Environment
@@ -16,6 +16,12 @@ from dallinger.transformations import Compression, Response
 from dallinger.transformations import Mutation, Replication
 from dallinger.networks import Empty
 
+#: Namespace of the advisory locks taken on networks.
+NETWORK_LOCK = 1
+
+#: A Redis hash counting the network locks taken, waited for and timed out.
+NETWORK_LOCK_METRICS = "dallinger:network_locks"
+
 
 class Experiment(object):
     """Define the structure of an experiment."""
@@ -51,6 +57,29 @@ class Experiment(object):
         #: requested when the experiment first starts. Default is 1.
         self.initial_recruitment_size = 1
 
+        #: float, the number of seconds to wait for another request that is
+        #: changing the same network before giving up. Default is 10.
+        self.network_lock_timeout = 10
+
+        #: set, the names of request hooks (e.g. ``"info_post_request"``)
+        #: that run in the worker after the request has committed, instead
+        #: of inside the request. Deferred hooks get their own session and
+        #: the request returns the id of the queued job as ``deferred``.
+        #: Default is empty.
+        self.deferred_hooks = set()
+
+        #: dictionary, the background jobs that the clock process runs. Keys
+        #: are the names of methods of the experiment and values the number
+        #: of seconds between runs. Each run has its own session and a job
+        #: never runs twice at once. Default is empty.
+        self.periodic_jobs = {}
+
+        #: set, the names of periodic jobs that only run if they have been
+        #: requested with
+        #: :func:`~dallinger.experiments.Experiment.request_job` since they
+        #: last ran. Default is empty.
+        self.debounced_jobs = set()
+
         #: dictionary, the classes Dallinger can make in response
         #: to front-end requests. Experiments can add new classes to this
         #: dictionary.
@@ -119,43 +148,65 @@ class Experiment(object):
         first complete networks with `role="practice"` before doing all other
         networks in a random order.
 
+        The chosen network is locked until the end of the transaction, so
+        concurrent requests cannot both take its last place. Networks locked
+        by other requests are skipped while any other network has space.
+
         """
         key = participant.id
-        networks_with_space = Network.query.filter_by(full=False).all()
-        networks_participated_in = [
-            node.network_id for node in
-            Node.query.with_entities(Node.network_id)
-                .filter_by(participant_id=participant.id).all()
-        ]
-
-        legal_networks = [
-            net for net in networks_with_space
-            if net.id not in networks_participated_in
-        ]
-
-        if not legal_networks:
+        participated = self.session.query(Node.network_id)\
+            .filter(Node.participant_id == participant.id)
+        available = Network.query.filter(Network.full.is_(False))\
+            .filter(~Network.id.in_(participated))
+
+        chosen_network = None
+        if self.practice_repeats:
+            chosen_network = self._reserve_network(
+                available.filter(Network.role == "practice")
+                .order_by(Network.id))
+            if chosen_network is not None:
+                self.log("Practice networks available."
+                         "Assigning participant to practice network {}."
+                         .format(chosen_network.id), key)
+                return chosen_network
+
+        experiment_networks = available.filter(Network.role != "practice")
+        # Start from a random id and take the first network from there, or
+        # from the first id if none is left after it. Both are bounded scans
+        # of the index of networks that are not full.
+        ids = Network.__table__.alias()
+        start = select([
+            cast(func.floor(func.random() * func.max(ids.c.id)), Integer)])\
+            .as_scalar()
+        chosen_network = self._reserve_network(
+            experiment_networks.filter(Network.id >= start)
+            .order_by(Network.id),
+            experiment_networks.order_by(Network.id))
+        if chosen_network is None:
             self.log("No networks available, returning None", key)
-            return None
-
-        self.log("{} networks out of {} available"
-                 .format(len(legal_networks),
-                         (self.practice_repeats + self.experiment_repeats)),
-                 key)
-
-        legal_practice_networks = [net for net in legal_networks
-                                   if net.role == "practice"]
-        if legal_practice_networks:
-            chosen_network = legal_practice_networks[0]
-            self.log("Practice networks available."
-                     "Assigning participant to practice network {}."
-                     .format(chosen_network.id), key)
         else:
-            chosen_network = random.choice(legal_networks)
             self.log("No practice networks available."
                      "Assigning participant to experiment network {}"
                      .format(chosen_network.id), key)
         return chosen_network
 
+    def _reserve_network(self, *queries):
+        """Lock and return the first network of the first query with one.
+
+        Networks locked by concurrent requests are skipped. If every network
+        is locked, waits at most `network_lock_timeout` seconds for the first
+        network of the last query, which should include all the others.
+        Returns None if there is no network.
+        """
+        for query in queries:
+            network = query.with_for_update(skip_locked=True).first()
+            if network is not None:
+                return network
+        # Postgres rechecks that the network still has space once the request
+        # holding it commits.
+        with db.lock_timeout(self.session, self.network_lock_timeout):
+            return queries[-1].with_for_update().first()
+
     def create_node(self, participant, network):
         """Create a node for a participant."""
         return Node(network=network, participant=participant)
@@ -163,11 +214,59 @@ class Experiment(object):
     def add_node_to_network(self, node, network):
         """Add a node to a network.
 
-        This passes `node` to :func:`~dallinger.models.Network.add_node()`.
+        This passes `node` to :func:`~dallinger.models.Network.add_node()`
+        while holding the network's lock (see
+        :func:`~dallinger.experiments.Experiment.lock_network`).
 
         """
+        self.lock_network(network)
         network.add_node(node)
 
+    def lock_network(self, network):
+        """Serialize changes to the structure of a network.
+
+        Takes a Postgres advisory lock on `network` that is released when the
+        transaction ends, so that concurrent requests adding nodes to the same
+        network see each other's nodes. Other networks are not affected. Waits
+        at most `network_lock_timeout` seconds and returns the time waited.
+        A network already locked in this transaction is not locked again.
+        The locks taken, waits longer than 0.1s and timeouts are counted in
+        Redis.
+
+        """
+        try:
+            waited = db.advisory_xact_lock(
+                self.session, NETWORK_LOCK, network.id,
+                timeout=self.network_lock_timeout)
+        except OperationalError as e:
+            if db.is_lock_timeout(e):
+                self._count_network_lock(timeouts=1)
+            raise
+        if waited is None:
+            return 0.0
+        if waited > 0.1:
+            db.logger.info("Waited %.3fs for the lock on network %s",
+                           waited, network.id)
+            self._count_network_lock(locks=1, waits=1, wait_seconds=waited)
+        else:
+            self._count_network_lock(locks=1)
+        return waited
+
+    def _count_network_lock(self, **counts):
+        """Add counts to the network lock metrics, if Redis is available."""
+        from dallinger import jobs
+        from redis.exceptions import RedisError
+        try:
+            pipe = jobs.redis_connection().pipeline()
+            for (field, count) in counts.items():
+                if isinstance(count, float):
+                    pipe.hincrbyfloat(NETWORK_LOCK_METRICS, field, count)
+                else:
+                    pipe.hincrby(NETWORK_LOCK_METRICS, field, count)
+            pipe.execute()
+        except RedisError:
+            db.logger.warning("Could not record network lock metrics")
+
     def data_check(self, participant):
         """Check that the data are acceptable.
 
@@ -232,6 +331,26 @@ class Experiment(object):
             self.log("All networks full: closing recruitment", "-----")
             self.recruiter().close_recruitment()
 
+    def request_job(self, name):
+        """Ask for a debounced job to run.
+
+        The job runs in the clock process at its next interval, once however
+        many times it is requested before then. Use this instead of doing
+        slow work that can wait, such as a periodic summary, inside a
+        request; work that the next participants depend on, such as
+        stepping an environment, should be done at once. If no clock process
+        is running, as when clock_on is false or when debugging, the job
+        runs at once in this session instead.
+
+        """
+        if name not in self.debounced_jobs:
+            raise ValueError("{} is not a debounced job".format(name))
+        from dallinger import jobs
+        if jobs.clock_running():
+            jobs.request_job(name)
+        else:
+            getattr(self, name)()
+
     def log(self, text, key="?????", force=False):
         """Print a string to the logs."""
         if force or self.verbose:
@@ -240,13 +359,47 @@ class Experiment(object):
 
     def log_summary(self):
         """Log a summary of all the participants' status codes."""
-        participants = Participant.query\
-            .with_entities(Participant.status).all()
-        counts = Counter([p.status for p in participants])
-        sorted_counts = sorted(counts.items(), key=itemgetter(0))
+        counts = Participant.query\
+            .with_entities(Participant.status, func.count(Participant.id))\
+            .group_by(Participant.status)\
+            .all()
+        # Postgres would sort the enum in the order its values are declared.
+        sorted_counts = sorted((status, count) for (status, count) in counts)
         self.log("Status summary: {}".format(str(sorted_counts)))
         return sorted_counts
 
+    def network_summary(self):
+        """Return how full each network that has not failed is.
+
+        Each network is described by its id, role, max_size, full and size,
+        its number of nodes that have not failed, all counted in one query.
+        """
+        rows = self.session\
+            .query(Network.id, Network.role, Network.max_size, Network.full,
+                   func.count(Node.id))\
+            .outerjoin(Node, and_(Node.network_id == Network.id,
+                                  Node.failed.is_(False)))\
+            .filter(Network.failed.is_(False))\
+            .group_by(Network.id)\
+            .order_by(Network.id)\
+            .all()
+        keys = ["id", "role", "max_size", "full", "size"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def throughput(self, hours=1):
+        """Count the participants who finished in the last hours by status.
+
+        A participant finishes when they submit, return or abandon their
+        assignment. Returns the counts as a dict, keyed by status.
+        """
+        since = datetime.now() - timedelta(hours=hours)
+        counts = Participant.query\
+            .with_entities(Participant.status, func.count(Participant.id))\
+            .filter(Participant.end_time >= since)\
+            .group_by(Participant.status)\
+            .all()
+        return dict(counts)
+
     def save(self, *objects):
         """Add all the objects to the session and commit them.
 
@@ -0,0 +1,368 @@
+"""A local stand-in for the Mechanical Turk API, for testing at scale.
+
+FakeMTurk keeps HITs and assignments in memory and implements the MTurk
+calls Dallinger makes, with optional latency and injected errors. Each
+assignment it makes available is worked on by a simulated worker, which
+signs up with the experiment server and sends the notifications MTurk would
+send to /notifications. create_app() serves a FakeMTurk over HTTP, so that
+the web, worker and clock processes can share it: they use
+FakeMTurkConnection in place of boto's MTurkConnection when the
+FAKE_MTURK_URL environment variable is set.
+"""
+
+from collections import Counter
+import json
+import random
+import threading
+import time
+import uuid
+
+from boto.mturk.connection import MTurkRequestError
+import requests
+
+from dallinger import loadtest
+
+# The operations of the fake, which are named after boto's methods.
+OPERATIONS = [
+    "approve_assignment",
+    "create_hit",
+    "expire_hit",
+    "extend_hit",
+    "get_assignment",
+    "grant_bonus",
+]
+
+
+class IdleBot(loadtest.Bot):
+    """A simulated participant that signs up and does nothing else."""
+
+    def participate(self):
+        """Do nothing."""
+        pass
+
+
+class FakeMTurk(object):
+    """Mechanical Turk, in memory.
+
+    Every call waits latency seconds, and fails with a throttling error with
+    probability error_rate. If base_url is given, each assignment made
+    available is taken by a simulated worker running bot_class against the
+    experiment server there. The worker takes work_time seconds and returns
+    the assignment with probability return_rate.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, base_url=None,
+                 bot_class=IdleBot, work_time=0.0, return_rate=0.0,
+                 seed=None):
+        """Create an empty MTurk."""
+        self.latency = latency
+        self.error_rate = error_rate
+        self.base_url = base_url
+        self.bot_class = bot_class
+        self.work_time = work_time
+        self.return_rate = return_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.hits = {}
+        self.assignments = {}
+        self.bonuses = []
+        self.calls = Counter()
+        self.errors = Counter()
+        self.stats = loadtest.Stats()
+        self.threads = []
+
+    def call(self, operation, **kwargs):
+        """Make a call as MTurk would, with the configured latency and errors.
+
+        Injected errors are raised as boto raises MTurk's throttling errors.
+        """
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown operation {}".format(operation))
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[operation] += 1
+            if self.random.random() < self.error_rate:
+                self.errors[operation] += 1
+                raise MTurkRequestError(503, "ServiceUnavailable")
+        return getattr(self, operation)(**kwargs)
+
+    def create_hit(self, max_assignments=1, lifetime=3600):
+        """Create a HIT with max_assignments assignments, returning its id."""
+        hit_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.hits[hit_id] = {
+                "expiration": time.time() + lifetime,
+                "assignments": 0,
+            }
+        self.open_assignments(hit_id, max_assignments)
+        return hit_id
+
+    def extend_hit(self, hit_id, assignments_increment=None,
+                   expiration_increment=None):
+        """Add assignments to a HIT or extend its lifetime."""
+        hit = self.get_hit(hit_id)
+        if expiration_increment:
+            with self.lock:
+                hit["expiration"] += expiration_increment
+        if assignments_increment:
+            self.open_assignments(hit_id, assignments_increment)
+
+    def expire_hit(self, hit_id):
+        """Stop a HIT from offering any more assignments."""
+        hit = self.get_hit(hit_id)
+        with self.lock:
+            hit["expiration"] = time.time()
+
+    def get_assignment(self, assignment_id):
+        """Describe an assignment."""
+        assignment = self.get(assignment_id)
+        with self.lock:
+            return {
+                "AssignmentId": assignment_id,
+                "AssignmentStatus": assignment["status"],
+                "HITId": assignment["hit_id"],
+                "WorkerId": assignment["worker_id"],
+            }
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        """Approve a submitted assignment."""
+        assignment = self.get(assignment_id)
+        with self.lock:
+            if assignment["status"] != "Submitted":
+                raise MTurkRequestError(
+                    400, "AWS.MechanicalTurk.InvalidAssignmentState")
+            assignment["status"] = "Approved"
+            assignment["approved"] = time.time()
+
+    def grant_bonus(self, worker_id, assignment_id, bonus_price, reason):
+        """Pay a bonus for an approved assignment."""
+        assignment = self.get(assignment_id)
+        with self.lock:
+            if assignment["status"] != "Approved" or \
+                    assignment["worker_id"] != worker_id:
+                raise MTurkRequestError(
+                    400, "AWS.MechanicalTurk.InvalidAssignmentState")
+            self.bonuses.append((assignment_id, float(bonus_price), reason))
+
+    def get_hit(self, hit_id):
+        """Return the state of a HIT, as MTurk would fail if it is unknown."""
+        with self.lock:
+            if hit_id not in self.hits:
+                raise MTurkRequestError(
+                    400, "AWS.MechanicalTurk.HITDoesNotExist")
+            return self.hits[hit_id]
+
+    def get(self, assignment_id):
+        """Return the state of an assignment, failing if it is unknown."""
+        with self.lock:
+            if assignment_id not in self.assignments:
+                raise MTurkRequestError(
+                    400, "AWS.MechanicalTurk.AssignmentDoesNotExist")
+            return self.assignments[assignment_id]
+
+    def open_assignments(self, hit_id, n):
+        """Make n assignments available and start their workers."""
+        for _ in range(int(n)):
+            assignment_id = uuid.uuid4().hex[:12]
+            with self.lock:
+                self.hits[hit_id]["assignments"] += 1
+                self.assignments[assignment_id] = {
+                    "hit_id": hit_id,
+                    "worker_id": uuid.uuid4().hex[:12],
+                    "status": "Available",
+                    "opened": time.time(),
+                }
+            if self.base_url is not None:
+                thread = threading.Thread(target=self.work,
+                                          args=(assignment_id, ))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self, assignment_id):
+        """Take an assignment as a worker and submit or return it."""
+        assignment = self.get(assignment_id)
+        with self.lock:
+            if time.time() >= self.hits[assignment["hit_id"]]["expiration"]:
+                assignment["status"] = "Expired"
+                return
+            assignment["status"] = "Accepted"
+            assignment["accepted"] = time.time()
+
+        bot = self.bot_class(self.base_url, self.stats)
+        bot.worker_id = assignment["worker_id"]
+        bot.hit_id = assignment["hit_id"]
+        bot.assignment_id = assignment_id
+        try:
+            bot.create_participant()
+            self.notify(bot, "AssignmentAccepted")
+            bot.participate()
+            if self.work_time:
+                time.sleep(self.random.uniform(0, 2 * self.work_time))
+            returned = self.random.random() < self.return_rate
+            if not returned:
+                bot.submit_questionnaire()
+        except loadtest.BotError:
+            self.stats.bot_done(False)
+            returned = True
+        else:
+            self.stats.bot_done(True)
+
+        with self.lock:
+            assignment["status"] = "Returned" if returned else "Submitted"
+            assignment["finished"] = time.time()
+        if returned:
+            self.notify(bot, "AssignmentReturned")
+        else:
+            self.notify(bot, "AssignmentSubmitted")
+
+    def notify(self, bot, event_type):
+        """Send the notification MTurk would send for a bot's assignment."""
+        bot.notify(event_type)
+
+    def wait(self, timeout=None):
+        """Wait for the workers started so far to finish."""
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in list(self.threads):
+            thread.join(None if deadline is None
+                        else max(deadline - time.time(), 0))
+
+    def report(self):
+        """Return counts, rates and delays as a dictionary suitable for JSON.
+
+        approval_delay is the time between a worker submitting and MTurk
+        receiving the approval; if it keeps growing, the pipeline has fallen
+        behind.
+        """
+        with self.lock:
+            assignments = list(self.assignments.values())
+            elapsed = time.time() - self.stats.start
+            delays = [a["approved"] - a["finished"] for a in assignments
+                      if "approved" in a]
+            statuses = Counter(a["status"] for a in assignments)
+            report = {
+                "assignments": dict(statuses),
+                "bonuses": len(self.bonuses),
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "elapsed_s": elapsed,
+                "submitted_per_minute": 60.0 * len(
+                    [a for a in assignments if "finished" in a]) / elapsed,
+                "approved_per_minute": 60.0 * len(delays) / elapsed,
+                "approval_delay": loadtest.Stats.summarize(delays, 0),
+            }
+        report["workers"] = self.stats.report()
+        return report
+
+
+def create_app(fake):
+    """Create a Flask app that serves fake's operations over HTTP.
+
+    Each operation is a POST to /<operation> with its keyword arguments as
+    JSON. Errors are returned with their status and reason.
+    """
+    from flask import Flask, Response, request
+
+    app = Flask(__name__)
+
+    @app.route("/<operation>", methods=["POST"])
+    def operate(operation):
+        if operation not in OPERATIONS:
+            return Response(status=404)
+        kwargs = json.loads(request.data or "{}")
+        try:
+            result = fake.call(operation, **kwargs)
+        except MTurkRequestError as e:
+            return Response(
+                json.dumps({"status": e.status, "reason": e.reason}),
+                status=e.status, mimetype="application/json")
+        return Response(json.dumps({"result": result}),
+                        mimetype="application/json")
+
+    return app
+
+
+class FakeAssignment(object):
+    """An assignment, with the attributes of boto's Assignment."""
+
+    def __init__(self, **attributes):
+        """Set the attributes."""
+        self.__dict__.update(attributes)
+
+
+class FakeMTurkConnection(object):
+    """Call a fake MTurk service with the methods of boto's MTurkConnection."""
+
+    def __init__(self, url, timeout=60):
+        """Connect to the service at url."""
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def _call(self, operation, **kwargs):
+        response = self.http.post(
+            "{}/{}".format(self.url, operation), data=json.dumps(kwargs),
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout)
+        body = response.json()
+        if response.status_code != 200:
+            raise MTurkRequestError(body["status"], body["reason"])
+        return body["result"]
+
+    def create_hit(self, max_assignments=1, lifetime=3600):
+        """Create a HIT, returning its id."""
+        return self._call("create_hit", max_assignments=max_assignments,
+                          lifetime=lifetime)
+
+    def extend_hit(self, hit_id, assignments_increment=None,
+                   expiration_increment=None):
+        """Add assignments to a HIT or extend its lifetime."""
+        return self._call("extend_hit", hit_id=hit_id,
+                          assignments_increment=assignments_increment,
+                          expiration_increment=expiration_increment)
+
+    def expire_hit(self, hit_id):
+        """Expire a HIT."""
+        return self._call("expire_hit", hit_id=hit_id)
+
+    def get_assignment(self, assignment_id):
+        """Return a list holding the assignment, as boto does."""
+        return [FakeAssignment(
+            **self._call("get_assignment", assignment_id=assignment_id))]
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        """Approve an assignment."""
+        return self._call("approve_assignment", assignment_id=assignment_id,
+                          feedback=feedback)
+
+    def grant_bonus(self, worker_id, assignment_id, bonus_price, reason):
+        """Pay a bonus."""
+        return self._call("grant_bonus", worker_id=worker_id,
+                          assignment_id=assignment_id,
+                          bonus_price=float(bonus_price), reason=reason)
+
+
+class FakeMTurkServices(object):
+    """Stand in for psiTurk's MTurkServices, which returns False on errors."""
+
+    def __init__(self, mtc):
+        """Use mtc, a FakeMTurkConnection."""
+        self.mtc = mtc
+
+    def approve_worker(self, assignment_id):
+        """Approve an assignment."""
+        try:
+            self.mtc.approve_assignment(assignment_id, feedback=None)
+            return True
+        except MTurkRequestError:
+            return False
+
+    def bonus_worker(self, assignment_id, amount, reason):
+        """Pay the worker of an assignment a bonus."""
+        try:
+            worker_id = self.mtc.get_assignment(assignment_id)[0].WorkerId
+            self.mtc.grant_bonus(worker_id, assignment_id, amount, reason)
+            return True
+        except MTurkRequestError:
+            return False
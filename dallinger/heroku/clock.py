@@ -1,18 +1,22 @@
 """A clock process."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
+from functools import partial
 import json
+from multiprocessing.pool import ThreadPool
 import os
 
 from apscheduler.schedulers.blocking import BlockingScheduler
-from boto.mturk.connection import MTurkConnection
 from psiturk.psiturk_config import PsiturkConfig
 import requests
+from rq import Queue
 
 import dallinger
 from dallinger import db
+from dallinger import jobs
 from dallinger.models import Participant
+from dallinger.recruiters import PsiTurkRecruiter, due_payouts
 
 config = PsiturkConfig()
 config.load_config()
@@ -24,83 +28,127 @@ session = db.session
 
 scheduler = BlockingScheduler()
 
+#: Seconds past the HIT duration after which a notification is missing.
+GRACE_PERIOD = 120
 
-@scheduler.scheduled_job('interval', minutes=0.5)
+#: The number of MTurk assignment lookups made at once.
+LOOKUP_THREADS = 10
+
+
+def overdue_participants(duration, now):
+    """Working participants who started more than duration seconds ago.
+
+    Participants are given GRACE_PERIOD seconds more before they count as
+    overdue. The index on (status, creation_time) serves the query, so only
+    the overdue participants are read however many are working.
+    """
+    cutoff = now - timedelta(seconds=duration + GRACE_PERIOD)
+    return Participant.query\
+        .filter(Participant.status == "working",
+                Participant.creation_time < cutoff)\
+        .order_by(Participant.creation_time)\
+        .all()
+
+
+def assignment_status(conn, assignment_id):
+    """Ask MTurk for the status of an assignment, or None if that fails."""
+    try:
+        return conn.get_assignment(assignment_id)[0].AssignmentStatus
+    except Exception:
+        return None
+
+
+def assignment_statuses(conn, assignment_ids, threads=LOOKUP_THREADS):
+    """Ask MTurk for the status of each assignment, several at a time.
+
+    Returns the statuses in the order of assignment_ids. At most threads
+    lookups are made at once.
+    """
+    if not assignment_ids:
+        return []
+    pool = ThreadPool(min(threads, len(assignment_ids)))
+    try:
+        return pool.map(partial(assignment_status, conn), assignment_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@scheduler.scheduled_job('interval', minutes=1, max_instances=1,
+                         coalesce=True)
+def sweep_payouts():
+    """Queue a payout job if payouts that are due are still pending.
+
+    Payouts are made by jobs queued when they are recorded or retried, so
+    this only finds those whose job was lost, such as to a worker restart.
+    """
+    due = due_payouts().first() is not None
+    session.remove()
+    if due:
+        Queue("high", connection=jobs.redis_connection())\
+            .enqueue("custom.schedule_payouts")
+    return due
+
+
+# A slow tick is skipped rather than run alongside the next one.
+@scheduler.scheduled_job('interval', minutes=0.5, max_instances=1,
+                         coalesce=True)
 def check_db_for_missing_notifications():
     """Check the database for missing notifications."""
-    aws_access_key_id = os.environ['aws_access_key_id']
-    aws_secret_access_key = os.environ['aws_secret_access_key']
-    if config.getboolean('Shell Parameters', 'launch_in_sandbox_mode'):
-        conn = MTurkConnection(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            host='mechanicalturk.sandbox.amazonaws.com')
-    else:
-        conn = MTurkConnection(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key)
-
-    # get all participants with status < 100
-    participants = Participant.query.filter_by(status="working").all()
-
-    # get current time
-    current_time = datetime.now()
+    conn = PsiTurkRecruiter().mturk_connection()
 
     # get experiment duration in seconds
     duration = float(config.get('HIT Configuration', 'duration')) * 60 * 60
 
-    # for each participant, if current_time - start_time > duration + 5 mins
-    for p in participants:
+    # get the participants who have been working for too long
+    current_time = datetime.now()
+    participants = overdue_participants(duration, current_time)
+
+    # ask amazon for the status of their assignments
+    statuses = assignment_statuses(
+        conn, [p.assignment_id for p in participants])
+
+    for p, status in zip(participants, statuses):
         p_time = (current_time - p.creation_time).total_seconds()
+        print ("Error: participant {} with status {} has been playing for too "
+               "long and no notification has arrived - "
+               "running emergency code".format(p.id, p.status))
+
+        assignment_id = p.assignment_id
+        print "assignment status from AWS is {}".format(status)
+        hit_id = p.hit_id
+
+        # general email settings:
+        # username = os.getenv('dallinger_email_username')
+        # fromaddr = username + "@gmail.com"
+        # email_password = os.getenv("dallinger_email_key")
+        # toaddr = config.get('HIT Configuration', 'contact_email_on_error')
+        whimsical = os.getenv("whimsical")
+
+        if status == "Approved":
+            # if its been approved, set the status accordingly
+            print "status set to approved"
+            p.status = "approved"
+            session.commit()
+        elif status == "Rejected":
+            print "status set to rejected"
+            # if its been rejected, set the status accordingly
+            p.status = "rejected"
+            session.commit()
+        elif status == "Submitted":
+            # if it has been submitted then resend a submitted notification
+            args = {
+                'Event.1.EventType': 'AssignmentSubmitted',
+                'Event.1.AssignmentId': assignment_id
+            }
+            requests.post(
+                "http://" + os.environ['HOST'] + '/notifications',
+                data=args)
 
-        if p_time > (duration + 120):
-            print ("Error: participant {} with status {} has been playing for too "
-                   "long and no notification has arrived - "
-                   "running emergency code".format(p.id, p.status))
-
-            # get their assignment
-            assignment_id = p.assignment_id
-
-            # ask amazon for the status of the assignment
-            try:
-                assignment = conn.get_assignment(assignment_id)[0]
-                status = assignment.AssignmentStatus
-            except:
-                status = None
-            print "assignment status from AWS is {}".format(status)
-            hit_id = p.hit_id
-
-            # general email settings:
-            # username = os.getenv('dallinger_email_username')
-            # fromaddr = username + "@gmail.com"
-            # email_password = os.getenv("dallinger_email_key")
-            # toaddr = config.get('HIT Configuration', 'contact_email_on_error')
-            whimsical = os.getenv("whimsical")
-
-            if status == "Approved":
-                # if its been approved, set the status accordingly
-                print "status set to approved"
-                p.status = "approved"
-                session.commit()
-            elif status == "Rejected":
-                print "status set to rejected"
-                # if its been rejected, set the status accordingly
-                p.status = "rejected"
-                session.commit()
-            elif status == "Submitted":
-                # if it has been submitted then resend a submitted notification
-                args = {
-                    'Event.1.EventType': 'AssignmentSubmitted',
-                    'Event.1.AssignmentId': assignment_id
-                }
-                requests.post(
-                    "http://" + os.environ['HOST'] + '/notifications',
-                    data=args)
-
-                # send the researcher an email to let them know
-                if whimsical:
-                    msg = MIMEText(
-                        """Dearest Friend,\n\nI am writing to let you know that at
+            # send the researcher an email to let them know
+            if whimsical:
+                msg = MIMEText(
+                    """Dearest Friend,\n\nI am writing to let you know that at
  {}, during my regular (and thoroughly enjoyable) perousal of the most charming
   participant data table, I happened to notice that assignment {} has been
  taking longer than we were expecting. I recall you had suggested {} minutes as
@@ -115,15 +163,15 @@ def check_db_for_missing_notifications():
  at your earliest convenience.\n\nI remain your faithful and obedient servant,
 \nWilliam H. Dallinger\n\n P.S. Please do not respond to this message, I am busy
  with other matters.""".format(
-                            datetime.now(),
-                            assignment_id,
-                            round(duration/60),
-                            round(p_time/60),
-                            round((p_time-duration)/60)))
-                    msg['Subject'] = "A matter of minor concern."
-                else:
-                    msg = MIMEText(
-                        """Dear experimenter,\n\nThis is an automated email from
+                        datetime.now(),
+                        assignment_id,
+                        round(duration/60),
+                        round(p_time/60),
+                        round((p_time-duration)/60)))
+                msg['Subject'] = "A matter of minor concern."
+            else:
+                msg = MIMEText(
+                    """Dear experimenter,\n\nThis is an automated email from
  Dallinger. You are receiving this email because the Dallinger platform has
  discovered evidence that a notification from Amazon Web Services failed to
  arrive at the server. Dallinger has automatically contacted AWS and has
@@ -132,46 +180,46 @@ def check_db_for_missing_notifications():
  Dallinger has auto-corrected the problem. Nonetheless you may wish to check the
  database.\n\nBest,\nThe Dallinger dev. team.\n\n Error details:\nAssignment: {}
 \nAllowed time: {}\nTime since participant started: {}""").format(
-                            assignment_id,
-                            round(duration/60),
-                            round(p_time/60))
-                    msg['Subject'] = "Dallinger automated email - minor error."
-
-                # This method commented out as gmail now blocks emails from
-                # new locations
-                # server = smtplib.SMTP('smtp.gmail.com:587')
-                # server.starttls()
-                # server.login(username, email_password)
-                # server.sendmail(fromaddr, toaddr, msg.as_string())
-                # server.quit()
-                print ("Error - submitted notification for participant {} missed. "
-                       "Database automatically corrected, but proceed with caution."
-                       .format(p.id))
-            else:
-                # if it has not been submitted shut everything down
-                # first turn off autorecruit
-                host = os.environ['HOST']
-                host = host[:-len(".herokuapp.com")]
-                args = json.dumps({"auto_recruit": "false"})
-                headers = {
-                    "Accept": "application/vnd.heroku+json; version=3",
-                    "Content-Type": "application/json"
-                }
-                heroku_email_address = os.getenv('heroku_email_address')
-                heroku_password = os.getenv('heroku_password')
-                requests.patch(
-                    "https://api.heroku.com/apps/{}/config-vars".format(host),
-                    data=args,
-                    auth=(heroku_email_address, heroku_password),
-                    headers=headers)
-
-                # then force expire the hit via boto
-                conn.expire_hit(hit_id)
-
-                # send the researcher an email to let them know
-                if whimsical:
-                    msg = MIMEText(
-                        """Dearest Friend,\n\nI am afraid I write to you with most
+                        assignment_id,
+                        round(duration/60),
+                        round(p_time/60))
+                msg['Subject'] = "Dallinger automated email - minor error."
+
+            # This method commented out as gmail now blocks emails from
+            # new locations
+            # server = smtplib.SMTP('smtp.gmail.com:587')
+            # server.starttls()
+            # server.login(username, email_password)
+            # server.sendmail(fromaddr, toaddr, msg.as_string())
+            # server.quit()
+            print ("Error - submitted notification for participant {} missed. "
+                   "Database automatically corrected, but proceed with caution."
+                   .format(p.id))
+        else:
+            # if it has not been submitted shut everything down
+            # first turn off autorecruit
+            host = os.environ['HOST']
+            host = host[:-len(".herokuapp.com")]
+            args = json.dumps({"auto_recruit": "false"})
+            headers = {
+                "Accept": "application/vnd.heroku+json; version=3",
+                "Content-Type": "application/json"
+            }
+            heroku_email_address = os.getenv('heroku_email_address')
+            heroku_password = os.getenv('heroku_password')
+            requests.patch(
+                "https://api.heroku.com/apps/{}/config-vars".format(host),
+                data=args,
+                auth=(heroku_email_address, heroku_password),
+                headers=headers)
+
+            # then force expire the hit via boto
+            conn.expire_hit(hit_id)
+
+            # send the researcher an email to let them know
+            if whimsical:
+                msg = MIMEText(
+                    """Dearest Friend,\n\nI am afraid I write to you with most
  grave tidings. At {}, during a routine check of the usually most delightful
  participant data table, I happened to notice that assignment {} has been
  taking longer than we were expecting. I recall you had suggested {} minutes as
@@ -193,15 +241,15 @@ def check_db_for_missing_notifications():
  and intelligence for which I know you so well.\n\nI remain your faithful and
  obedient servant,\nWilliam H. Dallinger\n\nP.S. Please do not respond to this
  message, I am busy with other matters.""".format(
-                            datetime.now(),
-                            assignment_id,
-                            round(duration/60),
-                            round(p_time/60),
-                            round((p_time-duration)/60)))
-                    msg['Subject'] = "Most troubling news."
-                else:
-                    msg = MIMEText(
-                        """Dear experimenter,\n\nThis is an automated email from
+                        datetime.now(),
+                        assignment_id,
+                        round(duration/60),
+                        round(p_time/60),
+                        round((p_time-duration)/60)))
+                msg['Subject'] = "Most troubling news."
+            else:
+                msg = MIMEText(
+                    """Dear experimenter,\n\nThis is an automated email from
  Dallinger. You are receiving this email because the Dallinger platform has
  discovered evidence that a notification from Amazon Web Services failed to
  arrive at the server. Dallinger has automatically contacted AWS and has
@@ -216,32 +264,34 @@ def check_db_for_missing_notifications():
  emails this suggests something is wrong with your experiment code.\n\nBest,
 \nThe Dallinger dev. team.\n\n Error details:\nAssignment: {}
 \nAllowed time: {}\nTime since participant started: {}""").format(
-                            assignment_id,
-                            round(duration/60),
-                            round(p_time/60))
-                    msg['Subject'] = "Dallinger automated email - major error."
-
-                # This method commented out as gmail now blocks emails from
-                # new locations
-                # server = smtplib.SMTP('smtp.gmail.com:587')
-                # server.starttls()
-                # server.login(username, email_password)
-                # server.sendmail(fromaddr, toaddr, msg.as_string())
-                # server.quit()
-
-                # send a notificationmissing notification
-                args = {
-                    'Event.1.EventType': 'NotificationMissing',
-                    'Event.1.AssignmentId': assignment_id
-                }
-                requests.post(
-                    "http://" + os.environ['HOST'] + '/notifications',
-                    data=args)
-
-                print ("Error - abandoned/returned notification for participant {} missed. "
-                       "Experiment shut down. Please check database and then manually "
-                       "resume experiment."
-                       .format(p.id))
-
-
-scheduler.start()
+                        assignment_id,
+                        round(duration/60),
+                        round(p_time/60))
+                msg['Subject'] = "Dallinger automated email - major error."
+
+            # This method commented out as gmail now blocks emails from
+            # new locations
+            # server = smtplib.SMTP('smtp.gmail.com:587')
+            # server.starttls()
+            # server.login(username, email_password)
+            # server.sendmail(fromaddr, toaddr, msg.as_string())
+            # server.quit()
+
+            # send a notificationmissing notification
+            args = {
+                'Event.1.EventType': 'NotificationMissing',
+                'Event.1.AssignmentId': assignment_id
+            }
+            requests.post(
+                "http://" + os.environ['HOST'] + '/notifications',
+                data=args)
+
+            print ("Error - abandoned/returned notification for participant {} missed. "
+                   "Experiment shut down. Please check database and then manually "
+                   "resume experiment."
+                   .format(p.id))
+
+
+if __name__ == '__main__':
+    jobs.schedule_jobs(scheduler, experiment)
+    scheduler.start()
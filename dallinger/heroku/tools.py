@@ -1,6 +1,5 @@
 """Miscellaneous tools for Heroku."""
 
-import pexpect
 import subprocess
 
 import dallinger as dlgr
@@ -13,6 +12,7 @@ def app_name(id):
 
 def log_in():
     """Ensure that the user is logged in to Heroku."""
+    import pexpect
     p = pexpect.spawn("heroku auth:whoami")
     p.interact()
 
@@ -1,6 +1,7 @@
 """Heroku web worker."""
 
 from future.builtins import map
+from multiprocessing import Process
 import os
 
 import redis
@@ -16,7 +17,37 @@ redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
-    with Connection(conn):
+
+def worker_processes():
+    """The number of worker processes to run in this dyno.
+
+    Set by worker_processes under [Server Parameters] in config.txt, and 1
+    if it is not set.
+    """
+    from psiturk.psiturk_config import PsiturkConfig
+    config = PsiturkConfig()
+    config.load_config()
+    if config.has_option('Server Parameters', 'worker_processes'):
+        return config.getint('Server Parameters', 'worker_processes')
+    return 1
+
+
+def work():
+    """Process jobs from the queues, highest priority first."""
+    with Connection(redis.from_url(redis_url)):
         worker = Worker(list(map(Queue, listen)))
         worker.work()
+
+
+if __name__ == '__main__':
+    n = worker_processes()
+    if n <= 1:
+        work()
+    else:
+        # Each process opens its own Redis connection. Heroku sends SIGTERM
+        # to every process in the dyno, so each worker shuts down cleanly.
+        processes = [Process(target=work) for _ in range(n)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
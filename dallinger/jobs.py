@@ -0,0 +1,239 @@
+"""Background jobs that experiments run periodically in the clock process.
+
+An experiment declares its jobs in
+:attr:`~dallinger.experiments.Experiment.periodic_jobs`, naming methods of
+the experiment and how often to run them. The clock runs each job at its
+interval in a session of its own. A debounced job, one also named in
+:attr:`~dallinger.experiments.Experiment.debounced_jobs`, runs only if it
+has been requested with :func:`request_job` since it last ran, so requests
+that arrive together are handled by a single run.
+
+A Redis lock ensures that a job never runs twice at once, even if a second
+clock process is running. Each job's runs, failures, skips and durations
+are kept in Redis, and :func:`job_metrics` reads them.
+
+rq has no delayed jobs, so :func:`enqueue_in` keeps them in Redis until the
+clock moves them to their queue, and workers never sleep waiting for them.
+"""
+
+import logging
+import time
+import uuid
+
+from dallinger import db
+
+logger = logging.getLogger('dallinger.jobs')
+
+#: Set while a job is running; the value identifies the run.
+JOB_LOCK = "dallinger:jobs:{}:lock"
+
+#: Set when a debounced job has been requested since it last ran.
+JOB_REQUESTED = "dallinger:jobs:{}:requested"
+
+#: A hash of counters and durations for each job.
+JOB_METRICS = "dallinger:jobs:{}:metrics"
+
+#: Set by the clock process, and expires unless it keeps setting it.
+CLOCK_RUNNING = "dallinger:clock:running"
+
+#: Seconds between the clock process setting CLOCK_RUNNING.
+CLOCK_HEARTBEAT = 10
+
+#: A sorted set of the ids of rq jobs waiting to be queued, scored by the
+#: time at which they are due.
+DELAYED_JOBS = "dallinger:jobs:delayed"
+
+#: Seconds between the clock process queueing the delayed jobs that are due.
+DELAYED_JOBS_INTERVAL = 1
+
+
+def redis_connection():
+    """The Redis connection shared with the worker."""
+    from dallinger.heroku.worker import conn
+    return conn
+
+
+def request_job(name, conn=None):
+    """Ask for the debounced job name to run at its next interval."""
+    conn = conn or redis_connection()
+    conn.set(JOB_REQUESTED.format(name), 1)
+
+
+def enqueue_in(queue, seconds, func, *args, **kwargs):
+    """Queue func(*args, **kwargs) on queue in seconds and return the job.
+
+    The job is saved and added to DELAYED_JOBS in one round trip, and the
+    clock queues it once it is due. If no clock is running it is queued at
+    once, since nothing would queue it later.
+    """
+    conn = queue.connection
+    if not clock_running(conn):
+        return queue.enqueue(func, *args, **kwargs)
+    job = queue.job_class.create(func, args=args, kwargs=kwargs,
+                                 connection=conn)
+    job.origin = queue.name
+    pipe = conn.pipeline()
+    job.save(pipeline=pipe)
+    pipe.zadd(DELAYED_JOBS, **{job.id: time.time() + seconds})
+    pipe.execute()
+    return job
+
+
+def enqueue_due_jobs(conn=None):
+    """Queue the delayed jobs that are due and return how many there were.
+
+    Each job is claimed by removing it from DELAYED_JOBS, so a job is queued
+    once even if two clock processes are running.
+    """
+    from rq import Queue
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+    conn = conn or redis_connection()
+    queued = 0
+    for job_id in conn.zrangebyscore(DELAYED_JOBS, 0, time.time()):
+        if not conn.zrem(DELAYED_JOBS, job_id):
+            continue
+        try:
+            job = Job.fetch(job_id, connection=conn)
+        except NoSuchJobError:
+            logger.warning("Delayed job %s no longer exists", job_id)
+            continue
+        Queue(job.origin, connection=conn).enqueue_job(job)
+        queued += 1
+    return queued
+
+
+def clock_running(conn=None):
+    """Whether a clock process has been running jobs in the last minute.
+
+    None runs when clock_on is false or when debugging an experiment.
+    """
+    conn = conn or redis_connection()
+    return bool(conn.exists(CLOCK_RUNNING))
+
+
+def heartbeat(conn=None):
+    """Record that the clock process is running."""
+    conn = conn or redis_connection()
+    conn.set(CLOCK_RUNNING, 1, ex=CLOCK_HEARTBEAT * 6)
+
+
+def run_job(experiment_class, name, debounced=False, lock_timeout=None,
+            conn=None):
+    """Run the job name of a new instance of experiment_class.
+
+    The job is skipped if it is already running or, when debounced, if it has
+    not been requested. It runs in its own session, which is committed if it
+    succeeds. Failures are logged and counted rather than raised, so that a
+    failing job does not stop the clock. Returns the outcome: "ran",
+    "failed" or "skipped".
+    """
+    conn = conn or redis_connection()
+    metrics = JOB_METRICS.format(name)
+    if debounced and not conn.delete(JOB_REQUESTED.format(name)):
+        return "skipped"
+
+    lock = JOB_LOCK.format(name)
+    token = uuid.uuid4().hex
+    if not conn.set(lock, token, nx=True, ex=lock_timeout):
+        logger.warning("Job %s is still running; skipping this run", name)
+        conn.hincrby(metrics, "skipped", 1)
+        if debounced:
+            # Keep the request for the next interval.
+            request_job(name, conn)
+        return "skipped"
+
+    start = time.time()
+    outcome = "ran"
+    try:
+        with db.sessions_scope(db.session, commit=True) as session:
+            getattr(experiment_class(session), name)()
+    except Exception:
+        logger.exception("Job %s failed", name)
+        outcome = "failed"
+        if debounced:
+            # The request was taken before the run; keep it for a retry.
+            request_job(name, conn)
+    finally:
+        duration = time.time() - start
+        if conn.get(lock) == token:
+            conn.delete(lock)
+
+    pipe = conn.pipeline()
+    pipe.hincrby(metrics, "runs", 1)
+    if outcome == "failed":
+        pipe.hincrby(metrics, "failures", 1)
+    pipe.hincrbyfloat(metrics, "total_duration", duration)
+    pipe.hset(metrics, "last_duration", duration)
+    pipe.hset(metrics, "last_run", start)
+    pipe.execute()
+    logger.info("Job %s %s in %.3fs", name, outcome, duration)
+    return outcome
+
+
+def schedule_jobs(scheduler, experiment_class, conn=None):
+    """Add the experiment's periodic jobs to an APScheduler scheduler.
+
+    A run that is due while the previous one is still going is skipped, and
+    missed runs are coalesced into one. A job's Redis lock expires after
+    ten of its intervals, in case its clock process dies while holding it.
+    A heartbeat job lets :func:`clock_running` tell that the clock runs,
+    and another queues the delayed jobs that are due.
+    """
+    heartbeat(conn)
+    scheduler.add_job(heartbeat, 'interval', seconds=CLOCK_HEARTBEAT,
+                      id="heartbeat", kwargs={"conn": conn},
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(enqueue_due_jobs, 'interval',
+                      seconds=DELAYED_JOBS_INTERVAL, id="delayed_jobs",
+                      kwargs={"conn": conn}, max_instances=1, coalesce=True)
+    exp = experiment_class(db.session)
+    for name, interval in sorted(exp.periodic_jobs.items()):
+        if not callable(getattr(exp, name, None)):
+            raise ValueError(
+                "{} is not a method of the experiment".format(name))
+        scheduler.add_job(
+            run_job, 'interval', seconds=interval, id=name,
+            args=(experiment_class, name),
+            kwargs={
+                "debounced": name in exp.debounced_jobs,
+                "lock_timeout": max(int(interval * 10), 60),
+                "conn": conn,
+            },
+            max_instances=1, coalesce=True)
+    db.session.remove()
+    return sorted(exp.periodic_jobs)
+
+
+def job_metrics(names, conn=None):
+    """Return the metrics of each job in names, read in one round trip.
+
+    Each job has its number of runs, failures and skipped runs, its mean and
+    last durations in seconds and the time of its last run, and whether it
+    is running or has been requested.
+    """
+    conn = conn or redis_connection()
+    pipe = conn.pipeline(transaction=False)
+    for name in names:
+        pipe.hgetall(JOB_METRICS.format(name))
+        pipe.exists(JOB_LOCK.format(name))
+        pipe.exists(JOB_REQUESTED.format(name))
+    results = pipe.execute()
+    metrics = {}
+    for i, name in enumerate(names):
+        values, running, requested = results[3 * i:3 * i + 3]
+        runs = int(values.get("runs", 0))
+        total = float(values.get("total_duration", 0))
+        metrics[name] = {
+            "runs": runs,
+            "failures": int(values.get("failures", 0)),
+            "skipped": int(values.get("skipped", 0)),
+            "mean_duration": total / runs if runs else None,
+            "last_duration": float(values["last_duration"])
+            if "last_duration" in values else None,
+            "last_run": float(values["last_run"])
+            if "last_run" in values else None,
+            "running": bool(running),
+            "requested": bool(requested),
+        }
+    return metrics
@@ -0,0 +1,420 @@
+"""Drive a locally running experiment server with simulated participants."""
+
+from collections import defaultdict
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+from dallinger import db
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values using the nearest-rank method."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class Stats(object):
+    """Thread-safe record of the requests made by a swarm of bots."""
+
+    def __init__(self):
+        """Start an empty record."""
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bots_finished = 0
+        self.bots_failed = 0
+        self.start = time.time()
+        self.end = None
+
+    def record(self, route, latency, ok):
+        """Record a single request."""
+        with self.lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    def bot_done(self, ok):
+        """Record the end of a bot's run."""
+        with self.lock:
+            if ok:
+                self.bots_finished += 1
+            else:
+                self.bots_failed += 1
+
+    def stop(self):
+        """Stop the clock."""
+        self.end = time.time()
+
+    @staticmethod
+    def summarize(latencies, errors):
+        """Summarize a list of latencies (in seconds) as milliseconds."""
+        ms = [l * 1000.0 for l in latencies]
+        return {
+            "requests": len(ms),
+            "errors": errors,
+            "error_rate": float(errors) / len(ms) if ms else 0.0,
+            "mean_ms": sum(ms) / len(ms) if ms else None,
+            "p50_ms": percentile(ms, 50),
+            "p90_ms": percentile(ms, 90),
+            "p99_ms": percentile(ms, 99),
+            "max_ms": max(ms) if ms else None,
+        }
+
+    def report(self):
+        """Return the results as a dictionary suitable for JSON."""
+        with self.lock:
+            elapsed = (self.end or time.time()) - self.start
+            everything = [l for ls in self.latencies.values() for l in ls]
+            overall = self.summarize(everything, sum(self.errors.values()))
+            overall["elapsed_s"] = elapsed
+            overall["throughput_rps"] = (
+                len(everything) / elapsed if elapsed else None)
+            overall["bots_finished"] = self.bots_finished
+            overall["bots_failed"] = self.bots_failed
+            routes = dict(
+                (route, self.summarize(ls, self.errors[route]))
+                for route, ls in self.latencies.items())
+        return {"overall": overall, "routes": routes}
+
+
+class PoolMonitor(threading.Thread):
+    """Sample the checked out connections of the database pool.
+
+    This only sees the pool of the current process, so the experiment server
+    must run in process (see serve()).
+    """
+
+    def __init__(self, pool=None, interval=0.05):
+        """Create a monitor for pool, which defaults to the engine's pool."""
+        super(PoolMonitor, self).__init__()
+        self.daemon = True
+        self.pool = pool or db.engine.pool
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def capacity(self):
+        """The maximum number of connections the pool will hand out."""
+        overflow = getattr(self.pool, "_max_overflow", 0)
+        return self.pool.size() + max(overflow, 0)
+
+    def run(self):
+        """Sample the pool until stopped."""
+        while not self.stopped.is_set():
+            self.samples.append(self.pool.checkedout())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling."""
+        self.stopped.set()
+        self.join()
+
+    def report(self):
+        """Return the pool usage as a dictionary suitable for JSON."""
+        capacity = self.capacity()
+        peak = max(self.samples) if self.samples else 0
+        return {
+            "capacity": capacity,
+            "samples": len(self.samples),
+            "peak_checked_out": peak,
+            "mean_checked_out": (
+                float(sum(self.samples)) / len(self.samples)
+                if self.samples else 0.0),
+            "peak_saturation": float(peak) / capacity if capacity else None,
+            "saturated_samples": len(
+                [s for s in self.samples if s >= capacity]),
+        }
+
+
+class BotError(Exception):
+    """Raised when a bot cannot continue its script."""
+
+
+class Bot(object):
+    """A simulated participant that uses the experiment server's HTTP API.
+
+    Subclasses implement participate() to follow the script of a demo.
+    """
+
+    def __init__(self, base_url, stats, pause=0.0, timeout=60):
+        """Create a bot that talks to the server at base_url."""
+        self.base_url = base_url.rstrip("/")
+        self.stats = stats
+        self.pause = pause
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.hit_id = "loadtest"
+        self.assignment_id = uuid.uuid4().hex[:12]
+        self.participant_id = None
+
+    def send(self, method, path, data=None):
+        """Make a request, returning its status, decoded body and latency.
+
+        The status and body are None if the server could not be reached or
+        did not return JSON.
+        """
+        start = time.time()
+        try:
+            response = self.http.request(
+                method, self.base_url + path, data=data, timeout=self.timeout)
+            status, body = response.status_code, response.json()
+        except (requests.RequestException, ValueError):
+            status, body = None, None
+        latency = time.time() - start
+        return status, body, latency
+
+    def request(self, method, path, route, data=None, allow_error=False):
+        """Make a request that should succeed and return its body."""
+        status, body, latency = self.send(method, path, data=data)
+        ok = status == 200 and body.get("status") != "error"
+        self.stats.record(route, latency, ok)
+        if not ok and not allow_error:
+            raise BotError("{} {} failed".format(method.upper(), path))
+        return body if ok else None
+
+    def wait(self):
+        """Think for a moment, like a participant would."""
+        if self.pause:
+            time.sleep(random.uniform(0, 2 * self.pause))
+
+    def create_participant(self):
+        """Sign up as a new participant."""
+        resp = self.request(
+            "post", "/participant/{}/{}/{}/debug".format(
+                self.worker_id, self.hit_id, self.assignment_id),
+            "POST /participant")
+        self.participant_id = resp["participant"]["id"]
+
+    def create_node(self):
+        """Ask for a node, returning its id or None if there is no space.
+
+        The server answers 403 without an error page when no network has
+        space left, which is how every bot finishes, so it is not an error.
+        """
+        route = "POST /node"
+        status, body, latency = self.send(
+            "post", "/node/{}".format(self.participant_id))
+        if status == 200:
+            self.stats.record(route, latency, True)
+            return body["node"]["id"]
+        full = status == 403 and body is not None and "html" not in body
+        self.stats.record(route, latency, full)
+        if not full:
+            raise BotError("POST /node failed")
+
+    def post_info(self, node_id, contents, info_type="Info"):
+        """Create an info, returning its id."""
+        resp = self.request(
+            "post", "/info/{}".format(node_id), "POST /info",
+            data={"contents": contents, "info_type": info_type})
+        return resp["info"]["id"]
+
+    def submit_questionnaire(self):
+        """Answer the questionnaire."""
+        for number, question in enumerate(["engagement", "difficulty"], 1):
+            self.request(
+                "post", "/question/{}".format(self.participant_id),
+                "POST /question",
+                data={"question": question, "number": number,
+                      "response": random.randint(1, 7)})
+
+    def notify(self, event_type):
+        """Post the notification MTurk would send for this assignment."""
+        self.request(
+            "post", "/notifications", "POST /notifications",
+            data={"Event.1.EventType": event_type,
+                  "Event.1.AssignmentId": self.assignment_id},
+            allow_error=True)
+
+    def participate(self):
+        """Follow the demo's script once a participant exists."""
+        raise NotImplementedError
+
+    def run(self):
+        """Run the whole participant flow, recording the outcome."""
+        try:
+            self.create_participant()
+            self.notify("AssignmentAccepted")
+            self.participate()
+            self.submit_questionnaire()
+            self.notify("AssignmentSubmitted")
+        except BotError:
+            self.stats.bot_done(False)
+        else:
+            self.stats.bot_done(True)
+
+
+class BartlettBot(Bot):
+    """Read a story and retell it, as in bartlett1932."""
+
+    def participate(self):
+        """Retell stories until the experiment runs out of nodes."""
+        while True:
+            node_id = self.create_node()
+            if node_id is None:
+                return
+            resp = self.request(
+                "get", "/node/{}/received_infos".format(node_id),
+                "GET /node/received_infos")
+            story = resp["infos"][0]["contents"] if resp["infos"] else ""
+            self.wait()
+            self.post_info(node_id, " ".join(story.split()[::2]))
+
+
+class RogersBot(Bot):
+    """Learn and report the majority colour, as in rogers."""
+
+    def participate(self):
+        """Complete trials until the experiment runs out of nodes."""
+        while True:
+            node_id = self.create_node()
+            if node_id is None:
+                return
+            self.request(
+                "get", "/node/{}/infos".format(node_id), "GET /node/infos",
+                data={"info_type": "LearningGene"})
+            self.request(
+                "get", "/node/{}/received_infos".format(node_id),
+                "GET /node/received_infos")
+            self.wait()
+            self.post_info(
+                node_id, random.choice(["blue", "yellow"]), info_type="Meme")
+
+
+class ChatroomBot(Bot):
+    """Wait for a quorum, then chat, as in chatroom."""
+
+    messages = 5
+
+    def wait_for_quorum(self):
+        """Poll the summary until enough participants are working."""
+        quorum = self.request(
+            "get", "/experiment/quorum", "GET /experiment")["quorum"]
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            summary = self.request("get", "/summary", "GET /summary")
+            working = dict(summary["summary"]).get("working", 0)
+            if working >= quorum:
+                return
+            time.sleep(0.5)
+        raise BotError("Quorum was not reached.")
+
+    def participate(self):
+        """Send messages, polling for pending transmissions between them."""
+        self.wait_for_quorum()
+        node_id = self.create_node()
+        if node_id is None:
+            return
+        for n in range(self.messages):
+            resp = self.request(
+                "get", "/node/{}/transmissions".format(node_id),
+                "GET /node/transmissions", data={"status": "pending"})
+            senders = []
+            for t in resp["transmissions"]:
+                self.request(
+                    "get", "/info/{}/{}".format(node_id, t["info_id"]),
+                    "GET /info")
+                senders.append(t["origin_id"])
+            self.wait()
+            info_id = self.post_info(node_id, "message {}".format(n))
+            # Reply directly to the last person who spoke.
+            if senders:
+                self.request(
+                    "post", "/node/{}/transmit".format(node_id),
+                    "POST /node/transmit",
+                    data={"what": info_id, "to_whom": senders[-1]})
+
+
+bots = {
+    "bartlett1932": BartlettBot,
+    "chatroom": ChatroomBot,
+    "rogers": RogersBot,
+}
+
+
+def serve(app, host="127.0.0.1", port=0):
+    """Serve app from a thread in this process, returning the server."""
+    from werkzeug.serving import make_server
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def swarm(base_url, bot_class, n=10, ramp_up=0.0, pause=0.0, monitor=None):
+    """Run n concurrent bots against base_url and return the report.
+
+    Bots start evenly over ramp_up seconds. If a PoolMonitor is given, its
+    readings are included in the report.
+    """
+    stats = Stats()
+    if monitor is not None:
+        monitor.start()
+    threads = []
+    for i in range(n):
+        bot = bot_class(base_url, stats, pause=pause)
+        thread = threading.Thread(target=bot.run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        if ramp_up and n > 1:
+            time.sleep(float(ramp_up) / (n - 1))
+    for thread in threads:
+        thread.join()
+    stats.stop()
+    report = stats.report()
+    report["bots"] = n
+    report["script"] = bot_class.__name__
+    if monitor is not None:
+        monitor.stop()
+        report["db_pool"] = monitor.report()
+    return report
+
+
+def dumps(report):
+    """Serialize a report as stable, diffable JSON."""
+    return json.dumps(report, indent=2, sort_keys=True)
+
+
+def pipeline(base_url, fake, assignments=10, duration=60.0, interval=1.0):
+    """Run assignments through a fake MTurk and the experiment's workers.
+
+    Creates a HIT with the given number of assignments on fake, whose
+    simulated workers use the server at base_url. Recruitment then extends
+    the HIT as usual. After duration seconds the HIT is expired and the
+    workers are given a moment to finish. The report is fake's, with the
+    depth of the notification queues sampled every interval seconds.
+    """
+    http = requests.Session()
+    depths = []
+    hit_id = fake.call("create_hit", max_assignments=assignments)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            metrics = http.get(base_url + "/notifications/metrics").json()
+            counts = metrics["notifications"]
+            depths.append(counts["pending"] + sum(counts["queued"].values()))
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        time.sleep(interval)
+    fake.expire_hit(hit_id)
+    fake.wait(timeout=interval * 10)
+    fake.stats.stop()
+    report = fake.report()
+    report["queue_depth"] = {
+        "samples": len(depths),
+        "max": max(depths) if depths else None,
+        "final": depths[-1] if depths else None,
+    }
+    return report
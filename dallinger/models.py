@@ -3,7 +3,7 @@
 from datetime import datetime
 import inspect
 
-from sqlalchemy import ForeignKey, or_, and_
+from sqlalchemy import ForeignKey, Index, UniqueConstraint, or_, and_
 from sqlalchemy import (
     Column,
     String,
@@ -17,7 +17,7 @@ from sqlalchemy import (
 from sqlalchemy.sql.expression import false
 from sqlalchemy.orm import relationship, validates
 
-from .db import Base
+from .db import Base, pending_nodes
 
 DATETIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
 
@@ -78,6 +78,10 @@ class Participant(Base, SharedMixin):
         'polymorphic_identity': 'participant'
     }
 
+    # The clock looks for participants working for longer than the HIT lasts.
+    __table_args__ = (Index("ix_participant_status_creation_time",
+                            "status", "creation_time"), )
+
     #: A String, the worker id of the participant.
     worker_id = Column(String(50), nullable=False)
 
@@ -353,6 +357,11 @@ class Network(Base, SharedMixin):
     #: networks as either "practice" or "experiment"
     role = Column(String(26), nullable=False, default="default", index=True)
 
+    # Participants are assigned to networks with space by scanning this index
+    # from a random id, which touches only the networks that are not full.
+    __table_args__ = (Index("ix_network_open_id", "id",
+                            postgresql_where=full.is_(False)), )
+
     def __repr__(self):
         """The string representation of a network."""
         return ("<Network-{}-{} with {} nodes, {} vectors, {} infos, "
@@ -574,7 +583,7 @@ class Network(Base, SharedMixin):
 
     def calculate_full(self):
         """Set whether the network is full."""
-        self.full = len(self.nodes()) >= self.max_size
+        self.full = len(self.nodes()) + pending_nodes(self) >= self.max_size
 
     def print_verbose(self):
         """Print a verbose representation of a network."""
@@ -639,14 +648,14 @@ class Node(Base, SharedMixin):
             raise ValueError("{} cannot create a node as they are not working"
                              .format(participant))
 
-        self.network = network
-        self.network_id = network.id
-        network.calculate_full()
-
         if participant is not None:
             self.participant = participant
             self.participant_id = participant.id
 
+        self.network = network
+        self.network_id = network.id
+        network.calculate_full()
+
     def __repr__(self):
         """The string representation of a node."""
         return "Node-{}-{}".format(self.id, self.type)
@@ -1111,11 +1120,13 @@ class Node(Base, SharedMixin):
 
     def flatten(self, l):
         """Turn a list of lists into a list."""
-        if l == []:
-            return l
-        if isinstance(l[0], list):
-            return self.flatten(l[0]) + self.flatten(l[1:])
-        return l[:1] + self.flatten(l[1:])
+        flat = []
+        for item in l:
+            if isinstance(item, list):
+                flat.extend(self.flatten(item))
+            else:
+                flat.append(item)
+        return flat
 
     def transmit(self, what=None, to_whom=None):
         """Transmit one or more infos from one node to another.
@@ -1359,7 +1370,6 @@ class Vector(Base, SharedMixin):
             "id": self.id,
             "origin_id": self.origin_id,
             "destination_id": self.destination_id,
-            "info_id": self.info_id,
             "network_id": self.network_id,
             "creation_time": self.creation_time,
             "failed": self.failed,
@@ -1803,3 +1813,48 @@ class Notification(Base, SharedMixin):
 
     # the type of notification
     event_type = Column(String, nullable=False)
+
+
+class Payout(Base, SharedMixin):
+    """An approval or bonus to be paid to a participant through MTurk.
+
+    Payouts are recorded in the transaction that processes a submission and
+    made later by the payout worker. There is at most one payout of each
+    kind per assignment, so a repeated notification cannot pay twice.
+    """
+
+    __tablename__ = "payout"
+    __table_args__ = (UniqueConstraint("assignment_id", "kind"), )
+
+    #: the assignment the payout is for
+    assignment_id = Column(String(50), nullable=False, index=True)
+
+    #: the participant being paid
+    participant_id = Column(Integer, ForeignKey('participant.id'), index=True)
+
+    #: ``approval`` of the assignment or ``bonus``
+    kind = Column(Enum("approval", "bonus", name="payout_kind"),
+                  nullable=False)
+
+    #: the amount of a bonus
+    amount = Column(Float)
+
+    #: the reason given to the participant for a bonus
+    reason = Column(Text)
+
+    #: ``pending`` until it is made, then ``paid``, or ``failed`` if MTurk
+    #: refused it every time it was attempted
+    status = Column(Enum("pending", "paid", "failed", name="payout_status"),
+                    nullable=False, default="pending", index=True)
+
+    #: the number of calls made to MTurk for this payout
+    attempts = Column(Integer, nullable=False, default=0)
+
+    #: the error of the last failed attempt
+    error = Column(Text)
+
+    #: the time at which the payout was made
+    paid_time = Column(DateTime)
+
+    #: the time before which a payout that failed is not attempted again
+    next_attempt_time = Column(DateTime)
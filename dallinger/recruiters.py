@@ -1,10 +1,25 @@
 """Recruiters manage the flow of participants to the experiment."""
 
+from datetime import datetime, timedelta
+import logging
 import os
 
 from boto.mturk.connection import MTurkConnection
-from psiturk.models import Participant
 from psiturk.psiturk_config import PsiturkConfig
+from rq import Queue, get_current_job
+from sqlalchemy import func, or_
+
+from dallinger import db
+from dallinger.models import Participant, Payout
+
+logger = logging.getLogger('dallinger.recruiters')
+
+# Redis keys of the number of participants waiting to be recruited and of
+# the flag that is set while a job to recruit them is queued or running. The
+# flag expires in case its job dies without clearing it.
+PENDING_RECRUITMENT = "dallinger:recruitment:pending"
+RECRUITMENT_SCHEDULED = "dallinger:recruitment:scheduled"
+RECRUITMENT_SCHEDULED_TTL = 600
 
 
 class Recruiter(object):
@@ -73,13 +88,34 @@ class SimulatedRecruiter(object):
 
 
 class PsiTurkRecruiter(Recruiter):
-    """Recruit participants from Amazon Mechanical Turk via PsiTurk."""
+    """Recruit participants from Amazon Mechanical Turk via PsiTurk.
+
+    The configuration, credentials and MTurk connections are loaded once per
+    process and shared by all the recruiters it creates, so creating a
+    recruiter is cheap. They are keyed by process id, because rq runs every
+    job in a forked process that must not share its parent's sockets.
+    """
+
+    _process_cache = {}
 
     def __init__(self):
         """Set up the connection to MTurk and psiTurk web services."""
-        # load the configuration options
-        self.config = PsiturkConfig()
-        self.config.load_config()
+        cache = self._cache()
+        if "config" not in cache:
+            # load the configuration options
+            config = PsiturkConfig()
+            config.load_config()
+            cache["config"] = config
+
+            # Get keys from environment variables or config file.
+            for key in ["aws_access_key_id", "aws_secret_access_key",
+                        "aws_region"]:
+                cache[key] = os.getenv(key, config.get("AWS Access", key))
+
+        self.config = cache["config"]
+        self.aws_access_key_id = cache["aws_access_key_id"]
+        self.aws_secret_access_key = cache["aws_secret_access_key"]
+        self.aws_region = cache["aws_region"]
 
         class FakeExperimentServerController(object):
             def is_server_running(self):
@@ -87,22 +123,65 @@ class PsiTurkRecruiter(Recruiter):
 
         self.server = FakeExperimentServerController()
 
-        # Get keys from environment variables or config file.
-        self.aws_access_key_id = os.getenv(
-            "aws_access_key_id",
-            self.config.get("AWS Access", "aws_access_key_id"))
+    @classmethod
+    def _cache(cls):
+        """The settings and connections cached for this process."""
+        pid = os.getpid()
+        if pid not in cls._process_cache:
+            cls._process_cache.clear()
+            cls._process_cache[pid] = {}
+        return cls._process_cache[pid]
+
+    def mturk_connection(self):
+        """Return this process's boto connection to MTurk.
+
+        If the FAKE_MTURK_URL environment variable is set, this is a
+        connection to the fake MTurk service there instead.
+        """
+        cache = self._cache()
+        if "mtc" not in cache and os.getenv("FAKE_MTURK_URL"):
+            from dallinger.fakemturk import FakeMTurkConnection
+            cache["mtc"] = FakeMTurkConnection(os.getenv("FAKE_MTURK_URL"))
+        if "mtc" not in cache:
+            if self.config.getboolean(
+                    'Shell Parameters', 'launch_in_sandbox_mode'):
+                host = 'mechanicalturk.sandbox.amazonaws.com'
+            else:
+                host = 'mechanicalturk.amazonaws.com'
+
+            cache["mtc"] = MTurkConnection(
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                host=host)
+        return cache["mtc"]
 
-        self.aws_secret_access_key = os.getenv(
-            "aws_secret_access_key",
-            self.config.get("AWS Access", "aws_secret_access_key"))
+    def mturk_services(self):
+        """Return this process's psiTurk MTurk services."""
+        from psiturk.amt_services import MTurkServices
 
-        self.aws_region = os.getenv(
-            "aws_region",
-            self.config.get("AWS Access", "aws_region"))
+        cache = self._cache()
+        if "amt_services" not in cache and os.getenv("FAKE_MTURK_URL"):
+            from dallinger.fakemturk import FakeMTurkServices
+            cache["amt_services"] = FakeMTurkServices(self.mturk_connection())
+        if "amt_services" not in cache:
+            cache["amt_services"] = MTurkServices(
+                self.aws_access_key_id,
+                self.aws_secret_access_key,
+                self.config.getboolean(
+                    'Shell Parameters', 'launch_in_sandbox_mode'))
+        return cache["amt_services"]
 
     def open_recruitment(self, n=1):
         """Open recruitment for the first HIT, unless it's already open."""
-        from psiturk.amt_services import MTurkServices, RDSServices
+        if os.getenv("FAKE_MTURK_URL"):
+            if Participant.query.first() is None:
+                self.mturk_connection().create_hit(
+                    max_assignments=n,
+                    lifetime=int(float(self.config.get(
+                        'HIT Configuration', 'duration')) * 3600))
+            return
+
+        from psiturk.amt_services import RDSServices
         from psiturk.psiturk_shell import PsiturkNetworkShell
         from psiturk.psiturk_org_services import PsiturkOrgServices
 
@@ -123,11 +202,7 @@ class PsiTurkRecruiter(Recruiter):
             self.aws_secret_access_key,
             self.aws_region)
 
-        self.amt_services = MTurkServices(
-            self.aws_access_key_id,
-            self.aws_secret_access_key,
-            self.config.getboolean(
-                'Shell Parameters', 'launch_in_sandbox_mode'))
+        self.amt_services = self.mturk_services()
 
         self.shell = PsiturkNetworkShell(
             self.config, self.amt_services, aws_rds_services, web_services,
@@ -136,8 +211,8 @@ class PsiTurkRecruiter(Recruiter):
                 'Shell Parameters', 'launch_in_sandbox_mode'))
 
         try:
-            participants = Participant.query.all()
-            assert(participants)
+            participant = Participant.query.first()
+            assert(participant)
 
         except Exception:
             # Create the first HIT.
@@ -160,24 +235,11 @@ class PsiTurkRecruiter(Recruiter):
 
             hit_id = str(
                 Participant.query.
-                with_entities(Participant.hitid).first().hitid)
+                with_entities(Participant.hit_id).first().hit_id)
 
             print "hit_id is {}.".format(hit_id)
 
-            is_sandbox = self.config.getboolean(
-                'Shell Parameters', 'launch_in_sandbox_mode')
-
-            if is_sandbox:
-                host = 'mechanicalturk.sandbox.amazonaws.com'
-            else:
-                host = 'mechanicalturk.amazonaws.com'
-
-            mturkparams = dict(
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                host=host)
-
-            self.mtc = MTurkConnection(**mturkparams)
+            self.mtc = self.mturk_connection()
 
             self.mtc.extend_hit(
                 hit_id,
@@ -196,26 +258,189 @@ class PsiTurkRecruiter(Recruiter):
 
     def approve_hit(self, assignment_id):
         """Approve the HIT."""
-        from psiturk.amt_services import MTurkServices
-
-        self.amt_services = MTurkServices(
-            self.aws_access_key_id,
-            self.aws_secret_access_key,
-            self.config.getboolean(
-                'Shell Parameters', 'launch_in_sandbox_mode'))
+        self.amt_services = self.mturk_services()
         return self.amt_services.approve_worker(assignment_id)
 
     def reward_bonus(self, assignment_id, amount, reason):
         """Reward the Turker with a bonus."""
-        from psiturk.amt_services import MTurkServices
-
-        self.amt_services = MTurkServices(
-            self.aws_access_key_id,
-            self.aws_secret_access_key,
-            self.config.getboolean(
-                'Shell Parameters', 'launch_in_sandbox_mode'))
+        self.amt_services = self.mturk_services()
         return self.amt_services.bonus_worker(assignment_id, amount, reason)
 
     def close_recruitment(self):
         """Close recruitment."""
         pass
+
+
+class CoalescingRecruiter(object):
+    """Coalesce the recruitment requests made while a recruitment is pending.
+
+    Wraps a recruiter class. Requests to recruit participants are added up in
+    Redis, and a job on queue recruits them all with one call to
+    recruit_participants. Requests made while that job is queued or running
+    are recruited by it too. Other methods are passed to a recruiter created
+    when needed.
+    """
+
+    def __init__(self, recruiter, queue):
+        """Wrap recruiter, a recruiter class."""
+        self.recruiter_class = recruiter
+        self.queue = queue
+        self._recruiter = None
+
+    def __getattr__(self, name):
+        """Pass other methods to the wrapped recruiter."""
+        if self._recruiter is None:
+            self._recruiter = self.recruiter_class()
+        return getattr(self._recruiter, name)
+
+    def recruit_participants(self, n=1):
+        """Add n participants to those waiting to be recruited."""
+        if n <= 0:
+            return
+        pipe = self.queue.connection.pipeline(transaction=False)
+        pipe.incrby(PENDING_RECRUITMENT, n)
+        pipe.set(RECRUITMENT_SCHEDULED, 1, nx=True,
+                 ex=RECRUITMENT_SCHEDULED_TTL)
+        pending, scheduled = pipe.execute()
+        logger.debug("%d participants waiting to be recruited", pending)
+        if scheduled:
+            self.queue.enqueue(flush_recruitment, self.recruiter_class)
+
+
+@db.scoped_session_decorator
+def flush_recruitment(recruiter_class):
+    """Recruit the participants waiting to be recruited until none are left.
+
+    Each count is taken atomically. The scheduling flag is kept while the
+    job runs, so participants requested during a call to the recruiter are
+    recruited together by the next call instead of by jobs of their own. If
+    recruitment fails, the count is put back before the error is raised.
+    """
+    job = get_current_job()
+    conn = job.connection
+    try:
+        while True:
+            conn.expire(RECRUITMENT_SCHEDULED, RECRUITMENT_SCHEDULED_TTL)
+            n = int(conn.getset(PENDING_RECRUITMENT, 0) or 0)
+            if not n:
+                break
+            try:
+                recruiter_class().recruit_participants(n=n)
+            except Exception:
+                conn.incrby(PENDING_RECRUITMENT, n)
+                raise
+    finally:
+        conn.delete(RECRUITMENT_SCHEDULED)
+    # A request may have arrived after the last count was taken but before
+    # the flag was cleared, in which case nobody scheduled a job for it.
+    if int(conn.get(PENDING_RECRUITMENT) or 0):
+        if conn.set(RECRUITMENT_SCHEDULED, 1, nx=True,
+                    ex=RECRUITMENT_SCHEDULED_TTL):
+            Queue(job.origin, connection=conn).enqueue(flush_recruitment,
+                                                       recruiter_class)
+
+
+def due_payouts(now=None):
+    """The pending payouts that are due to be attempted, as a query."""
+    now = now or datetime.now()
+    return Payout.query.filter(
+        Payout.status == "pending",
+        or_(Payout.next_attempt_time.is_(None),
+            Payout.next_attempt_time <= now))
+
+
+def next_payout_attempt():
+    """The time of the next retry of a pending payout, or None."""
+    return db.session.query(func.min(Payout.next_attempt_time))\
+        .filter(Payout.status == "pending",
+                Payout.next_attempt_time > datetime.now())\
+        .scalar()
+
+
+def make_payouts(recruiter, limit=100, attempts=5, backoff=1):
+    """Make up to limit of the payouts that are due, oldest first.
+
+    Each payout is locked, attempted and its outcome recorded in a
+    transaction of its own, so concurrent payout workers never make the
+    same payout twice. MTurk throttles bursts of requests, so a payout that
+    fails is not retried here: it is due again after backoff seconds, then
+    twice as long, and so on. Payouts locked by another worker are skipped,
+    as are bonuses whose approval has not been made yet. Returns the number
+    of payouts made.
+    """
+    session = db.session
+    ids = [id for (id, ) in due_payouts()
+           .with_entities(Payout.id)
+           .order_by(Payout.id)
+           .limit(limit)]
+    paid = 0
+    for id in ids:
+        payout = lock_payout(id)
+        if payout is None:
+            session.rollback()
+            continue
+        if make_payout(recruiter, payout, attempts=attempts, backoff=backoff):
+            paid += 1
+        session.commit()
+    return paid
+
+
+def lock_payout(id):
+    """Lock the pending payout id, or return None if it cannot be made now.
+
+    A bonus is failed if its approval failed, since MTurk only grants
+    bonuses for approved assignments, and waits if it has not been made.
+    """
+    payout = Payout.query.filter_by(id=id, status="pending")\
+        .with_for_update(skip_locked=True).first()
+    if payout is None or payout.kind != "bonus":
+        return payout
+    approval = Payout.query.filter_by(
+        assignment_id=payout.assignment_id, kind="approval").first()
+    if approval is not None and approval.status == "failed":
+        payout.status = "failed"
+        payout.error = "The approval failed."
+        db.session.commit()
+        return None
+    if approval is not None and approval.status != "paid":
+        return None
+    return payout
+
+
+def make_payout(recruiter, payout, attempts=5, backoff=1):
+    """Make one attempt at a payout through MTurk.
+
+    Returns whether the payout was made. Otherwise the error is recorded,
+    and the payout is due again after backoff seconds, doubling with each
+    failure, until it has been attempted attempts times and is marked
+    failed. The caller commits.
+    """
+    payout.attempts += 1
+    try:
+        if payout.kind == "approval":
+            result = recruiter.approve_hit(payout.assignment_id)
+        else:
+            result = recruiter.reward_bonus(
+                payout.assignment_id, payout.amount, payout.reason)
+    except Exception as e:
+        payout.error = "{}: {}".format(type(e).__name__, e)
+    else:
+        # psiTurk returns False when MTurk refuses the request.
+        if result is not False:
+            payout.status = "paid"
+            payout.paid_time = datetime.now()
+            payout.next_attempt_time = None
+            payout.error = None
+            return True
+        payout.error = "MTurk refused the request."
+    if payout.attempts < attempts:
+        delay = backoff * 2 ** (payout.attempts - 1)
+        payout.next_attempt_time = datetime.now() + timedelta(seconds=delay)
+        logger.warning("Retrying the %s of assignment %s in %ss: %s",
+                       payout.kind, payout.assignment_id, delay, payout.error)
+        return False
+    logger.error("Giving up on the %s of assignment %s: %s",
+                 payout.kind, payout.assignment_id, payout.error)
+    payout.status = "failed"
+    payout.next_attempt_time = None
+    return False
@@ -0,0 +1,180 @@
+"""Snapshots of experiment code, cached by the content of their files."""
+
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import time
+import zipfile
+import zlib
+
+#: Extensions of files that are already compressed, which are stored in
+#: snapshots as they are instead of being compressed again.
+STORED_EXTENSIONS = set([
+    ".bz2", ".gif", ".gz", ".jpeg", ".jpg", ".m4a", ".mp3", ".mp4", ".ogg",
+    ".pdf", ".png", ".webm", ".webp", ".woff", ".woff2", ".xz", ".zip",
+])
+
+#: The number of snapshots kept in the cache.
+CACHE_SIZE = 3
+
+
+def file_hash(path):
+    """The SHA-1 of the file at path."""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_hashes(root, exclude=(), cache_path=None, jobs=4):
+    """Map the path of each file under root, relative to root, to its hash.
+
+    If cache_path is given, the hashes are remembered there with the size
+    and modification time of each file, and a file that has neither changed
+    is not read again. Files are hashed jobs at a time.
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    stats = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            if name not in exclude:
+                stat = os.stat(path)
+                stats[name] = [stat.st_size, stat.st_mtime]
+
+    hashes = {}
+    stale = []
+    for name, stat in stats.items():
+        if name in cache and cache[name][:2] == stat:
+            hashes[name] = cache[name][2]
+        else:
+            stale.append(name)
+    if stale:
+        pool = ThreadPool(max(min(jobs, len(stale)), 1))
+        try:
+            fresh = pool.map(
+                lambda name: file_hash(os.path.join(root, name)), stale)
+        finally:
+            pool.close()
+            pool.join()
+        hashes.update(zip(stale, fresh))
+
+    if cache_path is not None:
+        with open(cache_path, "w") as f:
+            json.dump(dict((name, stats[name] + [hashes[name]])
+                           for name in hashes), f)
+    return hashes
+
+
+def deflate(path):
+    """Read the file at path, returning its CRC-32, its size and its contents
+    deflated as they are in a zip."""
+    with open(path, "rb") as f:
+        contents = f.read()
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(contents) + compressor.flush()
+    return zlib.crc32(contents) & 0xffffffff, len(contents), data
+
+
+def write_deflated(archive, name, path, crc, size, data):
+    """Add a file already deflated by :func:`deflate` to archive.
+
+    This is what ZipFile.writestr does, without compressing the data again.
+    """
+    stat = os.stat(path)
+    info = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+    info.external_attr = (stat.st_mode & 0xFFFF) << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    info.header_offset = archive.fp.tell()
+    zip64 = max(size, len(data)) > zipfile.ZIP64_LIMIT
+    archive.fp.write(info.FileHeader(zip64))
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[name] = info
+    archive._didModify = True
+
+
+def build(root, names, path, jobs=4):
+    """Zip the files of root named in names to path.
+
+    Files that are already compressed are stored rather than deflated. The
+    others are deflated jobs at a time, and written in order as they are.
+    """
+    names = sorted(names)
+    deflated = [name for name in names
+                if os.path.splitext(name)[1].lower() not in STORED_EXTENSIONS]
+    compressed = set(deflated)
+    pool = ThreadPool(max(min(jobs, len(deflated)), 1))
+    try:
+        results = pool.imap(
+            lambda name: deflate(os.path.join(root, *name.split("/"))),
+            deflated)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            for name in names:
+                source = os.path.join(root, *name.split("/"))
+                if name in compressed:
+                    write_deflated(archive, name, source, *next(results))
+                else:
+                    archive.write(source, name, zipfile.ZIP_STORED)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def snapshot(root, path, cache_dir, exclude=("experiment_id.txt", ),
+             jobs=4):
+    """Zip the experiment code in root to path, reusing an earlier zip.
+
+    The zip is cached in cache_dir under the hash of the names and contents
+    of its files, so if nothing has changed since an earlier snapshot that
+    zip is copied instead of compressing everything again. The files named
+    in exclude differ between snapshots; they are left out of the hash and
+    added to each copy. Returns the hash and whether the zip was reused.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    hashes = file_hashes(root, exclude=exclude, jobs=jobs,
+                         cache_path=os.path.join(cache_dir, "hashes.json"))
+    digest = hashlib.sha1(
+        json.dumps(sorted(hashes.items())).encode("utf-8")).hexdigest()
+
+    cached = os.path.join(cache_dir, digest + ".zip")
+    reused = os.path.exists(cached)
+    if reused:
+        os.utime(cached, None)
+    else:
+        build(root, hashes, cached + ".part", jobs=jobs)
+        os.rename(cached + ".part", cached)
+        prune(cache_dir)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    shutil.copyfile(cached, path)
+    with zipfile.ZipFile(path, "a", zipfile.ZIP_DEFLATED) as archive:
+        for name in exclude:
+            if os.path.exists(os.path.join(root, name)):
+                archive.write(os.path.join(root, name), name)
+    return digest, reused
+
+
+def prune(cache_dir, keep=CACHE_SIZE):
+    """Delete all but the keep most recently used snapshots in cache_dir."""
+    zips = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+            if name.endswith(".zip")]
+    zips.sort(key=os.path.getmtime, reverse=True)
+    for path in zips[keep:]:
+        os.remove(path)
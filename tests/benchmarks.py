@@ -0,0 +1,543 @@
+"""Benchmarks for the core models, networks and processes.
+
+Each benchmark builds a network of n nodes directly in the database and then
+times a single operation on it, such as adding one more node. Run the suite
+from the root of the repository with::
+
+    python tests/benchmarks.py
+
+The results are compared against ``tests/benchmarks_baseline.json``. Both the
+timings and the way they grow with n are checked, so that an operation that
+becomes quadratic is caught even on a faster machine. Use ``--save`` to
+record a new baseline.
+
+The time to start a new interpreter and import the package, its models or
+the command-line utility is benchmarked too, so that an import that makes
+every process slower to start is caught.
+"""
+
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+import click
+from sqlalchemy import Integer, select
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.sql.expression import cast
+
+from dallinger import db, models, networks, nodes, processes
+
+SCALES = (10, 100, 1000, 10000)
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmarks_baseline.json")
+
+registry = []
+
+#: Statements whose startup time is benchmarked, each run in a new
+#: interpreter. startup.python is the time to start the interpreter alone.
+STARTUP = [
+    ("startup.python", "pass"),
+    ("startup.import dallinger", "import dallinger"),
+    ("startup.import dallinger.models", "import dallinger.models"),
+    ("startup.dallinger --help",
+     "from dallinger.command_line import dallinger; dallinger(['--help'])"),
+]
+
+#: How many seconds slower than the baseline a startup must also be to
+#: regress, since starting a process is noisy.
+STARTUP_MARGIN = 0.05
+
+
+def benchmark(name, max_scale=None):
+    """Register a benchmark.
+
+    The decorated function takes n, builds its fixtures and returns the
+    operation to time. max_scale caps n for operations whose fixtures grow
+    faster than linearly.
+    """
+    def decorator(func):
+        registry.append((name, func, max_scale))
+        return func
+    return decorator
+
+
+class GenerationalAgent(nodes.Agent):
+    """An agent with the generation column DiscreteGenerational expects."""
+
+    __mapper_args__ = {"polymorphic_identity": "benchmark_generational_agent"}
+
+    @hybrid_property
+    def generation(self):
+        """The generation of the agent, stored in property2."""
+        return int(self.property2)
+
+    @generation.setter
+    def generation(self, generation):
+        """Store the generation in property2."""
+        self.property2 = repr(generation)
+
+    @generation.expression
+    def generation(self):
+        """Retrieve the generation via property2."""
+        return cast(self.property2, Integer)
+
+
+def insert(model, rows):
+    """Insert rows into the table of model with a single executemany."""
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+
+
+def ids(model, network):
+    """Return the ids of the rows of model in network, in order."""
+    table = model.__table__
+    query = select([table.c.id]).where(table.c.network_id == network.id)
+    return [r[0] for r in db.session.execute(query.order_by(table.c.id))]
+
+
+def build(network, types, edges=lambda ids: []):
+    """Populate network with one node of each type and the given vectors.
+
+    types is a list of (polymorphic identity, generation) pairs and edges
+    maps the ids of the new nodes to (origin, destination) pairs.
+    """
+    session = db.init_db(drop_all=True)
+    session.add(network)
+    session.commit()
+    start = datetime.now() - timedelta(days=1)
+    insert(models.Node, [{
+        "network_id": network.id,
+        "type": type,
+        "property1": "1.0",
+        "property2": None if generation is None else repr(generation),
+        "creation_time": start + timedelta(microseconds=i),
+    } for i, (type, generation) in enumerate(types)])
+    node_ids = ids(models.Node, network)
+    insert(models.Vector, [{
+        "network_id": network.id,
+        "origin_id": origin,
+        "destination_id": destination,
+    } for (origin, destination) in edges(node_ids)])
+    session.commit()
+    return node_ids
+
+
+def agents(n):
+    """The node types of n plain agents."""
+    return [("agent", None)] * n
+
+
+def give_infos(network, node_ids):
+    """Give each node one info, returning the ids of the infos."""
+    insert(models.Info, [{
+        "network_id": network.id,
+        "origin_id": node_id,
+        "type": "info",
+        "contents": "benchmark",
+    } for node_id in node_ids])
+    db.session.commit()
+    return ids(models.Info, network)
+
+
+def chain(ids):
+    """Each node connects to the next."""
+    return zip(ids[:-1], ids[1:])
+
+
+def ring(ids):
+    """Each node connects both ways with its neighbours on a ring."""
+    pairs = zip(ids, ids[1:] + ids[:1])
+    return pairs + [(b, a) for (a, b) in pairs]
+
+
+def both_ways(center, others):
+    """Vectors from center to each of others and back."""
+    return [(center, o) for o in others] + [(o, center) for o in others]
+
+
+def fully_connected(ids):
+    """Every node connects to every other node."""
+    return [(a, b) for a in ids for b in ids if a != b]
+
+
+def star(ids):
+    """The first node connects both ways with every other node."""
+    return both_ways(ids[0], ids[1:])
+
+
+def burst(ids):
+    """The first node connects to every other node."""
+    return [(ids[0], i) for i in ids[1:]]
+
+
+def microsociety(ids):
+    """Each node receives from the two nodes before it."""
+    return chain(ids) + zip(ids[:-2], ids[2:])
+
+
+def scale_free(ids):
+    """A fully connected core of three, then two links per newcomer."""
+    rng = random.Random(0)
+    pairs = fully_connected(ids[:3])
+    for i in range(3, len(ids)):
+        for other in rng.sample(ids[:i], 2):
+            pairs += [(ids[i], other), (other, ids[i])]
+    return pairs
+
+
+def generational(size):
+    """One source, then each agent receives from the generation before."""
+    def edges(ids):
+        rng = random.Random(0)
+        source, agents = ids[0], ids[1:]
+        pairs = [(source, a) for a in agents[:size]]
+        for i in range(size, len(agents)):
+            generation = i // size
+            parent = rng.choice(
+                agents[(generation - 1) * size:generation * size])
+            pairs.append((parent, agents[i]))
+        return pairs
+    return edges
+
+
+def add_node_benchmark(name, factory, edges, max_scale=None):
+    """Register a benchmark of adding one agent to a network of n."""
+    @benchmark("add_node." + name, max_scale=max_scale)
+    def run(n):
+        network = factory()
+        build(network, agents(n), edges)
+        node = nodes.Agent(network=network)
+        return lambda: network.add_node(node)
+    return run
+
+
+add_node_benchmark("Chain", networks.Chain, chain)
+add_node_benchmark(
+    "FullyConnected", networks.FullyConnected, fully_connected,
+    max_scale=100)
+add_node_benchmark("Empty", networks.Empty, lambda ids: [])
+add_node_benchmark("Star", networks.Star, star)
+add_node_benchmark("Burst", networks.Burst, burst)
+add_node_benchmark(
+    "SequentialMicrosociety",
+    lambda: networks.SequentialMicrosociety(n=3), microsociety)
+add_node_benchmark(
+    "ScaleFree", lambda: networks.ScaleFree(m0=3, m=2), scale_free,
+    max_scale=1000)
+
+
+@benchmark("add_node.DiscreteGenerational")
+def add_node_discrete_generational(n):
+    size = 10
+    network = networks.DiscreteGenerational(
+        generations=n // size + 2, generation_size=size, initial_source=True)
+    build(
+        network,
+        [("random_binary_string_source", None)] + [
+            ("benchmark_generational_agent", i // size) for i in range(n)],
+        generational(size))
+    node = GenerationalAgent(network=network)
+    node.fitness = 1.0
+    return lambda: network.add_node(node)
+
+
+# Transmitting to and failing n neighbours currently turn quadratic past a
+# few thousand nodes, so these stop at 1000 to keep the suite quick.
+@benchmark("Node.transmit.fan_out", max_scale=1000)
+def transmit_fan_out(n):
+    network = networks.Burst()
+    node_ids = build(network, agents(n + 1), burst)
+    sender = models.Node.query.get(node_ids[0])
+    info = models.Info(origin=sender, contents="benchmark")
+    db.session.commit()
+    return lambda: sender.transmit(what=info, to_whom=nodes.Agent)
+
+
+@benchmark("Node.receive.pending")
+def receive_pending(n):
+    network = networks.Empty()
+    node_ids = build(
+        network, agents(n + 1),
+        lambda ids: [(i, ids[0]) for i in ids[1:]])
+    info_ids = give_infos(network, node_ids[1:])
+    insert(models.Transmission, [{
+        "network_id": network.id,
+        "vector_id": vector_id,
+        "info_id": info_id,
+        "origin_id": origin_id,
+        "destination_id": node_ids[0],
+        "status": "pending",
+    } for (vector_id, info_id, origin_id) in zip(
+        ids(models.Vector, network), info_ids, node_ids[1:])])
+    db.session.commit()
+    receiver = models.Node.query.get(node_ids[0])
+    return lambda: receiver.receive()
+
+
+@benchmark("Node.fail.cascade", max_scale=1000)
+def fail_cascade(n):
+    network = networks.Star()
+    node_ids = build(network, agents(n + 1), star)
+    node = models.Node.query.get(node_ids[0])
+    info = models.Info(origin=node, contents="benchmark")
+    node.transmit(what=info, to_whom=nodes.Agent)
+    db.session.commit()
+    return lambda: node.fail()
+
+
+def create_agents(n, bulk):
+    """Create n agents in a network, each with an info, in bulk mode or not."""
+    network = networks.Empty(max_size=n)
+    build(network, [])
+
+    def create():
+        for _ in range(n):
+            models.Info(origin=nodes.Agent(network=network))
+
+    def create_in_bulk():
+        with db.bulk_mode():
+            create()
+
+    return create_in_bulk if bulk else create
+
+
+@benchmark("Node.__init__", max_scale=1000)
+def create_nodes(n):
+    return create_agents(n, bulk=False)
+
+
+@benchmark("Node.__init__.bulk_mode", max_scale=1000)
+def create_nodes_in_bulk(n):
+    return create_agents(n, bulk=True)
+
+
+@benchmark("Network.__repr__")
+def network_repr(n):
+    network = networks.Chain()
+    node_ids = build(network, agents(n), chain)
+    give_infos(network, node_ids)
+    return lambda: repr(network)
+
+
+def moran_network(n, baby=False):
+    """A ring of agents with infos, a source and one past transmission."""
+    network = networks.Empty()
+    types = [("random_binary_string_source", None)] + agents(n)
+    if baby:
+        types += [("agent", None)]
+    node_ids = build(
+        network, types,
+        lambda ids: [(ids[0], ids[1])] + ring(ids[1:n + 1]))
+    give_infos(network, node_ids[1:])
+    source = models.Node.query.get(node_ids[0])
+    source.transmit(to_whom=models.Node.query.get(node_ids[1]))
+    db.session.commit()
+    return network
+
+
+@benchmark("processes.random_walk")
+def random_walk(n):
+    network = networks.Empty()
+    build(
+        network, [("random_binary_string_source", None)] + agents(n),
+        lambda ids: burst(ids) + ring(ids[1:]))
+    return lambda: processes.random_walk(network)
+
+
+@benchmark("processes.moran_cultural")
+def moran_cultural(n):
+    network = moran_network(n)
+    return lambda: processes.moran_cultural(network)
+
+
+@benchmark("processes.moran_sexual")
+def moran_sexual(n):
+    network = moran_network(n, baby=True)
+    return lambda: processes.moran_sexual(network)
+
+
+@benchmark("processes.transmit_by_fitness")
+def transmit_by_fitness(n):
+    network = networks.Empty()
+    node_ids = build(network, agents(n), ring)
+    give_infos(network, node_ids)
+    parents = network.nodes(type=nodes.Agent)
+    return lambda: processes.transmit_by_fitness(
+        from_whom=parents, to_whom=nodes.Agent)
+
+
+def time_once(func, n):
+    """Build the fixtures for n and time one run of the operation."""
+    operation = func(n)
+    try:
+        start = time.time()
+        operation()
+        db.session.flush()
+        return time.time() - start
+    finally:
+        db.session.rollback()
+        db.session.remove()
+
+
+def exponent(timings):
+    """Fit t = c * n ** k to {n: t} by least squares and return k."""
+    points = [(math.log(n), math.log(max(t, 1e-6)))
+              for n, t in timings.items()]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return sxy / sxx
+
+
+def time_startup(statement):
+    """Time running statement in a new interpreter."""
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", statement],
+                              stdout=devnull)
+        return time.time() - start
+
+
+def run_startup(repeats=3, only=None, echo=lambda line: None):
+    """Run the startup benchmarks, returning their results.
+
+    Each result is the best of repeats runs, in seconds.
+    """
+    results = {}
+    for name, statement in STARTUP:
+        if only and only not in name:
+            continue
+        try:
+            seconds = min(time_startup(statement) for _ in range(repeats))
+        except subprocess.CalledProcessError as e:
+            results[name] = {"seconds": None, "error": str(e)}
+            echo("{:<40} {}".format(name, e))
+            continue
+        results[name] = {"seconds": seconds}
+        echo("{:<40} {:>16.2f} ms".format(name, seconds * 1000))
+    return results
+
+
+def run(scales=SCALES, repeats=3, only=None, echo=lambda line: None):
+    """Run the benchmarks, returning their results.
+
+    Each timing is the best of repeats runs, in seconds.
+    """
+    results = {}
+    for name, func, max_scale in registry:
+        if only and only not in name:
+            continue
+        timings = {}
+        errors = {}
+        for n in scales:
+            if max_scale is not None and n > max_scale:
+                continue
+            try:
+                timings[n] = min(time_once(func, n) for _ in range(repeats))
+            except Exception as e:
+                errors[str(n)] = "{}: {}".format(type(e).__name__, e)
+                echo("{:<40} n={:<6} {}".format(name, n, errors[str(n)]))
+                break
+            echo("{:<40} n={:<6} {:9.2f} ms".format(
+                name, n, timings[n] * 1000))
+        results[name] = {
+            "timings": dict((str(n), t) for n, t in timings.items()),
+            "exponent": exponent(timings),
+        }
+        if errors:
+            results[name]["errors"] = errors
+    return results
+
+
+def compare(results, baseline, slowdown=2.0, growth=0.5):
+    """Return a list of regressions of results relative to baseline.
+
+    A benchmark regresses when it fails at a scale that the baseline ran,
+    when it is more than slowdown times slower than the baseline at any
+    scale above 100 (smaller scales are too noisy), or when its fitted
+    exponent grows by more than growth. A startup benchmark regresses when
+    it fails or is more than slowdown times and STARTUP_MARGIN seconds
+    slower than the baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if "seconds" in result:
+            if result.get("error"):
+                regressions.append(
+                    "{} failed: {}".format(name, result["error"]))
+            elif (base["seconds"] is not None and result["seconds"] >
+                    max(slowdown * base["seconds"],
+                        base["seconds"] + STARTUP_MARGIN)):
+                regressions.append(
+                    "{} took {:.1f} ms (baseline {:.1f} ms)".format(
+                        name, result["seconds"] * 1000,
+                        base["seconds"] * 1000))
+            continue
+        for n, error in sorted(result.get("errors", {}).items()):
+            if n in base["timings"]:
+                regressions.append(
+                    "{} at n={} failed: {}".format(name, n, error))
+        for n, t in sorted(result["timings"].items(), key=lambda i: int(i[0])):
+            if int(n) <= 100 or n not in base["timings"]:
+                continue
+            if t > slowdown * base["timings"][n]:
+                regressions.append(
+                    "{} at n={} took {:.1f} ms (baseline {:.1f} ms)".format(
+                        name, n, t * 1000, base["timings"][n] * 1000))
+        if (result["exponent"] is not None and
+                base["exponent"] is not None and
+                result["exponent"] > base["exponent"] + growth):
+            regressions.append(
+                "{} now grows as n^{:.2f} (baseline n^{:.2f})".format(
+                    name, result["exponent"], base["exponent"]))
+    return regressions
+
+
+@click.command()
+@click.option('--scales', default=",".join(str(s) for s in SCALES),
+              help='Comma-separated network sizes')
+@click.option('--repeats', default=3, help='Runs per timing (best is kept)')
+@click.option('--only', default=None, help='Run benchmarks matching this')
+@click.option('--output', default=None, help='File to write results to')
+@click.option('--baseline', default=BASELINE, help='Baseline to compare to')
+@click.option('--save', is_flag=True, help='Save the results as the baseline')
+def main(scales, repeats, only, output, baseline, save):
+    """Run the benchmarks and compare them against the baseline."""
+    results = run(
+        scales=[int(s) for s in scales.split(",")],
+        repeats=repeats,
+        only=only,
+        echo=click.echo)
+    results.update(run_startup(repeats=repeats, only=only, echo=click.echo))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if save:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo("Saved baseline to {}".format(baseline))
+        return
+    if not os.path.exists(baseline):
+        click.echo("No baseline at {}".format(baseline))
+        return
+    with open(baseline) as f:
+        regressions = compare(results, json.load(f))
+    for regression in regressions:
+        click.echo("REGRESSION: " + regression)
+    if regressions:
+        sys.exit(1)
+    click.echo("No regressions against {}".format(baseline))
+
+
+if __name__ == "__main__":
+    main()
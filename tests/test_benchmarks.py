@@ -0,0 +1,110 @@
+import subprocess
+import sys
+
+from tests import benchmarks
+
+
+class TestBenchmarks(object):
+
+    def test_every_benchmark_runs(self):
+        results = benchmarks.run(scales=[10], repeats=1)
+        assert len(results) == len(benchmarks.registry)
+        for name, result in results.items():
+            assert result["timings"]["10"] > 0, name
+
+    def test_max_scale(self):
+        results = benchmarks.run(
+            scales=[10, 200], repeats=1, only="FullyConnected")
+        assert results.keys() == ["add_node.FullyConnected"]
+        assert results["add_node.FullyConnected"]["timings"].keys() == ["10"]
+
+    def test_exponent(self):
+        linear = dict((n, 0.001 * n) for n in [10, 100, 1000])
+        quadratic = dict((n, 0.001 * n * n) for n in [10, 100, 1000])
+        assert round(benchmarks.exponent(linear), 6) == 1
+        assert round(benchmarks.exponent(quadratic), 6) == 2
+        assert benchmarks.exponent({10: 1.0}) is None
+
+    def test_compare_flags_slowdown_and_growth(self):
+        baseline = {
+            "add_node.Chain": {
+                "timings": {"10": 0.001, "1000": 0.002},
+                "exponent": 0.2,
+            },
+        }
+        same = {
+            "add_node.Chain": {
+                "timings": {"10": 0.005, "1000": 0.003},
+                "exponent": 0.3,
+            },
+        }
+        assert benchmarks.compare(same, baseline) == []
+
+        quadratic = {
+            "add_node.Chain": {
+                "timings": {"10": 0.001, "1000": 10.0},
+                "exponent": 2.0,
+            },
+        }
+        regressions = benchmarks.compare(quadratic, baseline)
+        assert len(regressions) == 2
+        assert "n=1000" in regressions[0]
+        assert "n^2.00" in regressions[1]
+
+    def test_compare_ignores_new_benchmarks(self):
+        results = {"new": {"timings": {"1000": 1.0}, "exponent": 1.0}}
+        assert benchmarks.compare(results, {}) == []
+
+    def test_compare_flags_failures(self):
+        baseline = {"a": {"timings": {"1000": 0.1}, "exponent": None}}
+        results = {"a": {
+            "timings": {}, "exponent": None,
+            "errors": {"1000": "RuntimeError: too deep"}}}
+        regressions = benchmarks.compare(results, baseline)
+        assert regressions == ["a at n=1000 failed: RuntimeError: too deep"]
+
+    def test_run_startup(self):
+        results = benchmarks.run_startup(repeats=1, only="import dallinger")
+        assert sorted(results) == [
+            "startup.import dallinger", "startup.import dallinger.models"]
+        for name, result in results.items():
+            assert result["seconds"] > 0, name
+
+    def test_compare_startup(self):
+        baseline = {"startup.import dallinger": {"seconds": 0.1}}
+        slower = {"startup.import dallinger": {"seconds": 0.15}}
+        assert benchmarks.compare(slower, baseline) == []
+        regressions = benchmarks.compare(
+            {"startup.import dallinger": {"seconds": 0.5}}, baseline)
+        assert regressions == [
+            "startup.import dallinger took 500.0 ms (baseline 100.0 ms)"]
+        failed = {"startup.import dallinger": {
+            "seconds": None, "error": "exit status 1"}}
+        assert benchmarks.compare(failed, baseline) == [
+            "startup.import dallinger failed: exit status 1"]
+
+
+class TestStartup(object):
+
+    def imported(self, statement):
+        """The modules imported by statement in a new interpreter."""
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            statement + "; import sys; print(' '.join(sys.modules))"])
+        return set(output.split())
+
+    def test_import_dallinger_is_lazy(self):
+        modules = self.imported("import dallinger")
+        for name in ["dallinger.models", "sqlalchemy", "pexpect",
+                     "localconfig"]:
+            assert name not in modules, name
+
+    def test_modules_are_imported_on_first_use(self):
+        modules = self.imported("import dallinger; dallinger.networks.Chain")
+        assert "dallinger.networks" in modules
+        assert "dallinger.heroku" not in modules
+
+    def test_command_line_does_not_import_the_models(self):
+        modules = self.imported("import dallinger.command_line")
+        for name in ["dallinger.models", "sqlalchemy"]:
+            assert name not in modules, name
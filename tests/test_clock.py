@@ -0,0 +1,80 @@
+import os
+import sys
+
+from dallinger import db, jobs, models
+from dallinger.db import QueryBudget
+
+
+class TestClock(object):
+
+    @classmethod
+    def setup_class(cls):
+        # The clock loads the experiment from the deployment directory.
+        from dallinger.command_line import setup_experiment
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+        (id, tmp) = setup_experiment(debug=True, verbose=False)
+        os.chdir(tmp)
+        sys.path.insert(0, tmp)
+
+    @classmethod
+    def teardown_class(cls):
+        sys.path.pop(0)
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def test_sweep_queues_due_payouts(self):
+        from rq import Queue
+        from dallinger.heroku import clock
+        queue = Queue("high", connection=jobs.redis_connection())
+        queued = queue.count
+        assert not clock.sweep_payouts()
+        assert queue.count == queued
+        self.db.add(models.Payout(assignment_id="a1", kind="approval"))
+        self.db.commit()
+        try:
+            assert clock.sweep_payouts()
+            assert queue.count == queued + 1
+            assert queue.jobs[-1].func_name == "custom.schedule_payouts"
+        finally:
+            queue.remove(queue.jobs[-1])
+
+    def test_overdue_participants(self):
+        from datetime import datetime, timedelta
+        from dallinger.heroku import clock
+        now = datetime.now()
+        for i, hours in enumerate([0, 2, 3]):
+            participant = models.Participant(
+                worker_id="w{}".format(i), assignment_id="a{}".format(i),
+                hit_id="h1", mode="debug")
+            participant.creation_time = now - timedelta(hours=hours)
+            self.db.add(participant)
+        self.db.commit()
+        with QueryBudget(max_queries=1, explain=True) as queries:
+            overdue = clock.overdue_participants(3600, now)
+        queries.assert_no_seq_scan("participant")
+        assert [p.assignment_id for p in overdue] == ["a2", "a1"]
+
+    def test_assignment_statuses(self):
+        from dallinger.heroku import clock
+
+        class Assignment(object):
+            AssignmentStatus = "Submitted"
+
+        class Connection(object):
+            def get_assignment(self, assignment_id):
+                if assignment_id == "missing":
+                    raise ValueError(assignment_id)
+                return [Assignment()]
+
+        statuses = clock.assignment_statuses(
+            Connection(), ["a1", "missing", "a2"], threads=2)
+        assert statuses == ["Submitted", None, "Submitted"]
+        assert clock.assignment_statuses(Connection(), []) == []
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import os
+import shutil
 import subprocess
+import tempfile
 
 
 class TestCommandLine(object):
@@ -20,3 +22,102 @@ class TestCommandLine(object):
     def test_dallinger_help(self):
         output = subprocess.check_output("dallinger", shell=True)
         assert("Usage: dallinger [OPTIONS] COMMAND [ARGS]" in output)
+
+
+class TestDebugHelpers(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wait_for_server(self):
+        from flask import Flask
+        from dallinger import loadtest
+        from dallinger.command_line import wait_for_server
+        server = loadtest.serve(Flask(__name__))
+        try:
+            assert wait_for_server(
+                "http://127.0.0.1:{}/".format(server.server_port), timeout=5)
+        finally:
+            server.shutdown()
+        assert not wait_for_server(
+            "http://127.0.0.1:{}/".format(server.server_port), timeout=0.2)
+
+    def test_source_files(self):
+        from dallinger.command_line import source_files
+        for name in ["experiment.py", "experiment.pyc", "server.log",
+                     os.path.join("templates", "ad.html"),
+                     os.path.join("snapshots", "id-code.zip")]:
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+        assert sorted(source_files(self.directory)) == \
+            ["experiment.py", os.path.join("templates", "ad.html")]
+
+
+class TestExportImport(object):
+
+    def setup(self):
+        from dallinger import db, models
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        network = models.Network()
+        self.db.add(network)
+        self.db.commit()
+        self.db.add_all([models.Node(network=network) for _ in range(2)])
+        self.db.commit()
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        from dallinger import db
+        self.db.rollback()
+        self.db.close()
+        db.init_db(drop_all=True)
+        shutil.rmtree(self.directory)
+
+    def test_export_and_import(self):
+        # The commands run in their own processes, which have not imported
+        # the models.
+        subprocess.check_call(
+            ["dallinger", "export", "--local", "--app", "test"],
+            cwd=self.directory)
+        path = os.path.join(self.directory, "data", "test-data.zip")
+        assert os.path.exists(path)
+        subprocess.check_call(
+            ["dallinger", "import", "--app", "test"], cwd=self.directory)
+        from dallinger import models
+        self.db.remove()
+        assert models.Node.query.count() == 2
+
+
+class TestMonitor(object):
+
+    def test_format_summary(self):
+        from dallinger.command_line import format_summary
+        summary = {
+            "time": "2017-01-01T12:00:00",
+            "summary": [["approved", 3], ["working", 2]],
+            "networks": [
+                {"id": 1, "role": "default", "max_size": 2, "full": True,
+                 "size": 2},
+                {"id": 2, "role": "default", "max_size": 2, "full": False,
+                 "size": 1},
+            ],
+            "throughput": {"approved": 3, "returned": 1},
+            "completed_per_hour": 3,
+            "notifications": {"received": 5, "pending": 0,
+                              "queued": {"high": 0, "default": 1, "low": 2}},
+        }
+        jobs = {"step": {"runs": 4, "failures": 0, "last_duration": 0.1}}
+        assert format_summary(summary, jobs) == [
+            "2017-01-01T12:00:00",
+            "participants: approved 3, working 2",
+            "networks: 1 of 2 full, 3 of 4 places filled",
+            "throughput: 3 completed in the last hour "
+            "(approved 3, returned 1)",
+            "queues: default 1, high 0, low 2, pending 0",
+            "job step: 4 runs, 0 failures, 0 skipped, last took 0.1s",
+        ]
@@ -0,0 +1,86 @@
+"""Tests of the experiment server's notification processing."""
+
+import os
+import sys
+
+from dallinger import db, models
+from dallinger.db import QueryBudget
+
+
+class TestNotifications(object):
+    """The experiment server's module, custom, for the bartlett1932 demo."""
+
+    @classmethod
+    def setup_class(cls):
+        from dallinger.command_line import setup_experiment
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+        (id, tmp) = setup_experiment(debug=True, verbose=False)
+        os.chdir(tmp)
+        sys.path.insert(0, tmp)
+
+    @classmethod
+    def teardown_class(cls):
+        sys.path.pop(0)
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def participant(self, worker_id, assignment_id):
+        participant = models.Participant(worker_id=worker_id,
+                                         assignment_id=assignment_id,
+                                         hit_id="h1", mode="debug")
+        self.db.add(participant)
+        self.db.commit()
+        return participant
+
+    def test_notification_batch(self):
+        import custom
+        self.participant("w1", "a1")
+        self.participant("w2", "a2")
+        custom.experiment(db.session)
+        db.session.commit()
+        events = [("AssignmentReturned", "a1"),
+                  ("AssignmentReturned", "a1"),
+                  ("AssignmentAbandoned", "a2")]
+        with QueryBudget(max_commits=1):
+            custom.process_notification_batch(events)
+        assert models.Notification.query.count() == 3
+        statuses = dict(models.Participant.query
+                        .with_entities(models.Participant.assignment_id,
+                                       models.Participant.status))
+        assert statuses == {"a1": "returned", "a2": "abandoned"}
+
+    def test_notification_for_oldest_working_participant(self):
+        import custom
+        self.participant("w1", "a1")
+        self.participant("w2", "a1")
+        participants = models.Participant.query.order_by("id").all()
+        chosen = custom.select_participant(participants, "AssignmentReturned")
+        assert chosen.worker_id == "w1"
+        chosen = custom.select_participant(participants, "AssignmentSubmitted")
+        assert chosen.worker_id == "w2"
+
+    def test_enqueue_notification(self):
+        import custom
+        received = int(custom.conn.get(custom.NOTIFICATIONS_RECEIVED) or 0)
+        queued = custom.low_q.count
+        job = custom.enqueue_notification("AssignmentReturned", "a1")
+        try:
+            assert custom.low_q.count == queued + 1
+            assert job.args == ("AssignmentReturned", "a1", None)
+            assert int(custom.conn.get(custom.NOTIFICATIONS_RECEIVED)) == \
+                received + 1
+        finally:
+            custom.low_q.remove(job)
+
+    def test_notification_priorities(self):
+        import custom
+        assert custom.notification_queue("AssignmentSubmitted").name == "high"
+        assert custom.notification_queue("AssignmentReturned").name == "low"
+        assert custom.notification_queue("Unknown").name == "default"
@@ -0,0 +1,283 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import raises
+
+from dallinger import data, db, models
+
+
+class TestExport(object):
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        network = models.Network()
+        self.db.add(network)
+        self.db.commit()
+        for _ in range(3):
+            self.db.add(models.Node(network=network))
+        self.db.commit()
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_column_types(self):
+        columns = dict((c["name"], c["type"])
+                       for c in data.table_columns("node"))
+        assert columns["id"] == "integer"
+        assert columns["creation_time"] == "timestamp"
+        assert columns["failed"] == "boolean"
+        assert columns["property1"] == "string"
+        assert dict((c["name"], c["type"])
+                    for c in data.table_columns("info"))["contents"] == \
+            "string"
+
+    def test_csv_export(self):
+        manifest = data.export_data(self.directory, tables=["node", "network"])
+        entries = dict((t["table"], t) for t in manifest["runs"][0]["tables"])
+        assert entries["node"]["rows"] == 3
+        assert entries["network"]["rows"] == 1
+        with open(os.path.join(self.directory, "node.csv")) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 3
+        assert rows[0]["failed"] == "f"
+        with open(os.path.join(self.directory, "network.csv")) as f:
+            assert list(csv.DictReader(f))[0]["full"] == "f"
+        with open(os.path.join(self.directory, data.MANIFEST)) as f:
+            assert json.load(f)["format"] == "csv"
+
+    def test_compressed_csv_export(self):
+        manifest = data.export_data(self.directory, fmt="csv.gz", jobs=1)
+        assert len(manifest["runs"][0]["tables"]) == len(data.TABLES)
+        with gzip.open(os.path.join(self.directory, "node.csv.gz")) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 3
+
+    def read(self, filename):
+        with open(os.path.join(self.directory, filename)) as f:
+            return list(csv.DictReader(f))
+
+    def test_incremental_export(self):
+        tables = ["node", "participant"]
+        overlap = data.EXPORT_OVERLAP
+        data.EXPORT_OVERLAP = 0
+        try:
+            self.check_incremental_export(tables)
+        finally:
+            data.EXPORT_OVERLAP = overlap
+
+    def check_incremental_export(self, tables):
+        data.export_data(self.directory, tables=tables, incremental=True)
+        assert len(self.read("node.csv")) == 3
+
+        node = models.Node.query.order_by(models.Node.id).first()
+        node.fail()
+        self.db.add(models.Node(network=node.network))
+        self.db.commit()
+        manifest = data.export_data(self.directory, tables=tables,
+                                    incremental=True)
+        run = manifest["runs"][1]
+        entries = dict((t["table"], t) for t in run["tables"])
+        assert entries["node"]["file"] == "node.0001.csv"
+        assert entries["node"]["mode"] == "delta"
+        assert entries["participant"]["mode"] == "full"
+        delta = self.read("node.0001.csv")
+        assert len(delta) == 2
+        assert [r["failed"] for r in delta if r["id"] == str(node.id)] == ["t"]
+        assert run["watermarks"]["node"]["time_of_death"] is not None
+
+        manifest = data.export_data(self.directory, tables=tables,
+                                    incremental=True)
+        entries = dict((t["table"], t) for t in manifest["runs"][2]["tables"])
+        assert entries["node"]["rows"] == 0
+
+    def test_incremental_export_finds_late_commits(self):
+        # A node inserted by a transaction that commits after an export,
+        # with a lower id than a node that was exported.
+        network = models.Network.query.one()
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        connection.execute(models.Node.__table__.insert().values(
+            network_id=network.id, type="node"))
+        self.db.add(models.Node(network=network))
+        self.db.commit()
+        data.export_data(self.directory, tables=["node"], incremental=True)
+        assert len(self.read("node.csv")) == 4
+        transaction.commit()
+        connection.close()
+
+        data.export_data(self.directory, tables=["node"], incremental=True)
+        ids = set(int(r["id"]) for r in self.read("node.csv"))
+        late = set(int(r["id"]) for r in self.read("node.0001.csv")) - ids
+        assert len(late) == 1
+        assert late.pop() < max(ids)
+
+    def test_interrupted_export_resumes(self):
+        data.export_data(self.directory, tables=["node"], incremental=True)
+        manifest = data.load_manifest(self.directory)
+        manifest["runs"][0]["complete"] = False
+        data.write_manifest(self.directory, manifest)
+        os.remove(os.path.join(self.directory, "node.csv"))
+
+        manifest = data.export_data(self.directory, tables=["node", "vector"],
+                                    incremental=True)
+        assert len(manifest["runs"]) == 1
+        assert manifest["runs"][0]["complete"]
+        assert [t["table"] for t in manifest["runs"][0]["tables"]] == \
+            ["node", "vector"]
+        assert not os.path.exists(os.path.join(self.directory, "node.csv"))
+
+    @raises(ValueError)
+    def test_incremental_export_needs_same_format(self):
+        data.export_data(self.directory, tables=["node"], incremental=True)
+        data.export_data(self.directory, fmt="csv.gz", tables=["node"],
+                         incremental=True)
+
+    @raises(ValueError)
+    def test_unknown_format(self):
+        data.export_data(self.directory, fmt="xlsx")
+
+
+class TestLoad(object):
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        networks = [models.Network(), models.Network()]
+        self.db.add_all(networks)
+        self.db.commit()
+        for network in networks:
+            node = models.Node(network=network)
+            self.db.add(node)
+            self.db.commit()
+            for i in range(3):
+                self.db.add(models.Info(origin=node, contents=str(i)))
+        self.db.commit()
+        self.network_id = networks[1].id
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_read_with_projection_and_filters(self):
+        data.export_data(os.path.join(self.directory, "data"))
+        export = data.load(self.directory)
+        assert "info" in export.tables
+        infos = export.info.read(
+            columns=["id", "contents", "creation_time", "failed"],
+            filters=[("network_id", "=", self.network_id),
+                     ("contents", "in", ["0", "1"])])
+        assert list(infos.columns) == \
+            ["id", "contents", "creation_time", "failed"]
+        assert len(infos) == 2
+        assert list(infos["contents"]) == ["0", "1"]
+        assert infos["failed"].dtype == bool
+        assert str(infos["creation_time"].dtype).startswith("datetime64")
+        records = export["info"].to_numpy(columns=["id", "network_id"])
+        assert len(records) == 6
+        assert records.dtype.names == ("id", "network_id")
+
+    def test_read_zipped_compressed_export(self):
+        data.export_data(os.path.join(self.directory, "export", "data"),
+                         fmt="csv.gz")
+        archive = shutil.make_archive(
+            os.path.join(self.directory, "export"), "zip",
+            os.path.join(self.directory, "export"))
+        export = data.load(archive, cache_dir=self.directory)
+        assert len(export.node.read()) == 2
+
+    def test_read_incremental_export(self):
+        directory = os.path.join(self.directory, "data")
+        data.export_data(directory, incremental=True)
+        info = models.Info.query.order_by(models.Info.id).first()
+        info.fail()
+        self.db.commit()
+        data.export_data(directory, incremental=True)
+        infos = data.load(directory).info.read(columns=["id", "failed"])
+        assert len(infos) == 6
+        assert list(infos["id"]) == sorted(infos["id"])
+        assert infos[infos["id"] == info.id]["failed"].iloc[0]
+
+    @raises(ValueError)
+    def test_unknown_column(self):
+        data.export_data(os.path.join(self.directory, "data"),
+                         tables=["node"])
+        data.load(self.directory).node.read(columns=["colour"])
+
+
+class TestImport(object):
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        network = models.Network()
+        self.db.add(network)
+        self.db.commit()
+        nodes = [models.Node(network=network) for _ in range(3)]
+        self.db.add_all(nodes)
+        self.db.commit()
+        nodes[0].connect(whom=nodes[1])
+        self.db.commit()
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+        db.init_db(drop_all=True)
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        data.export_data(self.directory, fmt="csv.gz")
+        db.init_db(drop_all=True)
+        rows = data.import_data(self.directory)
+        assert rows["node"] == 3
+        assert rows["vector"] == 1
+        self.db.remove()
+        assert models.Node.query.count() == 3
+        assert models.Network.query.one().full is False
+        assert models.Vector.query.one().origin_id == \
+            models.Node.query.order_by(models.Node.id).first().id
+
+        # The sequences continue after the imported ids.
+        node = models.Node(network=models.Network.query.one())
+        self.db.add(node)
+        self.db.commit()
+        assert node.id == 4
+
+    def test_indexes_and_foreign_keys_are_restored(self):
+        data.export_data(self.directory)
+        data.import_data(self.directory)
+        indexes = [row[0] for row in db.engine.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'node'")]
+        assert "ix_node_network_id" in indexes
+        keys = db.engine.execute(
+            "SELECT count(*) FROM information_schema.table_constraints "
+            "WHERE table_name = 'node' AND constraint_type = 'FOREIGN KEY'")
+        assert keys.scalar() > 0
+
+    def test_indexes_of_tables_not_exported_are_restored(self):
+        data.export_data(self.directory, tables=["network", "node"])
+        data.import_data(self.directory)
+        indexes = [row[0] for row in db.engine.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'info'")]
+        assert "ix_info_origin_id" in indexes
+
+    def test_incremental_export(self):
+        data.export_data(self.directory, incremental=True)
+        node = models.Node.query.order_by(models.Node.id).first()
+        node.fail()
+        self.db.commit()
+        data.export_data(self.directory, incremental=True)
+        rows = data.import_data(self.directory)
+        assert rows["node"] == 3
+        self.db.remove()
+        assert models.Node.query.filter_by(failed=True).count() == 1
@@ -0,0 +1,67 @@
+"""Tests of bulk mode, which creates many objects quickly."""
+
+from dallinger import db, models, networks, nodes
+from dallinger.db import QueryBudget
+
+
+class TestBulkMode(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+        self.net = networks.Empty(max_size=3)
+        self.db.add(self.net)
+        self.db.commit()
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def test_ids_are_assigned_before_writing(self):
+        with db.bulk_mode():
+            agents = [nodes.Agent(network=self.net) for _ in range(3)]
+            info = models.Info(origin=agents[0])
+            assert None not in [agent.id for agent in agents]
+            assert info.origin_id == agents[0].id
+            assert models.Node.query.count() == 0
+        assert models.Node.query.count() == 3
+        assert models.Info.query.one().origin_id == agents[0].id
+
+    def test_one_insert_per_table(self):
+        with QueryBudget() as queries:
+            with db.bulk_mode():
+                agents = [nodes.Agent(network=self.net) for _ in range(3)]
+                models.Vector(origin=agents[0], destination=agents[1])
+                models.Vector(origin=agents[1], destination=agents[2])
+        inserts = [s for s in queries.statements if s.startswith("INSERT")]
+        assert len(inserts) == 2
+        assert models.Vector.query.count() == 2
+
+    def test_writes_every_batch_size_objects(self):
+        with db.bulk_mode(batch_size=2):
+            for _ in range(5):
+                nodes.Agent(network=self.net)
+            assert models.Node.query.count() == 4
+        assert models.Node.query.count() == 5
+
+    def test_full_is_recalculated(self):
+        with db.bulk_mode():
+            for _ in range(3):
+                nodes.Agent(network=self.net)
+        assert self.net.full
+
+    def test_full_as_nodes_are_added(self):
+        with db.bulk_mode(batch_size=2):
+            for _ in range(3):
+                assert not self.net.full
+                nodes.Agent(network=self.net)
+            assert self.net.full
+
+    def test_nothing_is_written_after_an_error(self):
+        try:
+            with db.bulk_mode():
+                nodes.Agent(network=self.net)
+                raise ValueError()
+        except ValueError:
+            self.db.rollback()
+        assert models.Node.query.count() == 0
+        assert self.db.autoflush
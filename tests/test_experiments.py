@@ -0,0 +1,323 @@
+import os
+import threading
+
+from dallinger import db, jobs, models, networks, nodes
+from dallinger.experiments import Experiment, NETWORK_LOCK_METRICS
+
+
+class TestNetworkAssignment(object):
+
+    @classmethod
+    def setup_class(cls):
+        # The recruiters load psiTurk, which needs an experiment's config.txt.
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+
+    @classmethod
+    def teardown_class(cls):
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        self.exp = Experiment(self.db)
+        self.exp.verbose = False
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def add_networks(self, n, role="experiment", max_size=2):
+        nets = [networks.Empty(max_size=max_size) for _ in range(n)]
+        for net in nets:
+            net.role = role
+        self.db.add_all(nets)
+        self.db.commit()
+        return nets
+
+    def participant(self, worker_id="w"):
+        p = models.Participant(worker_id=worker_id, assignment_id=worker_id,
+                               hit_id="h", mode="debug")
+        self.db.add(p)
+        self.db.commit()
+        return p
+
+    def join(self, participant, exp=None):
+        exp = exp or self.exp
+        net = exp.get_network_for_participant(participant)
+        if net is not None:
+            nodes.Agent(network=net, participant=participant)
+        return net
+
+    def test_practice_networks_come_first_in_order(self):
+        self.exp.practice_repeats = 2
+        experiment = self.add_networks(3)
+        practice = self.add_networks(2, role="practice")
+        p = self.participant()
+        assert self.join(p) == practice[0]
+        assert self.join(p) == practice[1]
+        assert self.join(p) in experiment
+
+    def test_never_assigned_twice_to_a_network(self):
+        nets = self.add_networks(3)
+        p = self.participant()
+        joined = [self.join(p) for _ in range(3)]
+        assert sorted(n.id for n in joined) == sorted(n.id for n in nets)
+        assert self.join(p) is None
+
+    def test_full_networks_are_skipped(self):
+        self.add_networks(2, max_size=1)
+        full = self.join(self.participant("a"))
+        self.db.commit()
+        assert full.full
+        assert self.join(self.participant("b")) != full
+        assert self.join(self.participant("c")) is None
+
+    def test_no_networks(self):
+        assert self.exp.get_network_for_participant(self.participant()) is None
+
+    def in_thread(self, worker_id):
+        """Join from another thread (and so another session)."""
+        result = {}
+
+        def run():
+            session = db.session()
+            try:
+                p = models.Participant.query.filter_by(
+                    worker_id=worker_id).one()
+                net = self.join(p, exp=Experiment(session))
+                result["network_id"] = net.id if net else None
+                session.commit()
+            finally:
+                db.session.remove()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    def test_locked_networks_are_skipped(self):
+        first, second = self.add_networks(2)
+        self.participant("b")
+        reserved = self.join(self.participant("a"))
+
+        thread, result = self.in_thread("b")
+        thread.join(5)
+        assert not thread.is_alive()
+        assert result["network_id"] != reserved.id
+        self.db.commit()
+
+    def test_last_place_is_not_taken_twice(self):
+        self.add_networks(1, max_size=1)
+        self.participant("b")
+        assert self.join(self.participant("a")) is not None
+
+        thread, result = self.in_thread("b")
+        thread.join(0.5)
+        # The other join waits for this transaction to end...
+        assert thread.is_alive()
+        self.db.commit()
+        thread.join(5)
+        # ...and then finds the network full.
+        assert result["network_id"] is None
+        assert models.Node.query.count() == 1
+
+    def test_waiting_for_a_locked_network_times_out(self):
+        self.add_networks(1)
+        self.participant("b")
+        assert self.join(self.participant("a")) is not None
+        result = {}
+
+        def run():
+            session = db.session()
+            try:
+                exp = Experiment(session)
+                exp.network_lock_timeout = 0.2
+                p = models.Participant.query.filter_by(worker_id="b").one()
+                exp.get_network_for_participant(p)
+            except Exception as e:
+                result["error"] = e
+            finally:
+                session.rollback()
+                db.session.remove()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        assert "lock timeout" in str(result["error"])
+
+    def test_assignment_scans_only_open_networks(self):
+        self.add_networks(20)
+        p = self.participant()
+        with db.QueryBudget(explain=True) as queries:
+            self.exp.get_network_for_participant(p)
+        queries.assert_no_seq_scan("network")
+
+
+class TestNetworkLocks(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+
+    @classmethod
+    def teardown_class(cls):
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        self.nets = [networks.Chain(), networks.Chain()]
+        self.db.add_all(self.nets)
+        self.db.commit()
+        self.exp = Experiment(self.db)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def lock_in_thread(self, network_id, timeout=10):
+        """Take the lock on a network from another session."""
+        result = {}
+
+        def run():
+            try:
+                exp = Experiment(db.session())
+                exp.network_lock_timeout = timeout
+                net = models.Network.query.get(network_id)
+                result["waited"] = exp.lock_network(net)
+            except Exception as e:
+                result["error"] = e
+            finally:
+                db.session.remove()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    def test_lock_resets_lock_timeout(self):
+        self.exp.lock_network(self.nets[0])
+        timeout = self.db.execute("SHOW lock_timeout").scalar()
+        assert timeout == "0"
+
+    def test_lock_restores_lock_timeout(self):
+        self.db.execute("SET LOCAL lock_timeout = '5s'")
+        self.exp.lock_network(self.nets[0])
+        timeout = self.db.execute("SHOW lock_timeout").scalar()
+        assert timeout == "5s"
+
+    def test_lock_is_taken_once_per_transaction(self):
+        self.exp.lock_network(self.nets[0])
+        with db.QueryBudget(0):
+            self.exp.lock_network(self.nets[0])
+        self.db.commit()
+        with db.QueryBudget(3):
+            self.exp.lock_network(self.nets[0])
+
+    def test_locks_are_counted(self):
+        conn = jobs.redis_connection()
+        conn.delete(NETWORK_LOCK_METRICS)
+        self.exp.lock_network(self.nets[0])
+        self.exp.lock_network(self.nets[0])
+        thread, result = self.lock_in_thread(self.nets[0].id, timeout=0.2)
+        thread.join(5)
+        metrics = conn.hgetall(NETWORK_LOCK_METRICS)
+        assert metrics["locks"] == "1"
+        assert metrics["timeouts"] == "1"
+
+    def test_same_network_waits_for_commit(self):
+        self.exp.lock_network(self.nets[0])
+        thread, result = self.lock_in_thread(self.nets[0].id)
+        thread.join(0.3)
+        assert thread.is_alive()
+        self.db.commit()
+        thread.join(5)
+        assert result["waited"] >= 0.2
+
+    def test_other_networks_proceed(self):
+        self.exp.lock_network(self.nets[0])
+        thread, result = self.lock_in_thread(self.nets[1].id)
+        thread.join(5)
+        assert not thread.is_alive()
+        assert result["waited"] < 0.3
+
+    def test_lock_times_out(self):
+        self.exp.lock_network(self.nets[0])
+        thread, result = self.lock_in_thread(self.nets[0].id, timeout=0.2)
+        thread.join(5)
+        assert "lock timeout" in str(result["error"])
+
+    def test_add_node_to_network_takes_lock(self):
+        node = nodes.Agent(network=self.nets[0])
+        self.exp.add_node_to_network(node, self.nets[0])
+        thread, result = self.lock_in_thread(self.nets[0].id, timeout=0.2)
+        thread.join(5)
+        assert "error" in result
+
+
+class TestSummary(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+
+    @classmethod
+    def teardown_class(cls):
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        self.exp = Experiment(self.db)
+        self.exp.verbose = False
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def participant(self, status, end_time=None):
+        p = models.Participant(worker_id="w", assignment_id="a", hit_id="h",
+                               mode="debug")
+        p.status = status
+        p.end_time = end_time
+        self.db.add(p)
+        self.db.commit()
+        return p
+
+    def test_log_summary_counts_statuses(self):
+        for status in ["working", "approved", "working", "returned"]:
+            self.participant(status)
+        assert self.exp.log_summary() == [
+            ("approved", 1), ("returned", 1), ("working", 2)]
+
+    def test_network_summary(self):
+        full = networks.Empty(max_size=1)
+        empty = networks.Empty(max_size=3)
+        failed = networks.Empty(max_size=2)
+        self.db.add_all([full, empty, failed])
+        self.db.commit()
+        nodes.Agent(network=full)
+        nodes.Agent(network=empty).fail()
+        failed.fail()
+        full.calculate_full()
+        self.db.commit()
+        assert self.exp.network_summary() == [
+            {"id": full.id, "role": "default", "max_size": 1, "full": True,
+             "size": 1},
+            {"id": empty.id, "role": "default", "max_size": 3,
+             "full": False, "size": 0},
+        ]
+
+    def test_throughput_counts_recent_finishes(self):
+        from datetime import datetime, timedelta
+        now = datetime.now()
+        self.participant("approved", now - timedelta(minutes=5))
+        self.participant("approved", now - timedelta(minutes=50))
+        self.participant("returned", now - timedelta(minutes=10))
+        self.participant("approved", now - timedelta(hours=2))
+        self.participant("working")
+        assert self.exp.throughput(hours=1) == {"approved": 2, "returned": 1}
@@ -0,0 +1,85 @@
+import json
+
+from boto.mturk.connection import MTurkRequestError
+from nose.tools import assert_raises
+
+from dallinger import fakemturk
+
+
+class TestFakeMTurk(object):
+
+    def test_assignments_follow_hit(self):
+        fake = fakemturk.FakeMTurk()
+        hit_id = fake.call("create_hit", max_assignments=2)
+        fake.call("extend_hit", hit_id=hit_id, assignments_increment=3)
+        assert fake.get_hit(hit_id)["assignments"] == 5
+        assert len(fake.assignments) == 5
+        assert fake.calls["create_hit"] == 1
+        assert fake.calls["extend_hit"] == 1
+
+    def test_approval_and_bonus(self):
+        fake = fakemturk.FakeMTurk()
+        hit_id = fake.create_hit(max_assignments=1)
+        assignment_id = list(fake.assignments)[0]
+        with assert_raises(MTurkRequestError):
+            fake.approve_assignment(assignment_id)
+
+        assignment = fake.get(assignment_id)
+        assignment["status"] = "Submitted"
+        assignment["finished"] = assignment["opened"]
+        fake.approve_assignment(assignment_id)
+        described = fake.get_assignment(assignment_id)
+        assert described["AssignmentStatus"] == "Approved"
+        assert described["HITId"] == hit_id
+        fake.grant_bonus(described["WorkerId"], assignment_id, "1.50", "Hi")
+        assert fake.bonuses == [(assignment_id, 1.5, "Hi")]
+
+        report = fake.report()
+        assert report["assignments"] == {"Approved": 1}
+        assert report["approval_delay"]["requests"] == 1
+
+    def test_unknown_ids(self):
+        fake = fakemturk.FakeMTurk()
+        with assert_raises(MTurkRequestError):
+            fake.get_assignment("missing")
+        with assert_raises(MTurkRequestError):
+            fake.extend_hit("missing", assignments_increment=1)
+        with assert_raises(ValueError):
+            fake.call("delete_everything")
+
+    def test_injected_errors(self):
+        fake = fakemturk.FakeMTurk(error_rate=0.5, seed=1)
+        failures = 0
+        for _ in range(100):
+            try:
+                fake.call("create_hit")
+            except MTurkRequestError as e:
+                assert e.status == 503
+                failures += 1
+        assert 25 < failures < 75
+        assert fake.errors["create_hit"] == failures
+        assert fake.calls["create_hit"] == 100
+
+    def test_services_report_failures(self):
+        fake = fakemturk.FakeMTurk()
+        app = fakemturk.create_app(fake).test_client()
+
+        class Connection(fakemturk.FakeMTurkConnection):
+
+            def _call(self, operation, **kwargs):
+                response = app.post("/" + operation,
+                                    data=json.dumps(kwargs))
+                body = json.loads(response.data)
+                if response.status_code != 200:
+                    raise MTurkRequestError(body["status"], body["reason"])
+                return body["result"]
+
+        services = fakemturk.FakeMTurkServices(Connection("http://fake"))
+        hit_id = services.mtc.create_hit(max_assignments=1)
+        assert hit_id in fake.hits
+        assignment_id = list(fake.assignments)[0]
+        assert not services.approve_worker(assignment_id)
+        fake.get(assignment_id)["status"] = "Submitted"
+        assert services.approve_worker(assignment_id)
+        assert services.bonus_worker(assignment_id, 2.0, "Thanks")
+        assert len(fake.bonuses) == 1
@@ -0,0 +1,130 @@
+import os
+
+from nose.tools import raises
+
+from dallinger import db, jobs, models
+from dallinger.experiments import Experiment
+
+
+class JobExperiment(Experiment):
+
+    def __init__(self, session):
+        super(JobExperiment, self).__init__(session)
+        self.periodic_jobs = {"add_network": 1, "fail": 1}
+        self.debounced_jobs = {"add_network"}
+
+    def add_network(self):
+        self.session.add(models.Network())
+
+    def fail(self):
+        raise ValueError("Job failed")
+
+
+class TestJobs(object):
+
+    @classmethod
+    def setup_class(cls):
+        # The recruiters load psiTurk, which needs an experiment's config.txt.
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+
+    @classmethod
+    def teardown_class(cls):
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        db.session.remove()
+        self.db = db.init_db(drop_all=True)
+        self.conn = jobs.redis_connection()
+        for name in ["add_network", "fail"]:
+            self.conn.delete(jobs.JOB_LOCK.format(name),
+                             jobs.JOB_REQUESTED.format(name),
+                             jobs.JOB_METRICS.format(name))
+        self.conn.delete(jobs.CLOCK_RUNNING, jobs.DELAYED_JOBS)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def test_debounced_job_runs_once_when_requested(self):
+        assert jobs.run_job(JobExperiment, "add_network",
+                            debounced=True) == "skipped"
+        jobs.heartbeat()
+        exp = JobExperiment(self.db)
+        exp.request_job("add_network")
+        exp.request_job("add_network")
+        assert jobs.run_job(JobExperiment, "add_network",
+                            debounced=True) == "ran"
+        assert jobs.run_job(JobExperiment, "add_network",
+                            debounced=True) == "skipped"
+        assert models.Network.query.count() == 1
+
+    def test_requested_job_runs_at_once_without_a_clock(self):
+        assert not jobs.clock_running()
+        JobExperiment(self.db).request_job("add_network")
+        assert models.Network.query.count() == 1
+        assert not self.conn.exists(jobs.JOB_REQUESTED.format("add_network"))
+
+    def test_failed_debounced_job_is_requested_again(self):
+        jobs.request_job("fail")
+        assert jobs.run_job(JobExperiment, "fail", debounced=True) == "failed"
+        assert self.conn.exists(jobs.JOB_REQUESTED.format("fail"))
+
+    def test_delayed_job_is_queued_by_the_clock_when_due(self):
+        from rq import Queue
+        queue = Queue("test_delayed", connection=self.conn)
+        queue.empty()
+        jobs.heartbeat()
+        try:
+            soon = jobs.enqueue_in(queue, 0, len, "soon")
+            later = jobs.enqueue_in(queue, 60, len, "later")
+            assert queue.count == 0
+            assert jobs.enqueue_due_jobs() == 1
+            assert queue.job_ids == [soon.id]
+            assert self.conn.zscore(jobs.DELAYED_JOBS, later.id)
+        finally:
+            queue.empty()
+
+    def test_delayed_job_is_queued_at_once_without_a_clock(self):
+        from rq import Queue
+        queue = Queue("test_delayed", connection=self.conn)
+        queue.empty()
+        try:
+            job = jobs.enqueue_in(queue, 60, len, "now")
+            assert queue.job_ids == [job.id]
+        finally:
+            queue.empty()
+
+    def test_running_job_is_not_overlapped(self):
+        self.conn.set(jobs.JOB_LOCK.format("add_network"), "another run")
+        assert jobs.run_job(JobExperiment, "add_network") == "skipped"
+        assert models.Network.query.count() == 0
+        metrics = jobs.job_metrics(["add_network"])["add_network"]
+        assert metrics["skipped"] == 1
+        assert metrics["running"]
+
+    def test_metrics(self):
+        jobs.run_job(JobExperiment, "add_network")
+        assert jobs.run_job(JobExperiment, "fail") == "failed"
+        metrics = jobs.job_metrics(["add_network", "fail"])
+        assert metrics["add_network"]["runs"] == 1
+        assert metrics["add_network"]["failures"] == 0
+        assert metrics["add_network"]["mean_duration"] >= 0
+        assert metrics["fail"]["failures"] == 1
+        assert not metrics["fail"]["running"]
+
+    def test_schedule_jobs(self):
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
+        assert jobs.schedule_jobs(scheduler, JobExperiment) == \
+            ["add_network", "fail"]
+        job = scheduler.get_job("add_network")
+        assert job.kwargs["debounced"]
+        assert job.max_instances == 1
+        assert scheduler.get_job("heartbeat")
+        assert scheduler.get_job("delayed_jobs")
+        assert jobs.clock_running()
+
+    @raises(ValueError)
+    def test_request_unknown_job(self):
+        JobExperiment(self.db).request_job("fail")
@@ -0,0 +1,86 @@
+import os
+import sys
+
+from dallinger import db, loadtest
+
+
+class TestStats(object):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert loadtest.percentile(values, 50) == 50
+        assert loadtest.percentile(values, 99) == 99
+        assert loadtest.percentile(values, 100) == 100
+        assert loadtest.percentile([3], 90) == 3
+        assert loadtest.percentile([], 50) is None
+
+    def test_report(self):
+        stats = loadtest.Stats()
+        stats.record("GET /a", 0.010, True)
+        stats.record("GET /a", 0.030, False)
+        stats.record("POST /b", 0.020, True)
+        stats.bot_done(True)
+        stats.stop()
+        report = stats.report()
+        assert report["overall"]["requests"] == 3
+        assert report["overall"]["errors"] == 1
+        assert report["overall"]["bots_finished"] == 1
+        assert report["routes"]["GET /a"]["error_rate"] == 0.5
+        assert round(report["routes"]["GET /a"]["max_ms"]) == 30
+        assert report["routes"]["POST /b"]["errors"] == 0
+
+    def test_pool_monitor(self):
+        monitor = loadtest.PoolMonitor(interval=0.01)
+        monitor.start()
+        connection = db.engine.connect()
+        try:
+            connection.execute("select pg_sleep(0.05)")
+        finally:
+            connection.close()
+        monitor.stop()
+        report = monitor.report()
+        assert report["samples"] > 0
+        assert report["peak_checked_out"] >= 1
+        assert report["capacity"] >= 1000
+
+
+class TestSwarm(object):
+
+    @classmethod
+    def setup_class(cls):
+        from dallinger.command_line import setup_experiment
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+        (id, tmp) = setup_experiment(debug=True, verbose=False)
+        os.chdir(tmp)
+        sys.path.insert(0, tmp)
+        from psiturk.experiment import app
+        cls.server = loadtest.serve(app)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        sys.path.pop(0)
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        from psiturk.db import Base, engine, init_db
+        db.session.remove()
+        db.init_db(drop_all=True)
+        Base.metadata.drop_all(bind=engine)
+        init_db()
+
+    def test_bartlett_swarm(self):
+        report = loadtest.swarm(
+            "http://127.0.0.1:{}".format(self.server.server_port),
+            loadtest.BartlettBot,
+            n=3,
+            monitor=loadtest.PoolMonitor())
+        overall = report["overall"]
+        assert overall["bots_finished"] + overall["bots_failed"] == 3
+        routes = report["routes"]
+        assert routes["POST /participant"]["requests"] == 3
+        assert routes["POST /participant"]["errors"] == 0
+        assert routes["POST /node"]["requests"] >= 3
+        assert report["db_pool"]["samples"] > 0
+        assert overall["throughput_rps"] > 0
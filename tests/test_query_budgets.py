@@ -0,0 +1,456 @@
+"""Query budgets for the core operations and the experiment server routes."""
+
+from json import loads
+import os
+import sys
+
+from nose.tools import raises
+
+from dallinger import db, models, networks, nodes
+from dallinger.db import QueryBudget, QueryBudgetExceeded
+from tests.benchmarks import GenerationalAgent
+
+
+class TestQueryBudget(object):
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def test_counts_statements(self):
+        net = models.Network()
+        self.db.add(net)
+        self.db.commit()
+        net_id = net.id
+        with QueryBudget() as queries:
+            models.Node.query.filter_by(network_id=net_id).all()
+            models.Vector.query.filter_by(network_id=net_id).all()
+        assert queries.count == 2
+
+    @raises(QueryBudgetExceeded)
+    def test_budget_exceeded(self):
+        net = models.Network()
+        self.db.add(net)
+        self.db.commit()
+        with QueryBudget(max_queries=1):
+            net.nodes()
+            net.vectors()
+
+    @raises(QueryBudgetExceeded)
+    def test_repeated_statement_detected(self):
+        net = models.Network()
+        self.db.add(net)
+        self.db.commit()
+        with QueryBudget(max_repeats=2):
+            for _ in range(3):
+                net.nodes()
+
+    @raises(QueryBudgetExceeded)
+    def test_commits_counted(self):
+        with QueryBudget(max_commits=1) as queries:
+            self.db.add(models.Network())
+            self.db.commit()
+            self.db.add(models.Network())
+            self.db.commit()
+        assert queries.commits == 2
+
+    def test_exception_in_block_is_not_masked(self):
+        try:
+            with QueryBudget(max_queries=0):
+                models.Network.query.all()
+                raise KeyError("boom")
+        except KeyError:
+            pass
+
+    def test_explain_captures_plans(self):
+        net = models.Network()
+        self.db.add(net)
+        self.db.commit()
+        net_id = net.id
+        with QueryBudget(explain=True) as queries:
+            models.Node.query.filter_by(network_id=net_id).all()
+        assert len(queries.plans) == 1
+        queries.assert_no_seq_scan("node")
+
+    @raises(QueryBudgetExceeded)
+    def test_explain_detects_sequential_scan(self):
+        with QueryBudget(explain=True) as queries:
+            models.Node.query.filter_by(property1="unindexed").all()
+        queries.assert_no_seq_scan("node")
+
+
+class TestModelQueryBudgets(object):
+    """Budgets for the primitives used by every experiment.
+
+    Each operation runs against a network that already has some nodes, so
+    that a query issued per neighbour shows up as a repeated statement.
+    """
+
+    size = 5
+
+    def setup(self):
+        self.db = db.init_db(drop_all=True)
+
+    def teardown(self):
+        self.db.rollback()
+        self.db.close()
+
+    def populate(self, net, node_type=nodes.Agent, source=False):
+        self.db.add(net)
+        self.db.commit()
+        if source:
+            nodes.RandomBinaryStringSource(network=net)
+        for _ in range(self.size):
+            node = node_type(network=net)
+            node.fitness = 1.0
+            net.add_node(node)
+        node = node_type(network=net)
+        node.fitness = 1.0
+        self.db.commit()
+        return node
+
+    def assert_add_node_budget(self, net, max_queries, max_repeats=1, **kw):
+        node = self.populate(net, **kw)
+        with QueryBudget(max_queries=max_queries, max_repeats=max_repeats):
+            net.add_node(node)
+            self.db.flush()
+
+    def test_add_node_chain(self):
+        self.assert_add_node_budget(networks.Chain(), 4)
+
+    def test_add_node_empty(self):
+        self.assert_add_node_budget(networks.Empty(), 0)
+
+    def test_add_node_star(self):
+        self.assert_add_node_budget(networks.Star(), 6, max_repeats=2)
+
+    def test_add_node_burst(self):
+        self.assert_add_node_budget(networks.Burst(), 4)
+
+    def test_add_node_sequential_microsociety(self):
+        self.assert_add_node_budget(
+            networks.SequentialMicrosociety(n=3), 6, max_repeats=2)
+
+    def test_add_node_discrete_generational(self):
+        net = networks.DiscreteGenerational(
+            generations=3, generation_size=2, initial_source=True)
+        self.size = 3
+        self.assert_add_node_budget(
+            net, 8, node_type=GenerationalAgent, source=True)
+
+    def test_add_node_fully_connected(self):
+        # Connecting to every other node checks each pair separately.
+        self.assert_add_node_budget(
+            networks.FullyConnected(), 4 * self.size + 2,
+            max_repeats=2 * self.size)
+
+    def test_add_node_scale_free(self):
+        # Preferential attachment reads the degree of every candidate node.
+        self.assert_add_node_budget(
+            networks.ScaleFree(m0=3, m=2), 29, max_repeats=2 * self.size)
+
+    def fully_connected(self):
+        net = networks.FullyConnected()
+        net.add_node(self.populate(net))
+        self.db.commit()
+        return net
+
+    def test_transmit_to_all_neighbors(self):
+        net = self.fully_connected()
+        node = net.nodes()[0]
+        info = models.Info(origin=node, contents="x")
+        self.db.commit()
+        # Each new transmission loads the destination of its vector.
+        with QueryBudget(max_queries=2 * self.size + 1, max_repeats=self.size):
+            node.transmit(what=info, to_whom=nodes.Agent)
+            self.db.flush()
+
+    def test_receive_pending_transmissions(self):
+        net = self.fully_connected()
+        receiver = net.nodes()[0]
+        for sender in net.nodes()[1:]:
+            sender.transmit(what=models.Info(origin=sender), to_whom=receiver)
+        self.db.commit()
+        # Each received transmission loads its info for update().
+        with QueryBudget(max_queries=self.size + 3, max_repeats=self.size):
+            receiver.receive()
+            self.db.flush()
+
+    def test_fail_node(self):
+        net = self.fully_connected()
+        node = net.nodes()[0]
+        node.transmit(what=models.Info(origin=node), to_whom=nodes.Agent)
+        self.db.commit()
+        # Each failed vector looks up its own transmissions.
+        with QueryBudget(max_queries=7 * self.size + 1,
+                         max_repeats=2 * self.size):
+            node.fail()
+            self.db.flush()
+
+
+class TestRouteQueryBudgets(object):
+    """Budgets for the database routes of the experiment server.
+
+    The server runs in process against the bartlett1932 demo. Routes that
+    talk to external services (/launch, /ad_address and /notifications) are
+    not covered.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        from dallinger.command_line import setup_experiment
+        cls.cwd = os.getcwd()
+        os.chdir(os.path.join("demos", "bartlett1932"))
+        (id, tmp) = setup_experiment(debug=True, verbose=False)
+        os.chdir(tmp)
+        sys.path.insert(0, tmp)
+        from psiturk.experiment import app
+        cls.client = app.test_client()
+
+    @classmethod
+    def teardown_class(cls):
+        sys.path.pop(0)
+        os.chdir(cls.cwd)
+
+    def setup(self):
+        from psiturk.db import Base, engine, init_db
+        self.db = db.init_db(drop_all=True)
+        Base.metadata.drop_all(bind=engine)
+        init_db()
+
+    def teardown(self):
+        from psiturk.db import db_session
+        db_session.remove()
+        self.db.rollback()
+        self.db.close()
+
+    def request(self, method, url, max_queries, max_repeats=1, data=None,
+                max_commits=None):
+        with QueryBudget(max_queries=max_queries, max_repeats=max_repeats,
+                         max_commits=max_commits):
+            response = getattr(self.client, method)(url, data=data)
+        assert response.status_code == 200, response.data
+        return response
+
+    def build_experiment(self):
+        """Set up the experiment's networks outside of any measurement."""
+        import custom
+        custom.experiment(db.session)
+        db.session.commit()
+
+    def participant_with_node(self):
+        self.client.post("/participant/w1/h1/a1/debug")
+        self.client.post("/node/1")
+        return 2
+
+    def test_participant_post(self):
+        self.request("post", "/participant/w1/h1/a1/debug", 4)
+
+    def post_participant_mirrored(self, mode):
+        """Post a participant with psiturk_mirror set to mode."""
+        import custom
+        previous = custom.PSITURK_MIRROR
+        custom.PSITURK_MIRROR = mode
+        try:
+            self.client.post("/participant/w1/h1/a1/debug")
+        finally:
+            custom.PSITURK_MIRROR = previous
+
+    def test_participant_post_copies_to_psiturk(self):
+        from psiturk.models import Participant
+        self.post_participant_mirrored("sync")
+        assert Participant.query.filter_by(workerid="w1").count() == 1
+
+    def test_participant_post_defers_psiturk_copy(self):
+        import custom
+        from psiturk.models import Participant
+        queued = custom.low_q.count
+        self.post_participant_mirrored("deferred")
+        assert custom.low_q.count == queued + 1
+        assert Participant.query.filter_by(workerid="w1").count() == 0
+
+    def test_participant_post_without_psiturk_copy(self):
+        import custom
+        from psiturk.models import Participant
+        queued = custom.low_q.count
+        self.post_participant_mirrored("off")
+        assert custom.low_q.count == queued
+        assert Participant.query.filter_by(workerid="w1").count() == 0
+
+    def test_psiturk_copy_is_written_once(self):
+        import custom
+        from psiturk.models import Participant
+        custom.mirror_psiturk_participant("w1", "h1", "a1")
+        custom.mirror_psiturk_participant("w1", "h1", "a1")
+        assert Participant.query.filter_by(workerid="w1").count() == 1
+
+    def test_psiturk_copy_retries(self):
+        import custom
+        from sqlalchemy.exc import SQLAlchemyError
+        write = custom.write_psiturk_participant
+        calls = []
+
+        def flaky(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise SQLAlchemyError()
+            return write(*args)
+
+        custom.write_psiturk_participant = flaky
+        queued = custom.low_q.count
+        try:
+            custom.mirror_psiturk_participant("w1", "h1", "a1", backoff=0)
+            # The retry is a job of its own rather than a sleep.
+            assert len(calls) == 1
+            assert custom.low_q.count == queued + 1
+            retry = custom.low_q.jobs[-1]
+            assert retry.kwargs["attempt"] == 2
+            custom.mirror_psiturk_participant(*retry.args, **retry.kwargs)
+        finally:
+            custom.write_psiturk_participant = write
+        custom.low_q.remove(retry)
+        assert len(calls) == 2
+
+    def test_participant_get(self):
+        self.client.post("/participant/w1/h1/a1/debug")
+        self.request("get", "/participant/1", 1)
+
+    def test_node_post_rolls_back_on_error(self):
+        import custom
+
+        def fail(self, participant, node):
+            raise ValueError()
+
+        self.client.post("/participant/w1/h1/a1/debug")
+        self.build_experiment()
+        custom.experiment.node_post_request = fail
+        try:
+            response = self.client.post("/node/1")
+        finally:
+            del custom.experiment.node_post_request
+        assert response.status_code == 403
+        assert models.Node.query.filter_by(participant_id=1).count() == 0
+        assert models.Transmission.query.count() == 0
+
+    def test_network_get(self):
+        self.participant_with_node()
+        self.request("get", "/network/1", 1)
+
+    def test_summary(self):
+        import custom
+        custom.conn.delete(custom.SUMMARY_KEY)
+        self.request("get", "/summary", 9, max_repeats=3)
+
+    def test_summary_is_cached(self):
+        import custom
+        custom.conn.delete(custom.SUMMARY_KEY)
+        first = self.client.get("/summary").data
+        self.client.post("/participant/w1/h1/a1/debug")
+        assert self.request("get", "/summary", 0).data == first
+        custom.conn.delete(custom.SUMMARY_KEY)
+        summary = loads(self.request("get", "/summary", 9, max_repeats=3).data)
+        assert summary["summary"] == [["working", 1]]
+
+    def test_node_post(self):
+        self.client.post("/participant/w1/h1/a1/debug")
+        self.build_experiment()
+        self.request("post", "/node/1", 19, max_repeats=2, max_commits=1)
+
+    def test_question_post(self):
+        self.client.post("/participant/w1/h1/a1/debug")
+        self.request("post", "/question/1", 2, max_commits=1, data={
+            "question": "q", "response": "r", "number": 1})
+
+    def test_node_neighbors(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/neighbors".format(node_id), 3)
+
+    def test_node_vectors(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/vectors".format(node_id), 4)
+
+    def test_node_infos(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/infos".format(node_id), 3)
+
+    def test_node_received_infos(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/received_infos".format(node_id), 5)
+
+    def test_info_post(self):
+        node_id = self.participant_with_node()
+        self.request("post", "/info/{}".format(node_id), 5, max_commits=1,
+                     data={"contents": "a story"})
+
+    def test_info_get(self):
+        node_id = self.participant_with_node()
+        self.client.post("/info/{}".format(node_id), data={"contents": "x"})
+        self.request("get", "/info/{}/2".format(node_id), 4, max_repeats=2)
+
+    def test_node_transmissions(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/transmissions".format(node_id), 5)
+
+    def test_node_transmit(self):
+        node_id = self.participant_with_node()
+        self.request("post", "/node/{}/transmit".format(node_id), 5,
+                     max_commits=1)
+
+    def test_node_transformations(self):
+        node_id = self.participant_with_node()
+        self.request("get", "/node/{}/transformations".format(node_id), 3)
+
+    def test_transformation_post(self):
+        node_id = self.participant_with_node()
+        self.client.post("/info/{}".format(node_id), data={"contents": "x"})
+        self.request("post", "/transformation/{}/1/2".format(node_id), 9,
+                     max_repeats=2, max_commits=1)
+
+    def test_deferred_hook_is_not_run(self):
+        import custom
+        node_id = self.participant_with_node()
+        exp = custom.experiment(db.session)
+        exp.deferred_hooks.add("info_post_request")
+        node = models.Node.query.get(node_id)
+        info = models.Info(origin=node, contents="x")
+        with QueryBudget(max_queries=1):
+            hook = custom.call_hook(exp, "info_post_request",
+                                    node=node, info=info)
+        assert hook == ("info_post_request",
+                        {"node": ("node", node_id), "info": ("info", info.id)})
+
+    def test_deferred_hook_loads_its_arguments(self):
+        import custom
+        import json
+        node_id = self.participant_with_node()
+        response = self.client.post("/info/{}".format(node_id),
+                                    data={"contents": "x"})
+        info_id = json.loads(response.data)["info"]["id"]
+        calls = []
+
+        def record(self, node, info):
+            calls.append((node.id, info.contents))
+
+        custom.experiment.info_post_request = record
+        try:
+            custom.execute_hook("info_post_request", {
+                "node": ("node", node_id), "info": ("info", info_id)})
+        finally:
+            del custom.experiment.info_post_request
+        assert calls == [(node_id, "x")]
+
+    def test_notification_metrics(self):
+        import json
+
+        def received():
+            response = self.request("get", "/notifications/metrics", 0)
+            return json.loads(response.data)["notifications"]["received"]
+
+        before = received()
+        self.request("post", "/notifications", 0, data={
+            "Event.1.EventType": "AssignmentAccepted",
+            "Event.1.AssignmentId": "a1"})
+        assert received() == before + 1
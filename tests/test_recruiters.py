@@ -29,3 +29,107 @@ class TestRecruiters(object):
     def test_recruiter_simulated(self):
         from dallinger.recruiters import SimulatedRecruiter
         assert SimulatedRecruiter()
+
+    def test_recruiter_psiturk_shares_config(self):
+        from dallinger.recruiters import PsiTurkRecruiter
+        assert PsiTurkRecruiter().config is PsiTurkRecruiter().config
+
+    def test_recruiter_coalescing(self):
+        import redis
+        from rq import Queue
+        from dallinger.recruiters import (
+            CoalescingRecruiter,
+            HotAirRecruiter,
+            PENDING_RECRUITMENT,
+            RECRUITMENT_SCHEDULED,
+        )
+        conn = redis.from_url(
+            os.getenv('REDIS_URL', 'redis://localhost:6379'))
+        queue = Queue("test_recruitment", connection=conn)
+        conn.delete(PENDING_RECRUITMENT, RECRUITMENT_SCHEDULED)
+        try:
+            recruiter = CoalescingRecruiter(HotAirRecruiter, queue)
+            recruiter.recruit_participants(n=2)
+            recruiter.recruit_participants(n=3)
+            assert int(conn.get(PENDING_RECRUITMENT)) == 5
+            assert len(queue) == 1
+        finally:
+            queue.empty()
+            conn.delete(PENDING_RECRUITMENT, RECRUITMENT_SCHEDULED)
+
+    def payouts(self, bonus=1.0):
+        from dallinger.models import Participant, Payout
+        participant = Participant(worker_id="w1", assignment_id="a1",
+                                  hit_id="h1", mode="debug")
+        self.add(participant)
+        self.add(Payout(assignment_id="a1", participant_id=participant.id,
+                        kind="approval"))
+        self.add(Payout(assignment_id="a1", participant_id=participant.id,
+                        kind="bonus", amount=bonus, reason="Thanks"))
+        return Payout
+
+    def test_payouts_are_made_once(self):
+        from dallinger.recruiters import make_payouts
+        Payout = self.payouts()
+        mturk = FakePayer()
+        assert make_payouts(mturk, backoff=0) == 2
+        assert make_payouts(mturk, backoff=0) == 0
+        assert mturk.calls == [("approve", "a1"), ("bonus", "a1", 1.0)]
+        assert [p.status for p in Payout.query.order_by(Payout.id)] == \
+            ["paid", "paid"]
+
+    def test_payouts_retry_with_backoff(self):
+        from dallinger.recruiters import make_payouts
+        Payout = self.payouts()
+        mturk = FakePayer(failures=2)
+        # Each call makes one attempt at the approval, and the bonus waits
+        # for it.
+        assert make_payouts(mturk, backoff=0) == 0
+        assert make_payouts(mturk, backoff=0) == 0
+        assert make_payouts(mturk, backoff=0) == 2
+        approval = Payout.query.filter_by(kind="approval").one()
+        assert approval.status == "paid"
+        assert approval.attempts == 3
+        assert approval.next_attempt_time is None
+
+    def test_failed_payout_waits_for_its_backoff(self):
+        from datetime import datetime
+        from dallinger.recruiters import make_payouts, next_payout_attempt
+        Payout = self.payouts()
+        mturk = FakePayer(failures=1)
+        assert make_payouts(mturk, backoff=60) == 0
+        assert make_payouts(mturk, backoff=60) == 0
+        assert len(mturk.calls) == 1
+        approval = Payout.query.filter_by(kind="approval").one()
+        assert approval.status == "pending"
+        assert approval.next_attempt_time > datetime.now()
+        assert next_payout_attempt() == approval.next_attempt_time
+
+    def test_bonus_fails_with_its_approval(self):
+        from dallinger.recruiters import make_payouts
+        Payout = self.payouts()
+        mturk = FakePayer(failures=10)
+        assert make_payouts(mturk, attempts=2, backoff=0) == 0
+        assert make_payouts(mturk, attempts=2, backoff=0) == 0
+        assert [p.status for p in Payout.query.order_by(Payout.id)] == \
+            ["failed", "failed"]
+        assert len(mturk.calls) == 2
+
+
+class FakePayer(object):
+    """Stands in for MTurk, refusing the first failures approvals."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+
+    def approve_hit(self, assignment_id):
+        self.calls.append(("approve", assignment_id))
+        if self.failures:
+            self.failures -= 1
+            return False
+        return True
+
+    def reward_bonus(self, assignment_id, amount, reason):
+        self.calls.append(("bonus", assignment_id, amount))
+        return True
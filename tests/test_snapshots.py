@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import zipfile
+
+from dallinger import snapshots
+
+
+class TestSnapshots(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, "code")
+        self.cache = os.path.join(self.directory, "cache")
+        os.makedirs(os.path.join(self.root, "static", "images"))
+        self.write("experiment.py", "class Experiment(object): pass\n")
+        self.write(os.path.join("static", "images", "stimulus.png"),
+                   "\x89PNG" * 1000)
+        self.write("experiment_id.txt", "first")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(contents)
+
+    def snapshot(self, name):
+        path = os.path.join(self.directory, name)
+        return snapshots.snapshot(self.root, path, self.cache), path
+
+    def test_snapshot_contents(self):
+        (digest, reused), path = self.snapshot("a.zip")
+        assert not reused
+        archive = zipfile.ZipFile(path)
+        assert sorted(archive.namelist()) == [
+            "experiment.py", "experiment_id.txt", "static/images/stimulus.png"]
+        assert archive.read("experiment_id.txt") == "first"
+        image = archive.getinfo("static/images/stimulus.png")
+        assert image.compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("experiment.py").compress_type == \
+            zipfile.ZIP_DEFLATED
+
+    def test_unchanged_code_is_reused(self):
+        (first, _), _ = self.snapshot("a.zip")
+        self.write("experiment_id.txt", "second")
+        (second, reused), path = self.snapshot("b.zip")
+        assert reused
+        assert first == second
+        assert zipfile.ZipFile(path).read("experiment_id.txt") == "second"
+
+    def test_changed_code_is_snapshotted(self):
+        (first, _), _ = self.snapshot("a.zip")
+        self.write("experiment.py", "class Experiment(object): x = 1\n")
+        (second, reused), path = self.snapshot("b.zip")
+        assert not reused
+        assert first != second
+        assert "x = 1" in zipfile.ZipFile(path).read("experiment.py")
+
+    def test_hashes_are_cached(self):
+        cache_path = os.path.join(self.directory, "hashes.json")
+        hashes = snapshots.file_hashes(self.root, cache_path=cache_path)
+        original = snapshots.file_hash
+        snapshots.file_hash = None
+        try:
+            assert snapshots.file_hashes(
+                self.root, cache_path=cache_path) == hashes
+        finally:
+            snapshots.file_hash = original
+
+    def test_prune(self):
+        for i in range(snapshots.CACHE_SIZE + 2):
+            self.write("experiment.py", "# version {}\n".format(i))
+            self.snapshot("{}.zip".format(i))
+        cached = [n for n in os.listdir(self.cache) if n.endswith(".zip")]
+        assert len(cached) == snapshots.CACHE_SIZE
+
+    def test_build_deflates_in_parallel(self):
+        for i in range(10):
+            self.write("stimulus{}.txt".format(i),
+                       "word {}\n".format(i) * 1000)
+        path = os.path.join(self.directory, "a.zip")
+        names = snapshots.file_hashes(self.root)
+        snapshots.build(self.root, names, path, jobs=3)
+        archive = zipfile.ZipFile(path)
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(names)
+        info = archive.getinfo("stimulus3.txt")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size
+        assert archive.read("stimulus3.txt") == "word 3\n" * 1000
@@ -0,0 +1,34 @@
+import os
+import shutil
+import tempfile
+
+from dallinger.heroku import worker
+
+
+class TestWorker(object):
+
+    def setup(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy(os.path.join("demos", "bartlett1932", "config.txt"),
+                    self.tmp)
+        os.chdir(self.tmp)
+
+    def teardown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_one_worker_process_by_default(self):
+        assert worker.worker_processes() == 1
+
+    def test_worker_processes_from_config(self):
+        with open("config.txt") as f:
+            config = f.read()
+        with open("config.txt", "w") as f:
+            f.write(config.replace(
+                "[Server Parameters]",
+                "[Server Parameters]\nworker_processes = 3"))
+        assert worker.worker_processes() == 3
+
+    def test_workers_listen_in_priority_order(self):
+        assert worker.listen == ["high", "default", "low"]